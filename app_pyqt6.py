@@ -2,7 +2,9 @@
 PyQt6 Interface for Astronomical Star Reduction - Before/After Comparison
 """
 
+import os
 import sys
+import time
 import numpy as np
 from astropy.io import fits
 from matplotlib.figure import Figure
@@ -10,14 +12,38 @@ from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvasQ
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
     QLabel, QPushButton, QFileDialog, QGridLayout, QMessageBox,
-    QSlider, QGroupBox
+    QSlider, QGroupBox, QProgressBar, QComboBox, QCheckBox,
+    QDialog, QDialogButtonBox, QFormLayout, QDoubleSpinBox
 )
 from PyQt6.QtGui import QFont
-from PyQt6.QtCore import Qt, pyqtSignal
+from PyQt6.QtCore import Qt, pyqtSignal, QThread, QTimer
 
-from star_detection import detect_stars, smooth_mask
-from erosion import apply_erosion, prepare_image
-from reduction_localisee import compute_final_image
+from pipeline import StageCache, PipelineCancelled, to_fits_layout, preview_params
+from fits_io import load_normalized
+from erosion import apply_erosion
+from pyramid import ImagePyramid
+from profiling import Profiler
+from catalog_cache import CatalogCache
+from fits_export import export_fits, DEFAULT_QUANTIZE_LEVEL
+from daemon_client import DaemonClient, DaemonError
+
+
+# Labels of the pipeline stages shown in the status bar
+ETAPES = {
+    'fond': "Estimation du fond",
+    'detection': "Détection des étoiles",
+    'masque': "Masque des étoiles",
+    'flou': "Flou du masque",
+    'seuil': "Seuil du masque",
+    'erosion': "Érosion",
+    'finale': "Image finale",
+}
+
+# Delay before reprocessing after the last slider change (ms)
+DELAI_DEBOUNCE = 300
+
+# Largest size of the live preview image (pixels), a level of the display pyramid
+PIXELS_APERCU = 1 << 19
 
 
 class ImageCanvas(FigureCanvasQTAgg):
@@ -31,6 +57,9 @@ class ImageCanvas(FigureCanvasQTAgg):
         self.setParent(parent)
         self.fig.patch.set_facecolor('black')
         self.image_data = None
+        self.pyramid = None
+        self.niveau = 0
+        self.artiste = None
         
         # Connect click event
         self.mpl_connect('button_press_event', self.on_click)
@@ -45,35 +74,102 @@ class ImageCanvas(FigureCanvasQTAgg):
     
     def display_image(self, data, title, cmap='gray', vmin_percentile=0.5, vmax_percentile=99.5):
         """Display image with percentile normalization"""
+        # Same image and layout: only the contrast changes, the axes are kept
+        if (data is self.image_data and self.artiste is not None and self.affichage[0] == title
+                and (data.ndim == 3 or self.affichage[1] == cmap)):
+            self.regler_contraste(vmin_percentile, vmax_percentile)
+            return
+
+        # New image of the same size and layout (e.g. live preview): only the pixels change, the axes are kept
+        meme_disposition = (self.artiste is not None and self.image_data is not None
+                            and data.shape == self.image_data.shape and self.affichage[0] == title
+                            and (data.ndim == 3 or self.affichage[1] == cmap))
+
+        # Pyramid built once per image
+        if data is not self.image_data or self.pyramid is None:
+            self.pyramid = ImagePyramid(data)
         self.image_data = data
+        self.affichage = (title, cmap, vmin_percentile, vmax_percentile)
+        if meme_disposition:
+            if data.ndim == 2:
+                self.artiste.set_data(self.pyramid.levels[self.niveau])
+            self.regler_contraste(vmin_percentile, vmax_percentile)
+            return
+        self.dessiner_niveau()
+
+    def taille_affichage(self):
+        """Size of the axes on screen, in physical pixels"""
+        bbox = self.ax.get_position()
+        ratio = self.devicePixelRatioF()
+        return (self.fig.get_figwidth() * self.fig.dpi * bbox.width * ratio,
+                self.fig.get_figheight() * self.fig.dpi * bbox.height * ratio)
+
+    def limites_contraste(self):
+        """Display range from the percentiles (prevents extreme pixels from destroying contrast)"""
+        _, _, vmin_percentile, vmax_percentile = self.affichage
+        data_min, data_max = self.pyramid.percentiles(vmin_percentile, vmax_percentile)
+        if data_max > data_min:
+            return data_min, data_max
+        return None
+
+    def image_etiree(self):
+        """Color level stretched to the display range (RGB images cannot use a colormap)"""
+        data = self.pyramid.levels[self.niveau]
+        limites = self.limites_contraste()
+        if limites is None:
+            return data
+        data_min, data_max = limites
+        return np.clip((data - data_min) / (data_max - data_min), 0, 1)
+
+    def dessiner_niveau(self):
+        """Draw the pyramid level matching the size of the canvas"""
+        title, cmap, _, _ = self.affichage
+        self.niveau = self.pyramid.level_for(*self.taille_affichage())
+        data = self.pyramid.levels[self.niveau]
         self.ax.clear()
-        
-        # Normalize using percentiles (prevents extreme pixels from destroying contrast)
-        if data.ndim == 3:
-            data_min = np.nanpercentile(data, vmin_percentile)
-            data_max = np.nanpercentile(data, vmax_percentile)
-        else:
-            data_min = np.nanpercentile(data, vmin_percentile)
-            data_max = np.nanpercentile(data, vmax_percentile)
 
-        if data_max > data_min:
-            data_norm = np.clip((data - data_min) / (data_max - data_min), 0, 1)
-        else:
-            data_norm = data
-        
-        # Display image
-        if data_norm.ndim == 3:
-            self.ax.imshow(data_norm, origin='upper')
+        # Display image, in full resolution pixel coordinates whatever the level
+        height, width = self.image_data.shape[:2]
+        extent = (-0.5, width - 0.5, height - 0.5, -0.5)
+        if data.ndim == 3:
+            self.artiste = self.ax.imshow(self.image_etiree(), origin='upper', extent=extent)
         else:
-            self.ax.imshow(data_norm, cmap=cmap, origin='upper')
+            limites = self.limites_contraste() or (None, None)
+            self.artiste = self.ax.imshow(data, cmap=cmap, origin='upper', extent=extent,
+                                          vmin=limites[0], vmax=limites[1])
 
         self.ax.set_title(title, fontsize=10, color='white', fontweight='bold')
         self.ax.axis('off')
         self.fig.patch.set_facecolor('black')
         self.draw()
 
+    def regler_contraste(self, vmin_percentile, vmax_percentile):
+        """Change the contrast of the displayed image without rebuilding the axes"""
+        title, cmap, _, _ = self.affichage
+        self.affichage = (title, cmap, vmin_percentile, vmax_percentile)
+
+        if self.pyramid.levels[self.niveau].ndim == 3:
+            self.artiste.set_data(self.image_etiree())
+        else:
+            limites = self.limites_contraste()
+            if limites is None:
+                self.artiste.autoscale()
+            else:
+                self.artiste.set_clim(*limites)
+        self.draw_idle()
+
+    def resizeEvent(self, event):
+        """Switch to a finer pyramid level when the canvas grows"""
+        super().resizeEvent(event)
+        if self.pyramid is not None and self.niveau > 0:
+            if self.pyramid.level_for(*self.taille_affichage()) < self.niveau:
+                self.dessiner_niveau()
+
     def clear_display(self):
         """Show default message when no image is loaded"""
+        self.image_data = None
+        self.pyramid = None
+        self.artiste = None
         self.ax.clear()
         self.ax.text(0.5, 0.5, 'No image loaded',
                      ha='center', va='center', color='gray', fontsize=12,
@@ -104,6 +200,55 @@ class ZoomWindow(QMainWindow):
         self.setCentralWidget(widget)
 
 
+class ExportDialog(QDialog):
+    """Options of the FITS export: compression, tiles, quantization and stages to include"""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Enregistrer le résultat")
+
+        layout = QFormLayout()
+
+        self.compression_combo = QComboBox()
+        self.compression_combo.addItem("RICE (rapide)", 'RICE_1')
+        self.compression_combo.addItem("GZIP avec mélange des octets", 'GZIP_2')
+        self.compression_combo.addItem("GZIP", 'GZIP_1')
+        self.compression_combo.addItem("Aucune", None)
+        layout.addRow("Compression:", self.compression_combo)
+
+        self.tuiles_combo = QComboBox()
+        self.tuiles_combo.addItem("Une ligne", None)
+        self.tuiles_combo.addItem("64 lignes", (64, 1 << 30))
+        self.tuiles_combo.addItem("256 × 256", (256, 256))
+        self.tuiles_combo.addItem("512 × 512", (512, 512))
+        layout.addRow("Tuiles:", self.tuiles_combo)
+
+        # 0: floating-point values stored without loss (GZIP only)
+        self.quantification_spin = QDoubleSpinBox()
+        self.quantification_spin.setRange(0, 256)
+        self.quantification_spin.setValue(DEFAULT_QUANTIZE_LEVEL)
+        self.quantification_spin.setSpecialValueText("Sans perte")
+        layout.addRow("Quantification (bruit / q):", self.quantification_spin)
+
+        self.masque_check = QCheckBox("Inclure le masque d'étoiles")
+        layout.addRow(self.masque_check)
+        self.erodee_check = QCheckBox("Inclure l'image érodée")
+        layout.addRow(self.erodee_check)
+
+        boutons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        boutons.accepted.connect(self.accept)
+        boutons.rejected.connect(self.reject)
+        layout.addRow(boutons)
+        self.setLayout(layout)
+
+    def options(self):
+        """Arguments of export_fits chosen in the dialog"""
+        return {
+            'compression': self.compression_combo.currentData(),
+            'tile_shape': self.tuiles_combo.currentData(),
+            'quantize_level': self.quantification_spin.value(),
+        }
+
+
 class ComparatorWindow(QMainWindow):
     """Side-by-side comparison with interactive slider"""
     def __init__(self, original, final):
@@ -112,6 +257,8 @@ class ComparatorWindow(QMainWindow):
         self.setGeometry(100, 100, 1000, 800)
         self.original = original
         self.final = final
+        self.pyramides = (ImagePyramid(original), ImagePyramid(final))
+        self.fond = None
 
         layout = QVBoxLayout()
 
@@ -128,10 +275,11 @@ class ComparatorWindow(QMainWindow):
         slider_label_left.setFixedWidth(60)
         slider_layout.addWidget(slider_label_left)
 
+        # Fine steps so the split follows the mouse
         self.slider = QSlider(Qt.Orientation.Horizontal)
         self.slider.setMinimum(0)
-        self.slider.setMaximum(100)
-        self.slider.setValue(50)
+        self.slider.setMaximum(1000)
+        self.slider.setValue(500)
         self.slider.valueChanged.connect(self.update_comparison)
         self.slider.setFixedHeight(20)
         slider_layout.addWidget(self.slider, 1)
@@ -153,25 +301,149 @@ class ComparatorWindow(QMainWindow):
         self.setCentralWidget(widget)
         self.setStyleSheet(f"background-color: #f0f0f0;")
 
-        self.update_comparison()
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.canvas.mpl_connect('resize_event', self.on_resize)
+        self.dessiner_images()
+
+    def dessiner_images(self):
+        """
+        Draw both images once: the final image below, the original above it
+        cropped at the split position. Both use the display range of the
+        original, so the stretch does not hide the star reduction.
+        """
+        ax = self.canvas.ax
+        ax.clear()
+
+        pyramide_originale, pyramide_finale = self.pyramides
+        self.niveau = pyramide_originale.level_for(*self.canvas.taille_affichage())
+        data_min, data_max = pyramide_originale.percentiles(0.5, 99.5)
+        if data_max <= data_min:
+            data_max = data_min + 1
+
+        # Displayed levels normalized once
+        self.niveaux = [
+            np.clip((pyramide.levels[self.niveau] - data_min) / (data_max - data_min), 0, 1)
+            for pyramide in self.pyramides
+        ]
+
+        height, width = self.original.shape[:2]
+        self.extent = (-0.5, width - 0.5, height - 0.5, -0.5)
+        self.artiste_finale = ax.imshow(self.niveaux[1], cmap='gray', vmin=0, vmax=1,
+                                        origin='upper', extent=self.extent)
+
+        # Animated artists are drawn by blitting over the saved background
+        self.artiste_originale = ax.imshow(self.niveaux[0], cmap='gray', vmin=0, vmax=1,
+                                           origin='upper', extent=self.extent, animated=True)
+        self.ligne = ax.axvline(0, color='white', linewidth=1, animated=True)
+        ax.set_xlim(self.extent[0], self.extent[1])
+        ax.set_ylim(self.extent[2], self.extent[3])
+        ax.axis('off')
+
+        self.placer_separation()
+        self.canvas.draw()
+
+    def placer_separation(self):
+        """Crop the original image at the split position and move the split line"""
+        value = self.slider.value()
+        self.percent_label.setText(f"{value / 10:.0f}%")
+
+        # Split in pixels of the displayed level, mapped back to full resolution coordinates
+        niveau = self.niveaux[0]
+        split = round(niveau.shape[1] * value / 1000)
+        x = -0.5 + split * self.original.shape[1] / niveau.shape[1]
+
+        self.artiste_originale.set_visible(split > 0)
+        if split > 0:
+            self.artiste_originale.set_data(niveau[:, :split])
+            self.artiste_originale.set_extent((self.extent[0], x) + self.extent[2:])
+        self.ligne.set_xdata([x, x])
+
+    def on_draw(self, event):
+        """Save the background (final image) after a full redraw and draw the animated artists"""
+        self.fond = self.canvas.copy_from_bbox(self.canvas.ax.bbox)
+        self.canvas.ax.draw_artist(self.artiste_originale)
+        self.canvas.ax.draw_artist(self.ligne)
+
+    def on_resize(self, event):
+        """Use a finer pyramid level when the window grows"""
+        if self.pyramides[0].level_for(*self.canvas.taille_affichage()) != self.niveau:
+            self.dessiner_images()
 
     def update_comparison(self):
         """Update blend based on slider position"""
-        value = self.slider.value()
-        self.percent_label.setText(f"{value}%")
-
-        # Create composite image by splitting left and right
-        split = int(self.original.shape[1] * value / 100)
-        if self.original.ndim == 3:
-            composite = np.zeros_like(self.original)
-            composite[:, :split] = self.original[:, :split]
-            composite[:, split:] = self.final[:, split:]
-        else:
-            composite = np.zeros_like(self.original)
-            composite[:, :split] = self.original[:, :split]
-            composite[:, split:] = self.final[:, split:]
+        self.placer_separation()
+        if self.fond is None:
+            self.canvas.draw_idle()
+            return
+
+        # Blit: restore the final image, draw the cropped original and the line over it
+        self.canvas.restore_region(self.fond)
+        self.canvas.ax.draw_artist(self.artiste_originale)
+        self.canvas.ax.draw_artist(self.ligne)
+        self.canvas.blit(self.canvas.ax.bbox)
+
+
+class TraitementThread(QThread):
+    """Run the pipeline in a background thread so the interface stays responsive"""
+    progression = pyqtSignal(str, int, int)
+    termine = pyqtSignal(dict)
+    erreur = pyqtSignal(str)
 
-        self.canvas.display_image(composite, "")
+    def __init__(self, pipeline, parametres, profiler=None):
+        super().__init__()
+        self.pipeline = pipeline
+        self.parametres = parametres
+        self.profiler = profiler
+        self.annule = False
+
+    def annuler(self):
+        """Ask the run to stop at the next stage boundary"""
+        self.annule = True
+
+    def run(self):
+        """Run the pipeline (executed in the background thread)"""
+        # Record the stages of this run (calls from this thread only)
+        if self.profiler is not None:
+            self.profiler.start()
+        try:
+            resultats = self.pipeline.run(
+                self.parametres,
+                progress=lambda etape, index, total: self.progression.emit(etape, index, total),
+                cancelled=lambda: self.annule
+            )
+            self.termine.emit(dict(resultats))
+        except PipelineCancelled:
+            pass
+        except Exception as e:
+            self.erreur.emit(str(e))
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+
+
+class DemonThread(QThread):
+    """Submit the loaded file to the reduction daemon and follow its progress"""
+    progression = pyqtSignal(str, int, int)
+    termine = pyqtSignal(dict)
+    erreur = pyqtSignal(str)
+
+    def __init__(self, entree, sortie, parametres):
+        super().__init__()
+        self.entree = entree
+        self.sortie = sortie
+        self.parametres = parametres
+
+    def run(self):
+        """Submit the job and wait for its end (executed in the background thread)"""
+        try:
+            client = DaemonClient()
+            tache = client.submit(self.entree, self.sortie, self.parametres, overwrite=True)
+            for evenement in client.events(tache['id']):
+                if evenement.get('stage'):
+                    self.progression.emit(evenement['stage'], evenement['index'], evenement['total'])
+            self.termine.emit(client.job(tache['id']))
+        except DaemonError as e:
+            self.erreur.emit(str(e))
 
 
 class ReductionAstroApp(QMainWindow):
@@ -189,13 +461,49 @@ class ReductionAstroApp(QMainWindow):
         # Store image data at different processing stages
         self.images_data = {
             'original': None,      # Normalized original image
-            'original_raw': None,  # Raw image for star detection
+            'original_raw': None,  # Image for star detection (file axis order, same buffer as 'original')
             'erodee': None,        # Eroded image
             'masque_brut': None,   # Binary star mask
             'masque_lisse': None,  # Smoothed mask
             'finale': None         # Final processed image
         }
         self.nb_etoiles = 0
+        self.header_original = None
+        self.chemin_image = None
+
+        # Timing and memory of the stages of the last run (when measured)
+        self.dernier_profil = None
+
+        # Parameters of the displayed results (the sliders may have moved since)
+        self.parametres_affiches = None
+
+        # Detection results kept on disk between sessions (reopening a file skips detection)
+        self.catalog_cache = CatalogCache()
+
+        # Cache of the pipeline stages (only the stages affected by a parameter change are recomputed)
+        self.pipeline = StageCache(catalog_cache=self.catalog_cache)
+
+        # Background processing: current run and parameters waiting for it to finish
+        self.thread_traitement = None
+        self.parametres_en_attente = None
+
+        # Debounce rapid slider changes
+        self.timer_debounce = QTimer(self)
+        self.timer_debounce.setSingleShot(True)
+        self.timer_debounce.setInterval(DELAI_DEBOUNCE)
+        self.timer_debounce.timeout.connect(self.traiter_image)
+
+        # Live preview while a slider is dragged: the pipeline runs on a downsampled
+        # level of the image (own cache), the full resolution run starts on release
+        self.apercu = StageCache()
+        self.facteur_apercu = 1
+        self.timer_apercu = QTimer(self)
+        self.timer_apercu.setSingleShot(True)
+        self.timer_apercu.setInterval(0)
+        self.timer_apercu.timeout.connect(self.traiter_apercu)
+
+        # Jobs sent to the reduction daemon and still followed
+        self.threads_demon = []
 
         # Keep zoom windows open
         self.zoom_windows = []
@@ -340,6 +648,44 @@ class ReductionAstroApp(QMainWindow):
         btn_comparateur.clicked.connect(self.show_comparateur)
         buttons_layout.addWidget(btn_comparateur)
 
+        btn_enregistrer = QPushButton("Enregistrer le résultat")
+        btn_enregistrer.setFont(QFont("Arial", 11, QFont.Weight.Bold))
+        btn_enregistrer.setStyleSheet(f"""
+            QPushButton {{
+                background-color: #34495e;
+                color: {self.couleur_texte};
+                border: none;
+                padding: 10px 20px;
+                border-radius: 5px;
+                font-weight: bold;
+            }}
+            QPushButton:hover {{
+                background-color: #2c3e50;
+            }}
+        """)
+        btn_enregistrer.clicked.connect(self.enregistrer_resultat)
+        buttons_layout.addWidget(btn_enregistrer)
+
+        btn_demon = QPushButton("Envoyer au démon")
+        btn_demon.setFont(QFont("Arial", 11, QFont.Weight.Bold))
+        btn_demon.setToolTip("Réduit le fichier en pleine résolution dans le démon local "
+                             "(python star_reduction.py serve), l'interface reste libre")
+        btn_demon.setStyleSheet(f"""
+            QPushButton {{
+                background-color: #8e44ad;
+                color: {self.couleur_texte};
+                border: none;
+                padding: 10px 20px;
+                border-radius: 5px;
+                font-weight: bold;
+            }}
+            QPushButton:hover {{
+                background-color: #71368a;
+            }}
+        """)
+        btn_demon.clicked.connect(self.envoyer_au_demon)
+        buttons_layout.addWidget(btn_demon)
+
         btn_reinitialiser = QPushButton("Réinitialiser les sliders")
         btn_reinitialiser.setFont(QFont("Arial", 11, QFont.Weight.Bold))
         btn_reinitialiser.setStyleSheet("""
@@ -359,9 +705,45 @@ class ReductionAstroApp(QMainWindow):
         buttons_layout.addWidget(btn_reinitialiser)
         
         buttons_layout.addStretch()
+
+        # Per-stage timing and memory, shown in the status bar and exportable
+        self.profil_check = QCheckBox("Mesurer les étapes")
+        buttons_layout.addWidget(self.profil_check)
+
+        self.apercu_check = QCheckBox("Aperçu en direct")
+        self.apercu_check.setToolTip("Traite une version réduite de l'image pendant le déplacement d'un slider, "
+                                     "la pleine résolution au relâchement")
+        self.apercu_check.setChecked(True)
+        buttons_layout.addWidget(self.apercu_check)
+
+        self.btn_profil = QPushButton("Exporter le profil")
+        self.btn_profil.setFont(QFont("Arial", 11, QFont.Weight.Bold))
+        self.btn_profil.setStyleSheet(f"""
+            QPushButton {{
+                background-color: #7f8c8d;
+                color: {self.couleur_texte};
+                border: none;
+                padding: 10px 20px;
+                border-radius: 5px;
+                font-weight: bold;
+            }}
+            QPushButton:hover {{
+                background-color: #636e72;
+            }}
+            QPushButton:disabled {{
+                background-color: #bdc3c7;
+            }}
+        """)
+        self.btn_profil.setEnabled(False)
+        self.btn_profil.clicked.connect(self.exporter_profil)
+        buttons_layout.addWidget(self.btn_profil)
         main_layout.addLayout(buttons_layout)
         
-        # Status bar
+        # Status bar with progress of the processing stages
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progress_bar)
         self.statusBar().showMessage("En attente d'une image...")
         
         central_widget.setLayout(main_layout)
@@ -472,6 +854,17 @@ class ReductionAstroApp(QMainWindow):
         radius_layout.addWidget(self.radius_label)
         layout.addLayout(radius_layout)
 
+        # Background estimator (computed once per image, reused by detection)
+        fond_layout = QHBoxLayout()
+        fond_layout.addWidget(QLabel("Estimation du fond:"))
+        self.fond_combo = QComboBox()
+        self.fond_combo.addItem("Complète", 'full')
+        self.fond_combo.addItem("Sous-échantillon", 'subsample')
+        self.fond_combo.addItem("Maillage 2D", 'mesh')
+        self.fond_combo.currentIndexChanged.connect(self.on_slider_change)
+        fond_layout.addWidget(self.fond_combo)
+        layout.addLayout(fond_layout)
+
         # Erosion parameters
         erosion_label = QLabel("- Érosion -")
         erosion_label.setStyleSheet("font-weight: bold; color: #27ae60;")
@@ -503,6 +896,28 @@ class ReductionAstroApp(QMainWindow):
         iter_layout.addWidget(self.iter_label)
         layout.addLayout(iter_layout)
 
+        # Erosion engine (uint8 OpenCV or float32 without quantization) and kernel shape
+        engine_layout = QHBoxLayout()
+        engine_layout.addWidget(QLabel("Moteur d'érosion:"))
+        self.engine_combo = QComboBox()
+        self.engine_combo.addItem("OpenCV (8 bits)", 'opencv')
+        self.engine_combo.addItem("Flottant (32 bits)", 'float')
+        self.engine_combo.currentIndexChanged.connect(self.on_slider_change)
+        engine_layout.addWidget(self.engine_combo)
+        engine_layout.addWidget(QLabel("Forme:"))
+        self.shape_combo = QComboBox()
+        self.shape_combo.addItem("Carré", 'square')
+        self.shape_combo.addItem("Cercle", 'circle')
+        self.shape_combo.currentIndexChanged.connect(self.on_slider_change)
+        engine_layout.addWidget(self.shape_combo)
+        engine_layout.addStretch()
+        layout.addLayout(engine_layout)
+
+        # Erode only the star regions (faster on sparse star fields)
+        self.localized_check = QCheckBox("Érosion localisée (zones d'étoiles uniquement)")
+        self.localized_check.stateChanged.connect(self.on_slider_change)
+        layout.addWidget(self.localized_check)
+
         # Mask smoothing parameters
         mask_label = QLabel("- Lissage du masque -")
         mask_label.setStyleSheet("font-weight: bold; color: #8e44ad;")
@@ -521,6 +936,16 @@ class ReductionAstroApp(QMainWindow):
         gauss_layout.addWidget(self.gauss_label)
         layout.addLayout(gauss_layout)
 
+        # Blur engine (full-frame filter, or blurred discs added at each star)
+        flou_layout = QHBoxLayout()
+        flou_layout.addWidget(QLabel("Calcul du flou:"))
+        self.flou_combo = QComboBox()
+        self.flou_combo.addItem("Filtre gaussien", 'filter')
+        self.flou_combo.addItem("Tampons par étoile", 'stamps')
+        self.flou_combo.currentIndexChanged.connect(self.on_slider_change)
+        flou_layout.addWidget(self.flou_combo)
+        layout.addLayout(flou_layout)
+
         # Mask threshold (binary threshold after smoothing)
         seuil_layout = QHBoxLayout()
         seuil_layout.addWidget(QLabel("Seuil masque:"))
@@ -552,6 +977,12 @@ class ReductionAstroApp(QMainWindow):
         contrast_layout.addWidget(self.contrast_label)
         layout.addLayout(contrast_layout)
 
+        # Processing sliders: live preview while dragged, full resolution on release
+        self.sliders_traitement = (self.fwhm_slider, self.threshold_slider, self.radius_slider, self.kernel_slider,
+                                   self.iter_slider, self.gauss_slider, self.seuil_slider)
+        for slider in self.sliders_traitement:
+            slider.sliderReleased.connect(self.on_slider_released)
+
         controls_group.setLayout(layout)
         return controls_group
 
@@ -569,6 +1000,40 @@ class ReductionAstroApp(QMainWindow):
         self.gauss_label.setText(f"{self.gauss_slider.value() / 10.0:.1f}")
         self.seuil_label.setText(f"{self.seuil_slider.value() / 100.0:.2f}")
 
+        if self.images_data['original'] is None:
+            return
+
+        # Slider being dragged: preview at low resolution, the full resolution run waits for the release
+        if self.apercu_check.isChecked() and any(slider.isSliderDown() for slider in self.sliders_traitement):
+            self.timer_debounce.stop()
+            self.timer_apercu.start()
+            return
+
+        # Reprocess once the sliders stop moving
+        self.timer_debounce.start()
+
+    def on_slider_released(self):
+        """Run the full resolution processing as soon as a dragged slider is released"""
+        if self.images_data['original'] is not None and self.apercu_check.isChecked():
+            self.timer_apercu.stop()
+            self.traiter_image()
+
+    def traiter_apercu(self):
+        """Run the pipeline on the preview image and display its result (in the interface thread)"""
+        # The full resolution run of the previous parameters is outdated
+        if self.thread_traitement is not None:
+            self.parametres_en_attente = None
+            self.thread_traitement.annuler()
+
+        debut = time.perf_counter()
+        try:
+            resultats = self.apercu.run(preview_params(self.lire_parametres(), self.facteur_apercu))
+        except Exception as e:
+            self.statusBar().showMessage(f"Erreur de l'aperçu : {e}")
+            return
+        self.canvas_finale.display_image(resultats['finale'], "Finale (aperçu)")
+        self.statusBar().showMessage(f"Aperçu 1/{self.facteur_apercu} ({(time.perf_counter() - debut) * 1000:.0f} ms)"
+                                     " - pleine résolution au relâchement du slider")
 
     def on_contrast_change(self):
         """Update display contrast based on slider"""
@@ -610,19 +1075,34 @@ class ReductionAstroApp(QMainWindow):
 
         try:
             # Load FITS file
-            with fits.open(chemin) as hdul:
-                data_raw = hdul[0].data.astype(float)
-
-            # Store raw data for star detection
-            self.images_data['original_raw'] = data_raw.copy()
+            # Memory-mapped loading, normalized (and transposed if needed) into one float32 buffer
+            data_norm, data_raw, self.header_original = load_normalized(chemin)
+            self.chemin_image = chemin
 
-            # Prepare image (normalize + transpose if needed)
-            data_norm = prepare_image(data_raw)
+            # Star detection runs on the same buffer, in the axis order of the file
+            # (DAOStarFinder is insensitive to the normalization)
+            self.images_data['original_raw'] = data_raw
 
             # Display original image
             self.images_data['original'] = data_norm
+
+            # Results of the previous image are not saved with this one
+            for etape in ('erodee', 'masque_brut', 'masque_lisse', 'finale'):
+                self.images_data[etape] = None
+            self.parametres_affiches = None
+
+            # New cache for the new image (a running thread keeps its own)
+            self.pipeline = StageCache(catalog_cache=self.catalog_cache)
+            self.pipeline.reset(original=data_norm, original_raw=self.images_data['original_raw'])
             self.canvas_original.display_image(data_norm, "Originale")
 
+            # Preview image: largest level of the display pyramid under PIXELS_APERCU
+            niveaux = self.canvas_original.pyramid.levels
+            index = next((index for index, niveau in enumerate(niveaux)
+                          if niveau.shape[0] * niveau.shape[1] <= PIXELS_APERCU), len(niveaux) - 1)
+            self.facteur_apercu = 2 ** index
+            self.apercu.reset(original=niveaux[index], original_raw=niveaux[index])
+
             # Process the image
             self.traiter_image()
 
@@ -631,68 +1111,135 @@ class ReductionAstroApp(QMainWindow):
             QMessageBox.critical(self, "Erreur", f"Erreur lors du traitement:\n{str(e)}")
             self.statusBar().showMessage("Erreur")
 
-    def traiter_image(self):
-        """Apply star reduction algorithm"""
-        try:
-            # Get stored data
-            data_norm = self.images_data['original']
-            data_raw = self.images_data['original_raw']
-
-            # Retrieve all parameters from sliders
-            fwhm = self.fwhm_slider.value() / 10.0
-            threshold_sigma = self.threshold_slider.value() / 10.0
-            radius = self.radius_slider.value() / 10.0
-
-            # Map slider values to kernel sizes
-            kernel_sizes = {1: 3, 2: 5, 3: 7, 4: 9, 5: 11, 6: 13, 7: 15, 8: 17, 9: 19, 10: 21}
-            kernel_size = kernel_sizes[self.kernel_slider.value()]
-            iterations = self.iter_slider.value()
-
-            gauss_sigma = self.gauss_slider.value() / 10.0
-            mask_threshold = self.seuil_slider.value() / 100.0
-
-            # STEP 1: Detect stars (create binary mask)
-            masque_brut, sources = detect_stars(
-                data_raw,
-                fwhm=fwhm,
-                threshold_sigma=threshold_sigma,
-                radius=radius
-            )
-            self.images_data['masque_brut'] = masque_brut
+    def lire_parametres(self):
+        """Read all processing parameters from the sliders"""
+        # Map slider values to kernel sizes
+        kernel_sizes = {1: 3, 2: 5, 3: 7, 4: 9, 5: 11, 6: 13, 7: 15, 8: 17, 9: 19, 10: 21}
+
+        return {
+            'fwhm': self.fwhm_slider.value() / 10.0,
+            'threshold_sigma': self.threshold_slider.value() / 10.0,
+            'radius': self.radius_slider.value() / 10.0,
+            # Detection in the processing thread: a process pool forked from the
+            # (multithreaded) interface could deadlock, and could not be cancelled
+            'detection_workers': 1,
+            'background_method': self.fond_combo.currentData(),
+            'kernel_size': kernel_sizes[self.kernel_slider.value()],
+            'iterations': self.iter_slider.value(),
+            'erosion_engine': self.engine_combo.currentData(),
+            'erosion_shape': self.shape_combo.currentData(),
+            'localized': self.localized_check.isChecked(),
+            'gauss_sigma': self.gauss_slider.value() / 10.0,
+            'blur_engine': self.flou_combo.currentData(),
+            'mask_threshold': self.seuil_slider.value() / 100.0,
+        }
 
-            # Count detected stars
-            if sources is not None:
-                self.nb_etoiles = len(sources)
-            else:
-                self.nb_etoiles = 0
+    def traiter_image(self):
+        """Apply star reduction algorithm in a background thread"""
+        self.timer_debounce.stop()
+        parametres = self.lire_parametres()
+
+        # A run is already in progress: cancel it, the newest parameters run after it
+        if self.thread_traitement is not None:
+            self.parametres_en_attente = parametres
+            self.thread_traitement.annuler()
+            return
 
-            # STEP 2: Apply gaussian blur to smooth the mask
-            masque_lisse = smooth_mask(masque_brut, sigma=gauss_sigma, threshold=mask_threshold)
-            self.images_data['masque_lisse'] = masque_lisse
+        self.lancer_thread(parametres)
+
+    def lancer_thread(self, parametres):
+        """Start a background processing run"""
+        profiler = Profiler() if self.profil_check.isChecked() else None
+        self.thread_traitement = TraitementThread(self.pipeline, parametres, profiler)
+        self.thread_traitement.progression.connect(self.on_progression)
+        self.thread_traitement.termine.connect(self.on_traitement_termine)
+        self.thread_traitement.erreur.connect(self.on_traitement_erreur)
+        self.thread_traitement.finished.connect(self.on_thread_fini)
+
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.thread_traitement.start()
+
+    def on_progression(self, etape, index, total):
+        """Show the current stage in the status bar"""
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(index)
+        self.statusBar().showMessage(f"Étape {index + 1}/{total} : {ETAPES.get(etape, etape)}...")
+
+    def on_traitement_termine(self, resultats):
+        """Display the results of a finished run"""
+        # Only the newest result is displayed (a run cancelled by a preview may still finish)
+        if (self.parametres_en_attente is not None or self.sender() is not self.thread_traitement
+                or self.sender().annule):
+            return
 
-            # STEP 3: Create eroded image
-            # Apply morphological erosion to reduce stars
-            data_erodee = apply_erosion(data_norm, kernel_size=kernel_size, iterations=iterations)
-            self.images_data['erodee'] = data_erodee
+        self.images_data['masque_brut'] = resultats['masque_brut']
+        self.images_data['masque_lisse'] = resultats['masque_lisse']
+        self.images_data['erodee'] = resultats['erodee']
+        self.images_data['finale'] = resultats['finale']
+        self.parametres_affiches = self.sender().parametres
+        image_finale = resultats['finale']
 
-            # STEP 4: Compute final image
-            # Formula: I_final = (M × I_erode) + ((1 - M) × I_original)
-            # Blend original and eroded images using smooth mask
-            image_finale = compute_final_image(data_norm, data_erodee, masque_lisse)
-            self.images_data['finale'] = image_finale
+        # Count detected stars
+        if resultats['sources'] is not None:
+            self.nb_etoiles = len(resultats['sources'])
+        else:
+            self.nb_etoiles = 0
+
+        # Display final processed image
+        self.canvas_finale.display_image(image_finale, "Finale")
+
+        # Update status bar (with the time and memory of the recomputed stages when measured)
+        message = f"Traitement terminé - {self.nb_etoiles} étoiles détectées"
+        profiler = self.sender().profiler
+        if profiler is not None:
+            self.dernier_profil = profiler
+            self.btn_profil.setEnabled(True)
+            message += f" | {profiler.format_summary(top_level_only=True) or 'aucune étape recalculée'}"
+        self.statusBar().showMessage(message)
+        self.info_label.setText(f"Étoiles détectées: {self.nb_etoiles}")
+
+    def on_traitement_erreur(self, message):
+        """Show an error raised in the background thread"""
+        if self.parametres_en_attente is not None:
+            return
+        QMessageBox.critical(self, "Erreur", f"Erreur lors du traitement:\n{message}")
+        self.statusBar().showMessage("Erreur")
+
+    def on_thread_fini(self):
+        """Start the pending run, if any, once the current thread has stopped"""
+        self.thread_traitement.wait()
+        self.thread_traitement = None
+        self.progress_bar.setVisible(False)
+
+        if self.parametres_en_attente is not None:
+            parametres = self.parametres_en_attente
+            self.parametres_en_attente = None
+            self.lancer_thread(parametres)
+
+    def exporter_profil(self):
+        """Save the profile of the last measured run as JSON or Chrome trace"""
+        if self.dernier_profil is None:
+            return
 
-            # Display final processed image
-            self.canvas_finale.display_image(image_finale, "Finale")
+        chemin, filtre = QFileDialog.getSaveFileName(
+            self,
+            "Exporter le profil",
+            "profil.json",
+            "Profil JSON (*.json);;Trace Chrome (*.trace.json)"
+        )
+        if not chemin:
+            return
 
-            # Update status bar
-            self.statusBar().showMessage(f"Traitement terminé - {self.nb_etoiles} étoiles détectées")
-            self.info_label.setText(f"Étoiles détectées: {self.nb_etoiles}")
+        try:
+            if filtre.startswith("Trace"):
+                self.dernier_profil.to_chrome_trace(chemin)
+            else:
+                self.dernier_profil.to_json(chemin)
+            self.statusBar().showMessage(f"Profil enregistré : {chemin}")
+        except OSError as e:
+            QMessageBox.critical(self, "Erreur", f"Impossible d'enregistrer le profil:\n{str(e)}")
 
-        except Exception as e:
-            # Show error message
-            QMessageBox.critical(self, "Erreur", f"Erreur lors du traitement:\n{str(e)}")
-            self.statusBar().showMessage("Erreur")
-    
     def retraiter(self):
         """Reprocess image with updated parameters"""
         if self.images_data['original'] is None:
@@ -701,14 +1248,109 @@ class ReductionAstroApp(QMainWindow):
         self.statusBar().showMessage("Retraitement en cours...")
         self.traiter_image()
 
+    def image_erodee(self):
+        """Eroded image (computed on demand in localized mode) with the parameters of the displayed final image"""
+        if self.images_data['erodee'] is None:
+            parametres = self.parametres_affiches
+            self.images_data['erodee'] = apply_erosion(
+                self.images_data['original'],
+                kernel_size=parametres['kernel_size'],
+                iterations=parametres['iterations'],
+                engine=parametres['erosion_engine'],
+                shape=parametres['erosion_shape']
+            )
+        return self.images_data['erodee']
+
     def show_erodee(self):
         """Display eroded image in zoom window"""
-        if self.images_data['erodee'] is None:
+        if self.images_data['finale'] is None:
             QMessageBox.warning(self, "Attention", "Veuillez charger une image d'abord")
             return
-        
+
         # Open zoom window with eroded image
-        self.show_zoom(self.images_data['erodee'], "Image Érodée")
+        self.show_zoom(self.image_erodee(), "Image Érodée")
+
+    def enregistrer_resultat(self):
+        """Save the final image (and optionally the mask and eroded image) as a FITS file"""
+        if self.images_data['finale'] is None:
+            QMessageBox.warning(self, "Attention", "Veuillez charger une image d'abord")
+            return
+
+        dialogue = ExportDialog(self)
+        if dialogue.exec() != QDialog.DialogCode.Accepted:
+            return
+
+        chemin, _ = QFileDialog.getSaveFileName(
+            self,
+            "Enregistrer le résultat",
+            "results/finale.fits",
+            "FITS Files (*.fits *.fit *.FITS)"
+        )
+        if not chemin:
+            return
+
+        # Same axis order as the original file, so its header (and WCS) still applies
+        data_raw = self.images_data['original_raw']
+        images = {'finale': to_fits_layout(self.images_data['finale'], data_raw).astype(np.float32)}
+        if dialogue.masque_check.isChecked():
+            images['masque'] = self.images_data['masque_lisse']
+        if dialogue.erodee_check.isChecked():
+            images['erodee'] = to_fits_layout(self.image_erodee(), data_raw)
+
+        self.statusBar().showMessage("Enregistrement en cours...")
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            rapport = export_fits(chemin, images, self.header_original, overwrite=True, **dialogue.options())
+        except (OSError, ValueError) as e:
+            QMessageBox.critical(self, "Erreur", f"Impossible d'enregistrer le résultat:\n{str(e)}")
+            self.statusBar().showMessage("Erreur")
+            return
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        self.statusBar().showMessage(
+            f"Résultat enregistré : {chemin} ({rapport['bytes'] / 1e6:.1f} Mo, "
+            f"{rapport['bytes'] / rapport['data_bytes']:.0%} des données, {rapport['seconds']:.1f} s)"
+        )
+
+    def envoyer_au_demon(self):
+        """Queue the loaded file with the current parameters on the reduction daemon"""
+        if self.chemin_image is None:
+            QMessageBox.warning(self, "Attention", "Veuillez charger une image d'abord")
+            return
+
+        nom = os.path.splitext(os.path.basename(self.chemin_image))[0]
+        chemin, _ = QFileDialog.getSaveFileName(
+            self,
+            "Résultat du démon",
+            f"results/daemon/{nom}_finale.fits",
+            "FITS Files (*.fits *.fit *.FITS)"
+        )
+        if not chemin:
+            return
+
+        thread = DemonThread(self.chemin_image, chemin, self.lire_parametres())
+        thread.progression.connect(lambda etape, index, total: self.statusBar().showMessage(
+            f"Démon, {os.path.basename(thread.entree)} : étape {index + 1}/{total} ({ETAPES.get(etape, etape)})"))
+        thread.termine.connect(self.on_demon_termine)
+        thread.erreur.connect(self.on_demon_erreur)
+        thread.finished.connect(lambda: self.threads_demon.remove(thread))
+        self.threads_demon.append(thread)
+        thread.start()
+        self.statusBar().showMessage(f"Envoyé au démon : {self.chemin_image}")
+
+    def on_demon_termine(self, tache):
+        """Report the end of a daemon job"""
+        if tache['state'] == 'done':
+            self.statusBar().showMessage(f"Démon : {tache['output']} enregistré ({tache['nb_stars']} étoiles, "
+                                         f"{tache['elapsed']:.1f} s)")
+        else:
+            self.statusBar().showMessage(f"Démon : échec de {tache['input']} ({tache.get('error', tache['state'])})")
+
+    def on_demon_erreur(self, message):
+        """Show an error of the daemon (not started, job refused, or daemon stopped during the job)"""
+        QMessageBox.critical(self, "Erreur", f"Erreur du démon:\n{message}")
+        self.statusBar().showMessage("Erreur du démon")
 
     def show_masque(self):
         """Display star mask in zoom window"""
@@ -751,7 +1393,12 @@ class ReductionAstroApp(QMainWindow):
         self.radius_slider.setValue(36)
         self.kernel_slider.setValue(1)
         self.iter_slider.setValue(1)
+        self.fond_combo.setCurrentIndex(0)
+        self.engine_combo.setCurrentIndex(0)
+        self.shape_combo.setCurrentIndex(0)
+        self.localized_check.setChecked(False)
         self.gauss_slider.setValue(18)
+        self.flou_combo.setCurrentIndex(0)
         self.seuil_slider.setValue(54)
         self.contrast_slider.setValue(995)
 
@@ -762,6 +1409,17 @@ class ReductionAstroApp(QMainWindow):
             self.statusBar().showMessage("En attente d'une image...")
 
 
+    def closeEvent(self, event):
+        """Stop the background processing before closing"""
+        self.timer_debounce.stop()
+        self.timer_apercu.stop()
+        self.parametres_en_attente = None
+        if self.thread_traitement is not None:
+            self.thread_traitement.annuler()
+            self.thread_traitement.wait()
+        super().closeEvent(event)
+
+
 def main():
     """Start the application"""
     app = QApplication(sys.argv)
@@ -0,0 +1,96 @@
+"""
+Benchmark of the blending step (compute_final_image) on color frames.
+
+Compares the former formula on a stacked 3-channel mask with the in-place
+dense path and the sparse path, for several fractions of star pixels.
+Reports the best wall time, the peak memory allocated during the call
+(tracemalloc, which follows numpy allocations) and checks that every
+version gives the same image.
+
+Usage:
+    python benchmarks/bench_blend.py
+    python benchmarks/bench_blend.py --size 4000 6000
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from reduction_localisee import compute_final_image
+
+
+def blend_stacked(original, eroded, mask):
+    """Former implementation of compute_final_image (reference)"""
+    if original.ndim == 3 and mask.ndim == 2:
+        mask_3d = np.stack([mask, mask, mask], axis=2)
+    else:
+        mask_3d = mask
+    return (mask_3d * eroded) + ((1 - mask_3d) * original)
+
+
+def measured(func, *args, repeat=3):
+    """Return the best wall time, the peak allocated memory in bytes and the result"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def star_mask(shape, fraction, rng):
+    """Float32 mask with about fraction of nonzero pixels, grouped in small discs"""
+    mask = np.zeros(shape, dtype=np.float32)
+    n_stars = int(fraction * mask.size / 45)
+    ys = rng.integers(0, shape[0], n_stars)
+    xs = rng.integers(0, shape[1], n_stars)
+    for dy in range(-3, 4):
+        for dx in range(-3, 4):
+            if dx * dx + dy * dy <= 14:
+                mask[np.clip(ys + dy, 0, shape[0] - 1), np.clip(xs + dx, 0, shape[1] - 1)] = 0.8
+    return mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, nargs=2, default=(4000, 6000), metavar=('HEIGHT', 'WIDTH'))
+    args = parser.parse_args()
+
+    shape = tuple(args.size)
+    rng = np.random.default_rng(0)
+    original = rng.random(shape + (3,), dtype=np.float32)
+    eroded = rng.random(shape + (3,), dtype=np.float32)
+    frame_mb = original.nbytes / 1e6
+
+    print(f"Color image {shape[1]}x{shape[0]} float32 ({frame_mb:.0f} MB per image)")
+    print(f"{'stars':>6} {'version':>8} {'time (s)':>9} {'peak (MB)':>10} {'same':>5}")
+
+    for fraction in (0.001, 0.01, 0.05, 0.2):
+        mask = star_mask(shape, fraction, rng)
+        _, _, ref = measured(blend_stacked, original, eroded, mask, repeat=1)
+
+        versions = {
+            'stacked': lambda: blend_stacked(original, eroded, mask),
+            'dense': lambda: compute_final_image(original, eroded, mask, sparse=False),
+            'sparse': lambda: compute_final_image(original, eroded, mask, sparse=True),
+        }
+        for name, func in versions.items():
+            elapsed, peak, result = measured(func)
+            same = np.array_equal(ref, result) and result.dtype == ref.dtype
+            label = f"{np.count_nonzero(mask) / mask.size:.1%}"
+            print(f"{label:>6} {name:>8} {elapsed:>9.3f} {peak / 1e6:>10.0f} {str(same):>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark of the erosion engines.
+
+Compares, for every kernel size offered by the GUI (3 to 21), the uint8
+OpenCV path of apply_erosion with the float32 engine (erode_float):
+- precision: error against the exact float32 erosion (OpenCV on float32
+  data, iterated), which the float engine must reproduce exactly
+- speed: wall time of both engines and of the iterated OpenCV float32 erosion
+
+A second table compares the two implementations of the 1D line minimum
+used by the float engine (OpenCV line kernel and van Herk/Gil-Werman),
+which sets erosion.VHGW_MIN_SIZE.
+
+Usage:
+    python benchmarks/bench_erosion.py [--size 4000x6000] [--iterations 1 3]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from erosion import apply_erosion, structuring_element, min_filter_1d
+
+
+def timed(func, repeat=3):
+    """Return the best wall time of several runs and the last result"""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def synthetic_image(height, width, seed=0):
+    """Smooth background with noise and point sources, normalized between 0 and 1"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:height, :width]
+    data = 0.1 + 0.05 * np.sin(xx / 97.0) * np.cos(yy / 61.0)
+    data += rng.normal(0, 0.01, (height, width))
+    n = height * width // 2000
+    data[rng.integers(0, height, n), rng.integers(0, width, n)] += rng.uniform(0.2, 0.9, n)
+    return np.clip(data, 0, 1).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='4000x6000', help="image size HEIGHTxWIDTH (default: 4000x6000)")
+    parser.add_argument('--iterations', type=int, nargs='+', default=[1, 3])
+    args = parser.parse_args()
+
+    height, width = (int(v) for v in args.size.split('x'))
+    data = synthetic_image(height, width)
+    print(f"Image {width}x{height} float32")
+    print(f"{'shape':>6} {'kernel':>6} {'iter':>4} | {'uint8 (s)':>9} {'float (s)':>9} {'cv f32 (s)':>10} | "
+          f"{'uint8 max err':>13} {'uint8 mean err':>14} {'float exact':>11}")
+
+    for shape in ('square', 'circle'):
+        for iterations in args.iterations:
+            for kernel_size in range(3, 22, 2):
+                t_uint8, eroded_uint8 = timed(lambda: apply_erosion(
+                    data, kernel_size, iterations, engine='opencv', shape=shape))
+                t_float, eroded_float = timed(lambda: apply_erosion(
+                    data, kernel_size, iterations, engine='float', shape=shape))
+                kernel = structuring_element(kernel_size, shape)
+                t_ref, reference = timed(lambda: cv.erode(data, kernel, iterations=iterations))
+
+                error = np.abs(eroded_uint8 - reference)
+                exact = np.array_equal(eroded_float, reference)
+                print(f"{shape:>6} {kernel_size:>6} {iterations:>4} | {t_uint8:>9.3f} {t_float:>9.3f} {t_ref:>10.3f} | "
+                      f"{error.max():>13.5f} {error.mean():>14.6f} {str(exact):>11}")
+
+    print()
+    print(f"{'line':>6} | {'opencv (s)':>10} {'vHGW (s)':>9} {'same':>5}")
+    for size in (3, 21, 61, 101, 201, 301, 401):
+        t_cv, line_cv = timed(lambda: cv.erode(data, np.ones((1, size), np.uint8)))
+        t_vhgw, line_vhgw = timed(lambda: min_filter_1d(data, size, axis=1))
+        print(f"{size:>6} | {t_cv:>10.3f} {t_vhgw:>9.3f} {str(np.array_equal(line_cv, line_vhgw)):>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark of the tiled parallel star detection (find_stars_parallel).
+
+Detects the stars of a synthetic field in a single pass and on tiles in a
+process pool, and checks that both give the same catalog. Stars are also
+drawn on the image border, some centred just outside it: with a small
+FWHM their centroid falls outside the frame and must still be kept by
+one tile.
+
+Usage:
+    python benchmarks/bench_parallel_detection.py
+    python benchmarks/bench_parallel_detection.py --megapixels 16 --workers 4
+"""
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from astropy.stats import sigma_clipped_stats
+from star_detection import find_stars, find_stars_parallel, centroid_columns
+from synthetic import shape_for_megapixels, generate_field, add_stars
+
+
+def edge_field(megapixels, fwhm, seed=0):
+    """Synthetic field with extra stars centred on the four borders and up to one pixel outside"""
+    shape = shape_for_megapixels(megapixels)
+    image, _ = generate_field(shape, n_stars=int(2000 * megapixels), fwhm=fwhm, seed=seed)
+    image = image.astype(np.float32)
+
+    rng = np.random.default_rng(seed + 1)
+    height, width = shape
+    n = 50
+    along_x = rng.uniform(0, width - 1, n)
+    along_y = rng.uniform(0, height - 1, n)
+    outside = rng.uniform(-1.0, 0.6, n)
+    xs = np.concatenate([outside, width - 1 - outside, along_x, along_x])
+    ys = np.concatenate([along_y, along_y, outside, height - 1 - outside])
+    add_stars(image, xs, ys, np.full(len(xs), 3000.0), fwhm)
+    return image
+
+
+def positions(sources):
+    """Centroids of a catalog sorted by position"""
+    if sources is None:
+        return np.empty((0, 2))
+    x_column, y_column = centroid_columns(sources)
+    points = np.column_stack([np.asarray(sources[x_column]), np.asarray(sources[y_column])])
+    return points[np.lexsort((points[:, 1], points[:, 0]))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--megapixels', type=float, default=4)
+    parser.add_argument('--fwhm', type=float, default=1.2)
+    parser.add_argument('--threshold-sigma', type=float, default=5.0)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    image = edge_field(args.megapixels, args.fwhm)
+    background = sigma_clipped_stats(image, sigma=3.0)
+    start = time.perf_counter()
+    reference = positions(find_stars(image, fwhm=args.fwhm, threshold_sigma=args.threshold_sigma,
+                                     background=background))
+    t_single = time.perf_counter() - start
+
+    print(f"Image {image.shape[1]}x{image.shape[0]}, {args.workers} worker(s)")
+    print(f"{'tile':>6} {'stars':>7} {'single (s)':>11} {'tiled (s)':>10} {'same':>5}")
+    for tile_size in (256, 512, 1024):
+        start = time.perf_counter()
+        tiled = positions(find_stars_parallel(image, fwhm=args.fwhm, threshold_sigma=args.threshold_sigma,
+                                              background=background, workers=args.workers, tile_size=tile_size))
+        t_tiled = time.perf_counter() - start
+        same = tiled.shape == reference.shape and np.allclose(tiled, reference)
+        print(f"{tile_size:>6} {len(tiled):>7} {t_single:>11.2f} {t_tiled:>10.2f} {str(same):>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark of the streaming batch pipeline (streaming.stream_jobs).
+
+Reduces a set of synthetic frames one after the other (read, reduce,
+write, as the former batch workers did) and with reads and writes
+overlapped with the reduction by reader and writer threads. A latency can
+be added to every read and write to model slow storage (network shares,
+USB disks), where the threads wait without using the CPU. Reports the
+wall time, the time spent in each stage and checks that both runs write
+the same images.
+
+Usage:
+    python benchmarks/bench_streaming.py
+    python benchmarks/bench_streaming.py --frames 12 --size 2000 3000 --latency 0.5
+"""
+
+import argparse
+import functools
+import os
+import sys
+import tempfile
+import time
+
+from astropy.io import fits
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pipeline import DEFAULT_PARAMS
+from star_reduction import read_file, reduce_file, write_file
+from streaming import stream_jobs
+from synthetic import generate_field, write_field
+
+
+def delayed(func, latency):
+    """func preceded by a wait of latency seconds (slow storage)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        time.sleep(latency)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def run_sequential(jobs, read, compute, write):
+    """Former batch worker loop: each file is read, reduced and written before the next one"""
+    totals = {'load': 0.0, 'compute': 0.0, 'write': 0.0}
+    start = time.perf_counter()
+    for job in jobs:
+        step_start = time.perf_counter()
+        data = read(job)
+        totals['load'] += time.perf_counter() - step_start
+
+        step_start = time.perf_counter()
+        result = compute(data)
+        totals['compute'] += time.perf_counter() - step_start
+
+        step_start = time.perf_counter()
+        write(job, result)
+        totals['write'] += time.perf_counter() - step_start
+    return time.perf_counter() - start, totals
+
+
+def run_streaming(jobs, read, compute, write, prefetch):
+    """Reads and writes in threads, overlapped with the reduction"""
+    totals = {'load': 0.0, 'compute': 0.0, 'write': 0.0}
+    start = time.perf_counter()
+    for _, result, error, timings in stream_jobs(jobs, read, compute, write, prefetch=prefetch):
+        if error is not None:
+            raise error
+        totals['compute'] += result[1]
+        for record in timings:
+            totals[record['name']] += record['wall_s']
+    return time.perf_counter() - start, totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--frames', type=int, default=8)
+    parser.add_argument('--size', type=int, nargs=2, default=(2000, 3000), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--latency', type=float, default=0.0, help="added to every read and write (seconds)")
+    parser.add_argument('--prefetch', type=int, default=2)
+    args = parser.parse_args()
+
+    params = {**DEFAULT_PARAMS, 'fwhm': 3.0, 'threshold_sigma': 5.0}
+    compute = functools.partial(reduce_file, params=params)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(args.frames):
+            image, _ = generate_field(tuple(args.size), n_stars=args.size[0] * args.size[1] // 1000, seed=index)
+            write_field(os.path.join(directory, f'frame{index:03d}.fits'), image)
+
+        print(f"{args.frames} frames {args.size[1]}x{args.size[0]}, latency {args.latency:.2f} s per read/write")
+        print(f"{'version':>10} {'wall (s)':>9} {'read (s)':>9} {'reduce (s)':>11} {'write (s)':>10}")
+
+        outputs = {}
+        for version in ('sequential', 'streaming'):
+            jobs = [(os.path.join(directory, f'frame{index:03d}.fits'),
+                     os.path.join(directory, f'{version}{index:03d}.fits')) for index in range(args.frames)]
+            read = delayed(read_file, args.latency)
+            write = delayed(write_file, args.latency)
+            if version == 'sequential':
+                wall, totals = run_sequential(jobs, read, compute, write)
+            else:
+                wall, totals = run_streaming(jobs, read, compute, write, args.prefetch)
+            print(f"{version:>10} {wall:>9.2f} {totals['load']:>9.2f} {totals['compute']:>11.2f} "
+                  f"{totals['write']:>10.2f}")
+            outputs[version] = [job[1] for job in jobs]
+
+        same = all(np.array_equal(fits.getdata(a), fits.getdata(b))
+                   for a, b in zip(outputs['sequential'], outputs['streaming']))
+        print(f"same images: {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Benchmark suite of the reduction pipeline on synthetic star fields.
+
+For each size of the matrix (1 to 100 megapixels by default), a synthetic
+field is generated (see synthetic.py), written as a uint16 FITS file and
+loaded like the interface and the batch command do. Every stage is then
+timed (best of several runs) and its peak memory measured (tracemalloc,
+which follows the numpy and OpenCV array allocations):
+- load: fits_io.load_normalized
+- detect_stars, smooth_mask, apply_erosion, compute_final_image
+- pipeline: the full chain (pipeline.reduce_image)
+
+The results are written as JSON with the machine and the commit they were
+measured on, and can be compared with a previous run to spot regressions.
+
+Usage:
+    python benchmarks/bench_suite.py -o results/bench_main.json
+    python benchmarks/bench_suite.py --sizes 1 4 16 --rgb -o bench_rgb.json
+    python benchmarks/bench_suite.py --sizes 1 4 --compare results/bench_main.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fits_io import load_normalized
+from star_detection import detect_stars, smooth_mask
+from erosion import apply_erosion
+from reduction_localisee import compute_final_image
+from pipeline import DEFAULT_PARAMS, reduce_image
+from synthetic import shape_for_megapixels, generate_field, write_field
+
+
+# Sizes of the default matrix in megapixels
+DEFAULT_SIZES = (1, 4, 16, 50, 100)
+
+# Relative slowdown reported as a regression by --compare, ignored below
+# a minimum time difference (timer noise on the fast stages)
+REGRESSION_THRESHOLD = 1.10
+REGRESSION_MIN_TIME = 0.01
+
+
+def measure(func, repeat):
+    """
+    Time a function and measure its peak memory.
+
+    Returns:
+    - best wall time in seconds, peak allocated memory in bytes, last result
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    # Separate run: tracing allocations slows the Python parts down
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def machine_info():
+    """Description of the machine and of the code the benchmark ran on"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def bench_size(megapixels, args, params, directory):
+    """Run every stage on a field of the given size, return the list of result records"""
+    shape = shape_for_megapixels(megapixels)
+    n_stars = int(args.stars_per_mp * shape[0] * shape[1] / 1e6)
+    image, _ = generate_field(shape, n_stars, fwhm=args.fwhm, noise=args.noise, nebula=args.nebulosity,
+                              rgb=args.rgb, seed=args.seed)
+    path = os.path.join(directory, f'field_{megapixels}mp.fits')
+    write_field(path, image)
+    del image
+
+    original, data_raw, _ = load_normalized(path)
+    mask, _ = detect_stars(data_raw, fwhm=params['fwhm'], threshold_sigma=params['threshold_sigma'],
+                           radius=params['radius'])
+    mask_smooth = smooth_mask(mask, params['gauss_sigma'], params['mask_threshold'])
+    eroded = apply_erosion(original, kernel_size=params['kernel_size'], iterations=params['iterations'],
+                           engine=params['erosion_engine'], shape=params['erosion_shape'])
+
+    stages = {
+        'load': lambda: load_normalized(path),
+        'detect_stars': lambda: detect_stars(data_raw, fwhm=params['fwhm'],
+                                             threshold_sigma=params['threshold_sigma'], radius=params['radius']),
+        'smooth_mask': lambda: smooth_mask(mask, params['gauss_sigma'], params['mask_threshold']),
+        'apply_erosion': lambda: apply_erosion(original, kernel_size=params['kernel_size'],
+                                               iterations=params['iterations'], engine=params['erosion_engine'],
+                                               shape=params['erosion_shape']),
+        'compute_final_image': lambda: compute_final_image(original, eroded, mask_smooth),
+        'pipeline': lambda: reduce_image(data_raw, params, original=original),
+    }
+
+    records = []
+    for stage, func in stages.items():
+        if args.stages and stage not in args.stages:
+            continue
+        # The slow stages of the large sizes are only run once
+        repeat = 1 if stage in ('detect_stars', 'pipeline') and megapixels >= 16 else args.repeat
+        elapsed, peak, result = measure(func, repeat)
+        record = {
+            'megapixels': megapixels,
+            'shape': list(original.shape),
+            'stage': stage,
+            'time_s': round(elapsed, 4),
+            'peak_mb': round(peak / 1e6, 1),
+        }
+        if stage == 'detect_stars':
+            record['stars'] = 0 if result[1] is None else len(result[1])
+        records.append(record)
+        print(f"{megapixels:>6} {stage:>20} {elapsed:>9.3f} {peak / 1e6:>10.0f}", flush=True)
+
+    os.remove(path)
+    return records
+
+
+def compare(results, config, previous_path):
+    """Print the time and memory ratios against a previous result file"""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    reference = {(r['megapixels'], r['stage']): r for r in previous['results']}
+
+    print(f"\nComparison with {previous_path} (commit {previous['machine'].get('commit')})")
+    if previous['config'] != config:
+        print("Warning: the fields or parameters differ from the previous run")
+    print(f"{'MP':>6} {'stage':>20} {'time':>8} {'memory':>8}")
+    regressions = 0
+    for record in results:
+        ref = reference.get((record['megapixels'], record['stage']))
+        if ref is None:
+            continue
+        time_ratio = record['time_s'] / max(ref['time_s'], 1e-6)
+        memory_ratio = record['peak_mb'] / max(ref['peak_mb'], 1e-6)
+        flag = ''
+        slower = time_ratio > REGRESSION_THRESHOLD and record['time_s'] - ref['time_s'] > REGRESSION_MIN_TIME
+        if slower or memory_ratio > REGRESSION_THRESHOLD:
+            flag = '  <- regression'
+            regressions += 1
+        print(f"{record['megapixels']:>6} {record['stage']:>20} {time_ratio:>7.2f}x {memory_ratio:>7.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite of the reduction pipeline")
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES,
+                        help="sizes of the fields in megapixels (default: 1 4 16 50 100)")
+    parser.add_argument('--stages', nargs='+', help="only run these stages")
+    parser.add_argument('--rgb', action='store_true', help="color fields (3, height, width)")
+    parser.add_argument('--stars-per-mp', type=float, default=1000, help="star density (default: 1000 per MP)")
+    parser.add_argument('--fwhm', type=float, default=3.0, help="FWHM of the synthetic stars (default: 3)")
+    parser.add_argument('--noise', type=float, default=20.0, help="noise of the fields in ADU (default: 20)")
+    parser.add_argument('--nebulosity', type=float, default=0.2, help="nebulosity level (default: 0.2)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage, the best time is kept (default: 3)")
+    parser.add_argument('-o', '--output', help="JSON file of the results")
+    parser.add_argument('--compare', help="previous JSON result file to compare with")
+    args = parser.parse_args()
+
+    params = dict(DEFAULT_PARAMS)
+    warnings.filterwarnings('ignore')
+
+    print(f"{'MP':>6} {'stage':>20} {'time (s)':>9} {'peak (MB)':>10}")
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in args.sizes:
+            megapixels = int(megapixels) if float(megapixels).is_integer() else megapixels
+            results.extend(bench_size(megapixels, args, params, directory))
+
+    config = {
+        'rgb': args.rgb, 'stars_per_mp': args.stars_per_mp, 'fwhm': args.fwhm, 'noise': args.noise,
+        'nebulosity': args.nebulosity, 'seed': args.seed, 'repeat': args.repeat, 'params': params,
+    }
+    report = {'machine': machine_info(), 'config': config, 'results': results}
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        return 1 if compare(results, config, args.compare) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
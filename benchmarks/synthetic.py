@@ -0,0 +1,157 @@
+"""
+Synthetic FITS star fields for benchmarks.
+
+Generates images with Gaussian stars (power-law fluxes), a smooth
+nebulosity, a sky background and Gaussian noise, in mono (2D) or RGB
+(3, height, width) layout, stored as uint16 like camera frames.
+
+Usage:
+    python benchmarks/synthetic.py field.fits --size 4000x6000 --stars 20000
+    python benchmarks/synthetic.py field_rgb.fits --megapixels 16 --rgb --nebulosity 0.5
+"""
+
+import argparse
+import math
+import os
+import sys
+
+from astropy.io import fits
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from star_detection import disc_offsets
+
+
+# Aspect ratio (width / height) of the fields built from a number of megapixels
+ASPECT_RATIO = 1.5
+
+# Color of the stars and of the nebulosity in RGB fields (relative gain per channel)
+STAR_COLORS = np.array([[1.0, 0.9, 0.8], [0.8, 0.9, 1.0], [1.0, 1.0, 1.0]])
+NEBULA_COLOR = np.array([1.0, 0.5, 0.7])
+
+
+def shape_for_megapixels(megapixels):
+    """(height, width) of a field of about megapixels million pixels"""
+    height = int(round(math.sqrt(megapixels * 1e6 / ASPECT_RATIO)))
+    return height, int(round(height * ASPECT_RATIO))
+
+
+def add_stars(image, xs, ys, fluxes, fwhm, chunk_size=65536):
+    """
+    Add Gaussian stars to an image (in place).
+
+    Parameters:
+    - image: float32 2D image
+    - xs, ys: sub-pixel positions of the stars
+    - fluxes: peak value of each star
+    - fwhm: full width at half maximum of the PSF in pixels
+    - chunk_size: number of stars drawn at once, bounds memory use
+    """
+    height, width = image.shape
+    sigma = fwhm / (2 * math.sqrt(2 * math.log(2)))
+    dy, dx = disc_offsets(3 * sigma)
+
+    for start in range(0, len(xs), chunk_size):
+        x = xs[start:start + chunk_size]
+        y = ys[start:start + chunk_size]
+        cx = np.round(x).astype(np.intp)
+        cy = np.round(y).astype(np.intp)
+
+        px = cx[:, None] + dx
+        py = cy[:, None] + dy
+        values = fluxes[start:start + chunk_size, None] * np.exp(
+            -((px - x[:, None]) ** 2 + (py - y[:, None]) ** 2) / (2 * sigma ** 2))
+
+        inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        np.add.at(image.ravel(), py[inside] * width + px[inside], values[inside].astype(np.float32))
+
+
+def nebulosity(shape, rng, scale=64):
+    """Smooth random structure between 0 and 1, built at low resolution then upsampled"""
+    low = rng.random((max(2, shape[0] // scale), max(2, shape[1] // scale)), dtype=np.float32)
+    low = ndimage.gaussian_filter(low, sigma=2)
+    low = (low - low.min()) / max(low.max() - low.min(), 1e-6)
+    zoom = (shape[0] / low.shape[0], shape[1] / low.shape[1])
+    return ndimage.zoom(low, zoom, order=1, grid_mode=True, mode='nearest')[:shape[0], :shape[1]] ** 2
+
+
+def generate_field(shape, n_stars, fwhm=3.0, noise=20.0, nebula=0.0, rgb=False, background=1000.0, seed=0):
+    """
+    Generate a synthetic star field.
+
+    Parameters:
+    - shape: (height, width) of the image
+    - n_stars: number of stars
+    - fwhm: FWHM of the stars in pixels
+    - noise: standard deviation of the Gaussian noise (ADU)
+    - nebula: peak of the nebulosity relative to the brightest stars (0 = none)
+    - rgb: color image with channels first (3, height, width)
+    - background: sky level (ADU)
+    - seed: seed of the random generator
+
+    Returns:
+    - uint16 image, positions (xs, ys) of the stars
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+
+    xs = rng.uniform(0, width, n_stars)
+    ys = rng.uniform(0, height, n_stars)
+    # Power-law fluxes: many faint stars, a few bright ones (up to saturation)
+    fluxes = np.minimum(40 * noise * rng.pareto(1.5, n_stars) + 5 * noise, 60000.0)
+
+    channels = 3 if rgb else 1
+    star_colors = STAR_COLORS[rng.integers(0, len(STAR_COLORS), n_stars)]
+    nebula_map = nebulosity(shape, rng) * (nebula * 20000.0) if nebula > 0 else None
+
+    image = np.empty((channels, height, width), dtype=np.uint16)
+    for channel in range(channels):
+        plane = rng.normal(background, noise, size=shape).astype(np.float32)
+        if nebula_map is not None:
+            plane += nebula_map * (NEBULA_COLOR[channel] if rgb else 1.0)
+        add_stars(plane, xs, ys, fluxes * (star_colors[:, channel] if rgb else 1.0), fwhm)
+        np.clip(plane, 0, 65535, out=plane)
+        image[channel] = plane
+
+    return (image if rgb else image[0]), (xs, ys)
+
+
+def write_field(path, image, overwrite=True, **keywords):
+    """Write a generated field as a FITS file (uint16 stored with BZERO, like cameras)"""
+    header = fits.Header()
+    for name, value in keywords.items():
+        header[name.upper()[:8]] = value
+    fits.writeto(path, image, header, overwrite=overwrite)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic FITS star field")
+    parser.add_argument('output', help="output FITS file")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--size', default='2000x3000', help="HEIGHTxWIDTH (default: 2000x3000)")
+    size.add_argument('--megapixels', type=float, help="size in megapixels (aspect ratio 3:2)")
+    parser.add_argument('--stars', type=int, default=None, help="number of stars (default: 1000 per megapixel)")
+    parser.add_argument('--fwhm', type=float, default=3.0, help="FWHM of the stars in pixels (default: 3)")
+    parser.add_argument('--noise', type=float, default=20.0, help="noise standard deviation in ADU (default: 20)")
+    parser.add_argument('--nebulosity', type=float, default=0.0, help="nebulosity level, 0 to 1 (default: 0)")
+    parser.add_argument('--rgb', action='store_true', help="color image (3, height, width)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.megapixels:
+        shape = shape_for_megapixels(args.megapixels)
+    else:
+        shape = tuple(int(v) for v in args.size.lower().split('x'))
+    n_stars = args.stars if args.stars is not None else int(shape[0] * shape[1] / 1000)
+
+    image, _ = generate_field(shape, n_stars, fwhm=args.fwhm, noise=args.noise, nebula=args.nebulosity,
+                              rgb=args.rgb, seed=args.seed)
+    write_field(args.output, image, nstars=n_stars, fwhm=args.fwhm, noise=args.noise,
+                nebula=args.nebulosity, seed=args.seed)
+    print(f"{args.output}: {image.shape} uint16, {n_stars} stars")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Persistent on-disk cache of the star catalogs
+
+Star detection is the slowest step of the pipeline and only depends on
+the image and on the detection parameters. Its results (the table of
+sources, optionally the raw star mask) are kept in a cache directory, one
+.npz file per image and parameter set: every column of the table is
+stored as its own array and the mask is packed to one bit per pixel. Files are named
+after a hash of the pixels and of the parameters; when the directory grows
+beyond its size limit the least recently used files are removed.
+
+Usage:
+    cache = CatalogCache()
+    catalogue = cache.for_image(data_raw)
+    cached = catalogue.load(params)
+    if cached is None:
+        sources = find_sources(data_raw, ...)
+        catalogue.store(params, None, sources)
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+from astropy.table import QTable
+import numpy as np
+
+
+# Cache directory (can be set with the STAR_REDUCTION_CACHE environment variable)
+DEFAULT_CACHE_DIR = os.environ.get('STAR_REDUCTION_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'star-reduction'))
+
+# Size limit of the cache directory (bytes)
+DEFAULT_MAX_BYTES = 1 << 30
+
+# Parameters the detection results depend on (the mask radius is not one:
+# the pipeline draws the mask from the cached sources)
+DETECTION_PARAMS = ('fwhm', 'threshold_sigma', 'background_method', 'detection_engine')
+
+# Version of the file layout, part of the keys (old files are never read)
+CACHE_VERSION = 2
+
+
+def content_hash(data):
+    """Hash (BLAKE2b) of the shape, dtype and pixels of an array"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{data.shape} {data.dtype.str}".encode())
+    digest.update(np.ascontiguousarray(data))
+    return digest.hexdigest()
+
+
+class CatalogCache:
+    """Directory of cached detection results with a size-bounded LRU eviction"""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Parameters:
+        - directory: cache directory (created on the first write)
+        - max_bytes: size limit of the directory
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, image_hash, params):
+        """Key of the detection results of an image with the given parameters"""
+        description = {
+            'version': CACHE_VERSION,
+            'image': image_hash,
+            'params': {name: params[name] for name in DETECTION_PARAMS},
+        }
+        return hashlib.blake2b(json.dumps(description, sort_keys=True).encode(), digest_size=20).hexdigest()
+
+    def path(self, key):
+        """File of a key"""
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def contains(self, key):
+        """True if the results of this key are cached"""
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+        """
+        Read cached detection results.
+
+        Returns:
+        - (mask, sources) as returned by detect_stars (mask is None when it
+          was not stored), or None if the key is not cached (or its file is
+          unreadable, in which case it is removed)
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as archive:
+                mask = None
+                if 'mask_bits' in archive:
+                    shape = tuple(archive['mask_shape'])
+                    mask = np.unpackbits(archive['mask_bits'], count=int(np.prod(shape))).reshape(shape)
+                    mask *= 255
+                columns = [str(name) for name in archive['columns']]
+                sources = QTable({name: archive[f'column_{name}'] for name in columns}) if columns else None
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            self._remove(path)
+            return None
+
+        # Most recently used files are evicted last
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return mask, sources
+
+    def store(self, key, mask, sources):
+        """
+        Write detection results, then evict the oldest files if the directory is too large.
+
+        Parameters:
+        - key: key of the results (see key)
+        - mask: raw star mask (0 or 255), or None to only store the sources
+        - sources: table of detected stars, or None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        columns = [] if sources is None else list(sources.colnames)
+        arrays = {f'column_{name}': np.asarray(sources[name]) for name in columns}
+        if mask is not None:
+            arrays.update(mask_shape=np.array(mask.shape), mask_bits=np.packbits(mask != 0))
+
+        # Written under a temporary name so readers never see a partial file
+        handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, columns=np.array(columns, dtype=str), **arrays)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            self._remove(temporary)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the directory fits in max_bytes"""
+        entries = []
+        try:
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if entry.name.endswith('.npz'):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            return
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def for_image(self, data):
+        """Cache entries of one image (its hash is computed on first use)"""
+        return ImageCatalog(self, data)
+
+    @staticmethod
+    def _remove(path):
+        """Remove a file, ignoring files already removed (e.g. by another process)"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ImageCatalog:
+    """Cached detection results of one image, for any detection parameters"""
+
+    def __init__(self, cache, data):
+        """
+        Parameters:
+        - cache: CatalogCache
+        - data: image given to detect_stars
+        """
+        self.cache = cache
+        self.data = data
+        self.image_hash = None
+
+    def key(self, params):
+        """Cache key of the image with these parameters"""
+        if self.image_hash is None:
+            self.image_hash = content_hash(self.data)
+        return self.cache.key(self.image_hash, params)
+
+    def contains(self, params):
+        """True if the results of these parameters are cached"""
+        return self.cache.contains(self.key(params))
+
+    def load(self, params):
+        """Cached (mask, sources) for these parameters, or None"""
+        return self.cache.load(self.key(params))
+
+    def store(self, params, mask, sources):
+        """Cache the detection results of these parameters"""
+        self.cache.store(self.key(params), mask, sources)
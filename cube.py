@@ -0,0 +1,125 @@
+"""
+Plane by plane star reduction of multi-extension FITS files and data cubes
+
+Every image plane of every HDU (2D images, planes of cubes such as time
+series or spectral planes, color images) is read, reduced and written on
+its own into a multi-extension output file with the same structure, so
+memory use stays bounded by a few planes whatever the size of the cube.
+Planes can be reduced by worker processes: each worker reads its plane
+from the input file and writes the result directly into the output file,
+only the numbers of stars go back to the main process.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+
+from pipeline import DEFAULT_PARAMS, reduce_image, to_fits_layout
+from fits_io import open_memmap, has_image, image_planes, iter_planes, read_plane, create_outputs, write_plane
+from profiling import section
+
+
+def output_layouts(path, color=True):
+    """
+    Structure of the output file of a FITS file.
+
+    Image HDUs keep their shape (float32 results), an empty primary HDU
+    stays empty and the other HDUs (tables) are not copied.
+
+    Returns:
+    - list of (shape, header) for create_outputs
+    - dictionary input HDU index -> output HDU index
+    - list of (input HDU index, plane index tuple) of all the planes
+    """
+    layouts = []
+    mapping = {}
+    planes = []
+    with open_memmap(path) as hdul:
+        for index, hdu in enumerate(hdul):
+            if has_image(hdu):
+                mapping[index] = len(layouts)
+                layouts.append((hdu.shape, hdu.header.copy()))
+                planes.extend((index, plane) for plane in image_planes(hdu.shape, color))
+            elif index == 0:
+                layouts.append((None, hdu.header.copy()))
+
+    if not planes:
+        raise ValueError(f"{path}: no image data in any HDU")
+    return layouts, mapping, planes
+
+
+def reduce_plane(data_norm, data_raw, params):
+    """
+    Reduce the stars of one plane.
+
+    Returns:
+    - final image in the axis order of data_raw (float32), number of detected stars
+    """
+    results = reduce_image(data_raw, params, original=data_norm)
+    final = to_fits_layout(results['finale'], data_raw).astype(np.float32)
+    return final, 0 if results['sources'] is None else len(results['sources'])
+
+
+def _reduce_plane_file(input_path, output_path, hdu_index, plane, output_spec, params):
+    """Read, reduce and write one plane (runs in a worker process), return the number of stars"""
+    with open_memmap(input_path) as hdul:
+        data_norm, data_raw = read_plane(hdul[hdu_index], plane)
+    final, nb_stars = reduce_plane(data_norm, data_raw, params)
+
+    write_plane(output_path, *output_spec, plane, final)
+    return nb_stars
+
+
+def process_planes(input_path, output_path, params=None, workers=1, color=True, overwrite=False, progress=None):
+    """
+    Reduce the stars of every image plane of a FITS file into a multi-extension FITS file.
+
+    Parameters:
+    - input_path: FITS file (images in the primary HDU and/or extensions,
+      2D images, cubes, color images with channels first)
+    - output_path: FITS file written with one float32 HDU per input image HDU
+    - params: processing parameters (missing ones use DEFAULT_PARAMS)
+    - workers: number of planes reduced at the same time by worker processes
+      (1: in this process)
+    - color: read 3-plane HDUs as one color image (else as a cube of 3 planes)
+    - overwrite: replace an existing output file
+    - progress: optional callable progress(done, total) called after each plane
+
+    Returns:
+    - total number of detected stars
+    """
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    layouts, mapping, planes = output_layouts(input_path, color)
+
+    for shape, header in layouts:
+        if shape is not None:
+            header['HISTORY'] = 'Star reduction plane by plane (detect_stars, smooth_mask, apply_erosion)'
+
+    # Planes are written with plain file writes (see write_plane), the maps are not used
+    outputs = create_outputs(output_path, layouts, overwrite=overwrite)
+    specs = [None if output is None else (output.offset, output.shape) for output in outputs]
+    del outputs
+    nb_stars = 0
+
+    if workers == 1:
+        for done, (index, plane, data_norm, data_raw, _) in enumerate(iter_planes(input_path, color), start=1):
+            with section('plane', tags={'hdu': index, 'plane': list(plane)}):
+                final, plane_stars = reduce_plane(data_norm, data_raw, params)
+                write_plane(output_path, *specs[mapping[index]], plane, final)
+            nb_stars += plane_stars
+            if progress is not None:
+                progress(done, len(planes))
+        return nb_stars
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [
+            executor.submit(_reduce_plane_file, input_path, output_path, index, plane, specs[mapping[index]], params)
+            for index, plane in planes
+        ]
+        for done, future in enumerate(futures, start=1):
+            nb_stars += future.result()
+            if progress is not None:
+                progress(done, len(planes))
+
+    return nb_stars
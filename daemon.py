@@ -0,0 +1,522 @@
+"""
+Local reduction daemon: job queue with priorities, warm worker pool and progress streaming
+
+Every process running the reduction pays the import of astropy, photutils
+and OpenCV (about 2.5 s) before reading its first file. The daemon imports
+them once and keeps a pool of worker processes ready; scripts and the GUI
+submit jobs to it over an HTTP API and follow their progress as a stream
+of JSON lines. Every job uses the same catalog cache, so a field already
+detected is not detected again.
+
+Jobs read and write files with the rights of the daemon, so the API is
+served on a Unix domain socket created with mode 0600: only the user
+running the daemon can connect (web pages and other users cannot).
+
+API (JSON bodies with Content-Type application/json, JSON answers):
+    POST   /jobs               submit a job: {"input", "output", "params", "priority",
+                               "overwrite", "compression", "tile_shape", "quantize_level"}
+    GET    /jobs               every job known to the daemon
+    GET    /jobs/<id>          state of one job
+    GET    /jobs/<id>/events   progress of a job, one JSON object per line until it ends
+    DELETE /jobs/<id>          cancel a queued job
+    GET    /status             workers and number of jobs in each state
+
+Usage:
+    python star_reduction.py serve -j 4
+    python daemon_client.py submit "night/*.fits" -o results/daemon --priority 5
+    curl --unix-socket "$XDG_RUNTIME_DIR/star-reduction.sock" http://localhost/status
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+import numpy as np
+
+from pipeline import DEFAULT_PARAMS, reduce_image
+from fits_export import check_compression, DEFAULT_QUANTIZE_LEVEL
+from daemon_client import DEFAULT_SOCKET, JOB_STATES, FINISHED_STATES
+
+# Finished jobs kept for the clients (the oldest ones are forgotten)
+MAX_FINISHED_JOBS = 1000
+
+# Start method of the worker pool: the pool is rebuilt while the dispatcher and
+# HTTP threads run, and forking a multithreaded process can deadlock the children
+WORKER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Progress queue of the worker processes (set by _init_worker)
+_events = None
+
+
+def _init_worker(events):
+    """
+    Prepare a worker process of the pool: keep the progress queue and warm it up.
+
+    Reducing a small image once loads the modules imported on first use
+    (photutils detection, OpenCV) before the first job arrives.
+    """
+    global _events
+    _events = events
+    rng = np.random.default_rng(0)
+    image = rng.normal(0.1, 0.01, (64, 64)).astype(np.float32)
+    image[30:33, 30:33] += 0.5
+    reduce_image(image, {'fwhm': 2.0, 'threshold_sigma': 5.0})
+
+
+def _ping():
+    """Empty task, waits for a worker process to be ready"""
+    return os.getpid()
+
+
+def _reduce_job(job_id, data, params, catalog_cache):
+    """Reduce a job in a worker process, sending the pipeline stages to the daemon"""
+    # Imported here: star_reduction imports this module for its serve command
+    from star_reduction import reduce_file
+
+    def progress(stage, index, total):
+        _events.put((job_id, stage, index, total))
+
+    return reduce_file(data, params, catalog_cache=catalog_cache, progress=progress)
+
+
+class JobQueue:
+    """Jobs waiting for a worker (highest priority first, then in submission order) and their events"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.closed = False
+
+    def submit(self, job, priority=0):
+        """
+        Add a job to the queue.
+
+        Parameters:
+        - job: dictionary describing the job (input, output, params...)
+        - priority: jobs with a higher priority are started first
+
+        Returns:
+        - identifier of the job
+        """
+        with self.condition:
+            job_id = next(self.ids)
+            self.jobs[job_id] = {**job, 'id': job_id, 'priority': priority, 'state': 'queued',
+                                 'submitted': time.time(), 'events': []}
+            self._record(job_id, {'state': 'queued'})
+            heapq.heappush(self.heap, (-priority, job_id))
+            self.condition.notify_all()
+            return job_id
+
+    def next(self):
+        """
+        Wait for the next job to run and mark it as loading.
+
+        Returns:
+        - job dictionary, or None once the queue is closed (the queued jobs are not started)
+        """
+        with self.condition:
+            while not self.closed:
+                while self.heap:
+                    _, job_id = heapq.heappop(self.heap)
+                    job = self.jobs.get(job_id)
+                    # Cancelled jobs stay in the heap until they are popped
+                    if job is not None and job['state'] == 'queued':
+                        self._record(job_id, {'state': 'loading', 'started': time.time()})
+                        return job
+                self.condition.wait()
+            return None
+
+    def update(self, job_id, **fields):
+        """Change the state or progress of a job and wake up the clients following it"""
+        with self.condition:
+            if job_id in self.jobs:
+                self._record(job_id, fields)
+                self.condition.notify_all()
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued job.
+
+        Returns:
+        - True if the job was cancelled, False if it already left the queue
+
+        Raises KeyError for an unknown job.
+        """
+        with self.condition:
+            if self.jobs[job_id]['state'] != 'queued':
+                return False
+            self._record(job_id, {'state': 'cancelled'})
+            self.condition.notify_all()
+            return True
+
+    def events(self, job_id, start=0, timeout=None):
+        """
+        Wait for the events of a job after the first start ones.
+
+        Returns:
+        - list of the new events (empty after timeout), True when the job is finished
+
+        Raises KeyError for an unknown job.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: (job_id not in self.jobs or len(self.jobs[job_id]['events']) > start
+                                             or self.closed), timeout)
+            job = self.jobs[job_id]
+            return list(job['events'][start:]), job['state'] in FINISHED_STATES
+
+    def job(self, job_id):
+        """Public description of a job, without its events (raises KeyError for an unknown job)"""
+        with self.condition:
+            return {name: value for name, value in self.jobs[job_id].items() if name != 'events'}
+
+    def all_jobs(self):
+        """Public descriptions of every job, in submission order"""
+        with self.condition:
+            return [self.job(job_id) for job_id in sorted(self.jobs)]
+
+    def close(self):
+        """Wake up every waiting worker and client, no job is started anymore"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _record(self, job_id, fields):
+        """Apply fields to a job and append them to its events (condition held)"""
+        job = self.jobs[job_id]
+        job.update(fields)
+        job['events'].append({**fields, 'time': time.time()})
+        if fields.get('state') in FINISHED_STATES:
+            job['finished'] = time.time()
+            self._forget_finished()
+
+    def _forget_finished(self):
+        """Keep the MAX_FINISHED_JOBS most recent finished jobs (condition held)"""
+        finished = [job_id for job_id, job in self.jobs.items() if job['state'] in FINISHED_STATES]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+
+class ReductionDaemon:
+    """Queue of reduction jobs run by a pool of warm worker processes"""
+
+    def __init__(self, workers=None, catalog_cache=None):
+        """
+        Parameters:
+        - workers: number of jobs reduced at the same time (default: number of CPUs)
+        - catalog_cache: optional catalog_cache.CatalogCache shared by every job
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.catalog_cache = catalog_cache
+        self.queue = JobQueue()
+        self.started = time.time()
+        self.context = multiprocessing.get_context(WORKER_START_METHOD)
+        if WORKER_START_METHOD == 'forkserver':
+            # Workers are forked from a server that already imported the reduction modules
+            self.context.set_forkserver_preload(['star_reduction'])
+        self.events = self.context.Queue()
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        """Start the worker processes (warmed up before returning), the dispatchers and the progress reader"""
+        self.executor = self._new_executor()
+
+        # One dispatcher per worker: each one loads, reduces and writes one job at a time
+        self.threads = [threading.Thread(target=self._dispatch, daemon=True) for _ in range(self.workers)]
+        self.threads.append(threading.Thread(target=self._read_progress, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Stop taking jobs, wait for the running ones and stop the workers"""
+        self.queue.close()
+        for thread in self.threads[:-1]:
+            thread.join()
+        self.events.put(None)
+        self.threads[-1].join()
+        self.executor.shutdown()
+
+    def _new_executor(self):
+        """Pool of worker processes, started and warmed up"""
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.context, initializer=_init_worker,
+                                       initargs=(self.events,))
+        for future in [executor.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def submit(self, request):
+        """
+        Check a job request and queue it.
+
+        Parameters:
+        - request: dictionary with input and output (paths, absolute or
+          relative to the directory of the daemon), and optionally params
+          (processing parameters, missing ones use DEFAULT_PARAMS), priority,
+          overwrite, compression, tile_shape and quantize_level (see
+          star_reduction.write_file)
+
+        Returns:
+        - public description of the queued job
+
+        Raises ValueError for an invalid request, FileNotFoundError for a
+        missing input and FileExistsError for an existing output.
+        """
+        unknown = set(request) - {'input', 'output', 'params', 'priority', 'overwrite', 'compression', 'tile_shape',
+                                  'quantize_level'}
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        if 'input' not in request or 'output' not in request:
+            raise ValueError("input and output are required")
+
+        params = request.get('params') or {}
+        unknown = set(params) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+
+        job = {
+            'input': os.path.abspath(request['input']),
+            'output': os.path.abspath(request['output']),
+            'params': {**DEFAULT_PARAMS, **params},
+            'overwrite': bool(request.get('overwrite', False)),
+            'compression': request.get('compression'),
+            'tile_shape': request.get('tile_shape'),
+            'quantize_level': (DEFAULT_QUANTIZE_LEVEL if request.get('quantize_level') is None
+                               else request['quantize_level']),
+        }
+        check_compression(job['compression'], job['quantize_level'])
+        if not os.path.isfile(job['input']):
+            raise FileNotFoundError(f"{job['input']} not found")
+        if os.path.exists(job['output']) and not job['overwrite']:
+            raise FileExistsError(f"{job['output']} already exists")
+
+        job_id = self.queue.submit(job, priority=int(request.get('priority', 0)))
+        return self.queue.job(job_id)
+
+    def status(self):
+        """Workers, uptime and number of jobs in each state"""
+        counts = dict.fromkeys(JOB_STATES, 0)
+        for job in self.queue.all_jobs():
+            counts[job['state']] += 1
+        return {'workers': self.workers, 'pid': os.getpid(), 'uptime': time.time() - self.started, 'jobs': counts}
+
+    def _dispatch(self):
+        """Run the jobs of the queue one after the other (dispatcher thread)"""
+        # Imported here: star_reduction imports this module for its serve command
+        from star_reduction import read_file, write_file
+
+        while True:
+            job = self.queue.next()
+            if job is None:
+                return
+            job_id = job['id']
+            paths = (job['input'], job['output'])
+            try:
+                data = read_file(paths)
+                self.queue.update(job_id, state='running')
+                with self.executor_lock:
+                    executor = self.executor
+                result = executor.submit(_reduce_job, job_id, data, job['params'], self.catalog_cache).result()
+                del data
+
+                self.queue.update(job_id, state='writing', stage=None)
+                os.makedirs(os.path.dirname(job['output']), exist_ok=True)
+                nb_stars, elapsed, _ = write_file(paths, result, overwrite=job['overwrite'],
+                                                  compression=job['compression'], tile_shape=job['tile_shape'],
+                                                  quantize_level=job['quantize_level'])
+                self.queue.update(job_id, state='done', nb_stars=nb_stars, elapsed=elapsed)
+                print(f"done  {job['input']} -> {job['output']} ({nb_stars} stars, {elapsed:.1f} s)", flush=True)
+            except BrokenProcessPool as error:
+                # A worker died (e.g. out of memory): the job fails, the pool is replaced
+                self.queue.update(job_id, state='failed', error=f"worker process stopped: {error}")
+                print(f"error {job['input']}: worker process stopped, restarting the pool", flush=True)
+                with self.executor_lock:
+                    if self.executor is executor and not self.queue.closed:
+                        self.executor = self._new_executor()
+            except Exception as error:
+                self.queue.update(job_id, state='failed', error=str(error))
+                print(f"error {job['input']}: {error}", flush=True)
+
+    def _read_progress(self):
+        """Turn the pipeline stages reported by the workers into job events (progress thread)"""
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            job_id, stage, index, total = event
+            self.queue.update(job_id, stage=stage, index=index, total=total)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """HTTP API of the daemon (see the module docstring)"""
+
+    server_version = 'star-reduction'
+
+    def log_message(self, format, *args):
+        """Requests are not logged (clients poll and stream often), the jobs are"""
+
+    def address_string(self):
+        """Clients of a Unix domain socket have no address"""
+        return 'local'
+
+    def send_json(self, status, body):
+        """Send a JSON answer"""
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def route(self):
+        """Path split into its parts, and the job identifier when there is one (None if invalid)"""
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        job_id = None
+        if len(parts) >= 2 and parts[0] == 'jobs':
+            job_id = int(parts[1]) if parts[1].isdigit() else None
+        return parts, job_id
+
+    def do_GET(self):
+        """Status, jobs, one job, or the event stream of a job"""
+        daemon = self.server.reduction_daemon
+        parts, job_id = self.route()
+        try:
+            if parts == ['status']:
+                self.send_json(200, daemon.status())
+            elif parts == ['jobs']:
+                self.send_json(200, daemon.queue.all_jobs())
+            elif len(parts) == 2 and job_id is not None:
+                self.send_json(200, daemon.queue.job(job_id))
+            elif len(parts) == 3 and job_id is not None and parts[2] == 'events':
+                self.stream_events(job_id)
+            else:
+                self.send_json(404, {'error': f"unknown path {self.path}"})
+        except KeyError:
+            self.send_json(404, {'error': f"unknown job {job_id}"})
+
+    def do_POST(self):
+        """Submit a job"""
+        if self.route()[0] != ['jobs']:
+            self.send_json(404, {'error': f"unknown path {self.path}"})
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self.send_json(415, {'error': "the request must be sent as application/json"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a JSON object")
+            self.send_json(201, self.server.reduction_daemon.submit(request))
+        except FileExistsError as error:
+            self.send_json(409, {'error': str(error)})
+        except (ValueError, TypeError, FileNotFoundError) as error:
+            self.send_json(400, {'error': str(error)})
+
+    def do_DELETE(self):
+        """Cancel a queued job"""
+        parts, job_id = self.route()
+        if len(parts) != 2 or job_id is None:
+            self.send_json(404, {'error': f"unknown path {self.path}"})
+            return
+        try:
+            if self.server.reduction_daemon.queue.cancel(job_id):
+                self.send_json(200, self.server.reduction_daemon.queue.job(job_id))
+            else:
+                self.send_json(409, {'error': f"job {job_id} is not queued anymore"})
+        except KeyError:
+            self.send_json(404, {'error': f"unknown job {job_id}"})
+
+    def stream_events(self, job_id):
+        """Send the events of a job as JSON lines as they happen, until the job is finished"""
+        queue = self.server.reduction_daemon.queue
+        events, finished = queue.events(job_id, 0, timeout=0)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+
+        sent = 0
+        try:
+            while True:
+                for event in events:
+                    self.wfile.write(json.dumps(event).encode() + b'\n')
+                self.wfile.flush()
+                sent += len(events)
+                if finished or queue.closed:
+                    return
+                events, finished = queue.events(job_id, sent, timeout=30)
+        except (BrokenPipeError, ConnectionResetError, KeyError):
+            # Client gone, or job forgotten
+            return
+
+
+def listen(socket_path):
+    """
+    Create the server of the API on a Unix domain socket only its user can open.
+
+    A socket left by a daemon that stopped without removing it is replaced;
+    raises OSError if another daemon listens on it or if the path is not a socket.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OSError("the daemon needs Unix domain sockets, not available on this system")
+    os.makedirs(os.path.dirname(socket_path) or '.', mode=0o700, exist_ok=True)
+
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise FileExistsError(f"{socket_path} exists and is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+            else:
+                raise OSError(f"a daemon is already listening on {socket_path}")
+
+    # The socket is created with mode 0600 (connecting needs write permission)
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, _RequestHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    return server
+
+
+def serve(socket_path=DEFAULT_SOCKET, workers=None, catalog_cache=None):
+    """
+    Run the daemon until interrupted (Ctrl+C).
+
+    Parameters:
+    - socket_path: Unix domain socket of the HTTP API (removed on exit)
+    - workers: number of worker processes (default: number of CPUs)
+    - catalog_cache: optional catalog_cache.CatalogCache shared by every job
+    """
+    # Listening first: a second daemon fails before starting its workers
+    server = listen(socket_path)
+    daemon = ReductionDaemon(workers=workers, catalog_cache=catalog_cache)
+    server.reduction_daemon = daemon
+    start = time.perf_counter()
+    try:
+        daemon.start()
+        print(f"Listening on {socket_path} with {daemon.workers} warm worker(s) "
+              f"(ready in {time.perf_counter() - start:.1f} s)", flush=True)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        if daemon.threads:
+            daemon.stop()
@@ -0,0 +1,320 @@
+"""
+Client of the local reduction daemon (see daemon.py)
+
+Only uses the standard library: submitting a job does not load astropy,
+photutils or OpenCV, so scripts and the GUI can hand files to the daemon
+without paying their import. The daemon listens on a Unix domain socket
+only its user can open (see daemon.py).
+
+Usage:
+    python daemon_client.py submit "night/*.fits" -o results/daemon --priority 5 -p fwhm=3.0
+    python daemon_client.py jobs
+    python daemon_client.py jobs --cancel 12
+
+    client = DaemonClient()
+    job = client.submit('night/light_001.fits', 'results/light_001_finale.fits', {'fwhm': 3.0})
+    for event in client.events(job['id']):
+        print(event)
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+import time
+
+from fits_files import find_fits_files, output_jobs
+
+
+# Socket of the daemon (can be set with the STAR_REDUCTION_DAEMON environment variable)
+DEFAULT_SOCKET = os.environ.get('STAR_REDUCTION_DAEMON', os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.cache'), 'star-reduction.sock'))
+
+# States of a job, and those it does not leave
+JOB_STATES = ('queued', 'loading', 'running', 'writing', 'done', 'failed', 'cancelled')
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+# Width of the progress line rewritten in place by the submit command
+PROGRESS_WIDTH = 79
+
+
+class DaemonError(Exception):
+    """Error answered by the daemon, or daemon unreachable"""
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        """Open the socket of the daemon"""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class DaemonClient:
+    """Client of the HTTP API of the daemon"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=10.0):
+        """
+        Parameters:
+        - socket_path: Unix domain socket of the daemon
+        - timeout: timeout of the requests in seconds (not of the event streams)
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, method, path, body=None, timeout=None):
+        """Send a request and return the open answer (raises DaemonError)"""
+        if not hasattr(socket, 'AF_UNIX'):
+            raise DaemonError("the daemon needs Unix domain sockets, not available on this system")
+        data = None if body is None else json.dumps(body).encode()
+        connection = _UnixHTTPConnection(self.socket_path, timeout=timeout)
+        try:
+            connection.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+            answer = connection.getresponse()
+        except (FileNotFoundError, ConnectionRefusedError):
+            connection.close()
+            raise DaemonError(f"no daemon listening on {self.socket_path} "
+                              f"(start it with: python star_reduction.py serve)") from None
+        except (OSError, http.client.HTTPException) as error:
+            connection.close()
+            raise DaemonError(f"cannot reach the daemon on {self.socket_path}: {error}") from None
+
+        if answer.status >= 400:
+            try:
+                message = json.loads(answer.read())['error']
+            except (OSError, http.client.HTTPException, ValueError, KeyError):
+                message = f"{answer.status} {answer.reason}"
+            finally:
+                answer.close()
+            raise DaemonError(message)
+        return answer
+
+    def call(self, method, path, body=None):
+        """Send a request and return its decoded JSON answer"""
+        with self.request(method, path, body, timeout=self.timeout) as answer:
+            try:
+                return json.loads(answer.read())
+            except (OSError, http.client.HTTPException, ValueError) as error:
+                raise DaemonError(f"connection to the daemon lost: {error}") from None
+
+    def submit(self, input, output, params=None, priority=0, overwrite=False, compression=None, tile_shape=None,
+               quantize_level=None):
+        """
+        Queue a job (paths are made absolute: the daemon runs in another directory).
+
+        Parameters:
+        - input, output: paths of the FITS file and of its result
+        - params: processing parameters (missing ones use the defaults of the daemon)
+        - priority: jobs with a higher priority are started first
+        - overwrite, compression, tile_shape, quantize_level: see
+          star_reduction.write_file (quantize_level None: default of the daemon)
+
+        Returns:
+        - description of the queued job (its identifier is job['id'])
+        """
+        return self.call('POST', '/jobs', {
+            'input': os.path.abspath(input),
+            'output': os.path.abspath(output),
+            'params': params or {},
+            'priority': priority,
+            'overwrite': overwrite,
+            'compression': compression,
+            'tile_shape': tile_shape,
+            'quantize_level': quantize_level,
+        })
+
+    def job(self, job_id):
+        """Description of a job"""
+        return self.call('GET', f'/jobs/{job_id}')
+
+    def jobs(self):
+        """Descriptions of every job known to the daemon"""
+        return self.call('GET', '/jobs')
+
+    def cancel(self, job_id):
+        """Cancel a queued job (raises DaemonError if it already started)"""
+        return self.call('DELETE', f'/jobs/{job_id}')
+
+    def status(self):
+        """Workers and number of jobs in each state"""
+        return self.call('GET', '/status')
+
+    def events(self, job_id):
+        """
+        Follow the progress of a job.
+
+        Yields:
+        - events of the job as dictionaries (state changes, and stage,
+          index, total while it is reduced), until it is finished
+
+        Raises DaemonError if the daemon stops before the end of the job.
+        """
+        finished = False
+        with self.request('GET', f'/jobs/{job_id}/events') as answer:
+            # The daemon stopping mid-stream cuts the connection, leaves a partial line or ends the stream
+            try:
+                for line in answer:
+                    if line.strip():
+                        event = json.loads(line)
+                        finished = finished or event.get('state') in FINISHED_STATES
+                        yield event
+            except (OSError, http.client.HTTPException, ValueError) as error:
+                raise DaemonError(f"connection to the daemon lost: {error}") from None
+        if not finished:
+            raise DaemonError(f"the daemon stopped before the end of job {job_id}")
+
+    def wait(self, job_id):
+        """Wait for the end of a job and return its description"""
+        for _ in self.events(job_id):
+            pass
+        return self.job(job_id)
+
+
+def parse_params(args):
+    """Processing parameters of the config file, then of the -p NAME=VALUE options (checked by the daemon)"""
+    params = {}
+    if args.config:
+        with open(args.config) as f:
+            params.update(json.load(f))
+    for assignment in args.param:
+        name, separator, value = assignment.partition('=')
+        if not separator:
+            raise ValueError(f"Invalid parameter {assignment} (expected NAME=VALUE)")
+        # Numbers and booleans as JSON, anything else as text
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+def run_submit(client, args):
+    """Queue files on the daemon and follow their progress"""
+    try:
+        params = parse_params(args)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    files = find_fits_files(args.inputs)
+    if not files:
+        print("No FITS file found", file=sys.stderr)
+        return 1
+    try:
+        jobs = output_jobs(files, args.output, args.suffix)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    rejected = 0
+    submitted = []
+    for path, destination in jobs:
+        try:
+            job = client.submit(path, destination, params, priority=args.priority, overwrite=args.overwrite,
+                                compression=args.compression, tile_shape=args.tile_shape,
+                                quantize_level=args.quantize)
+        except DaemonError as e:
+            rejected += 1
+            print(f"error {path}: {e}", file=sys.stderr)
+            continue
+        print(f"queued {path} -> {destination} (job {job['id']}, priority {job['priority']})")
+        submitted.append(job)
+
+    if args.no_wait or not submitted:
+        return 1 if rejected else 0
+
+    # Jobs run in parallel in the daemon, their progress is shown one after the other
+    failures = 0
+    start = time.perf_counter()
+    for job in submitted:
+        try:
+            for event in client.events(job['id']):
+                if event.get('stage'):
+                    line = f"{job['input']}: {event['stage']} ({event['index'] + 1}/{event['total']})"
+                    print(f"\r{line:<{PROGRESS_WIDTH}}", end='', flush=True)
+            job = client.job(job['id'])
+        except DaemonError as e:
+            failures += 1
+            print(file=sys.stderr)
+            print(f"error {job['input']}: {e}", file=sys.stderr)
+            continue
+
+        if job['state'] == 'done':
+            line = f"done  {job['input']} -> {job['output']} ({job['nb_stars']} stars, {job['elapsed']:.1f} s)"
+            print(f"\r{line:<{PROGRESS_WIDTH}}")
+        else:
+            failures += 1
+            print(f"\r{' ' * PROGRESS_WIDTH}\r", end='')
+            print(f"{job['state']} {job['input']}: {job.get('error', '')}", file=sys.stderr)
+
+    print(f"{len(submitted) - failures}/{len(submitted)} job(s) done in {time.perf_counter() - start:.1f} s")
+    return 1 if rejected or failures else 0
+
+
+def run_jobs(client, args):
+    """Show the state of the daemon and of its jobs, or cancel a queued job"""
+    if args.cancel is not None:
+        job = client.cancel(args.cancel)
+        print(f"job {job['id']} cancelled ({job['input']})")
+        return 0
+
+    status = client.status()
+    counts = ', '.join(f"{count} {state}" for state, count in status['jobs'].items() if count)
+    print(f"daemon {status['pid']}: {status['workers']} worker(s), up {status['uptime'] / 60:.0f} min, "
+          f"{counts or 'no job'}")
+    for job in client.jobs():
+        detail = job.get('error') or job.get('stage') or ''
+        print(f"{job['id']:>5} {job['state']:<9} {job['priority']:>4}  {job['input']}  {detail}")
+    return 0
+
+
+def build_parser():
+    """Command-line parser"""
+    parser = argparse.ArgumentParser(prog='star-reduction-client', description="Client of the star reduction daemon")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f"socket of the daemon (default: {DEFAULT_SOCKET})")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    submit = subparsers.add_parser('submit', help="queue files on the daemon and follow their progress")
+    submit.add_argument('inputs', nargs='+', help="FITS files, directories or glob patterns")
+    submit.add_argument('-o', '--output', default='results/daemon', help="output directory (default: results/daemon)")
+    submit.add_argument('--priority', type=int, default=0,
+                        help="jobs with a higher priority are started first (default: 0)")
+    submit.add_argument('--no-wait', action='store_true', help="return once the jobs are queued")
+    submit.add_argument('-c', '--config', help="JSON file with processing parameters")
+    submit.add_argument('-p', '--param', action='append', default=[], metavar='NAME=VALUE',
+                        help="processing parameter, e.g. -p fwhm=3.0 -p erosion_engine=float (overrides the config "
+                             "file; see pipeline.DEFAULT_PARAMS)")
+    submit.add_argument('--suffix', default='_finale', help="suffix of the result files (default: _finale)")
+    submit.add_argument('--overwrite', action='store_true', help="overwrite existing results")
+    submit.add_argument('--compression', help="write the results as tile-compressed FITS: RICE_1, GZIP_1 or GZIP_2")
+    submit.add_argument('--tile-shape', type=int, nargs=2, metavar=('ROWS', 'COLUMNS'),
+                        help="size of the compression tiles (default: one row per tile)")
+    submit.add_argument('--quantize', type=float, help="quantization of the compressed values (default: 16)")
+    submit.set_defaults(func=run_submit)
+
+    jobs = subparsers.add_parser('jobs', help="show the jobs of the daemon")
+    jobs.add_argument('--cancel', type=int, metavar='ID', help="cancel a queued job")
+    jobs.set_defaults(func=run_jobs)
+
+    return parser
+
+
+def main(argv=None):
+    """Entry point of the command-line client"""
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(DaemonClient(args.socket), args)
+    except DaemonError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
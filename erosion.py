@@ -3,8 +3,36 @@ import matplotlib.pyplot as plt
 import cv2 as cv
 import numpy as np
 
+from profiling import profiled
 
-def apply_erosion(data, kernel_size=3, iterations=2):
+
+# Window length from which the van Herk/Gil-Werman minimum is faster than
+# OpenCV's vectorized line erosion (measured on float32 frames)
+VHGW_MIN_SIZE = 256
+
+
+def structuring_element(kernel_size=3, shape='square'):
+    """
+    Create the structuring element of the erosion.
+
+    Parameters:
+    - kernel_size: size of the kernel (width and height)
+    - shape: 'square' or 'circle' (disc of diameter kernel_size)
+
+    Returns:
+    - uint8 array of shape (kernel_size, kernel_size), 1 inside the element
+    """
+    if shape == 'square':
+        return np.ones((kernel_size, kernel_size), np.uint8)
+    if shape == 'circle':
+        center = (kernel_size - 1) / 2
+        dy, dx = np.mgrid[:kernel_size, :kernel_size] - center
+        return (np.sqrt(dx**2 + dy**2) <= kernel_size / 2).astype(np.uint8)
+    raise ValueError(f"Unknown kernel shape: {shape}")
+
+
+@profiled
+def apply_erosion(data, kernel_size=3, iterations=2, engine='opencv', shape='square'):
     """
     Apply morphological erosion on the image.
 
@@ -12,15 +40,23 @@ def apply_erosion(data, kernel_size=3, iterations=2):
     - data: numpy array (normalized image between 0 and 1)
     - kernel_size: size of the erosion kernel (default: 3)
     - iterations: number of erosion iterations (default: 2)
+    - engine: 'opencv' (uint8 erosion with OpenCV) or 'float' (float32
+      erosion without quantization, see erode_float)
+    - shape: shape of the kernel, 'square' or 'circle' (default: 'square')
 
     Returns:
     - eroded image normalized between 0 and 1
     """
+    if engine == 'float':
+        return erode_float(data, kernel_size=kernel_size, iterations=iterations, shape=shape)
+    if engine != 'opencv':
+        raise ValueError(f"Unknown erosion engine: {engine}")
+
     # Convert to uint8 for OpenCV
     data_uint8 = (data * 255).astype(np.uint8)
 
     # Create the kernel
-    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    kernel = structuring_element(kernel_size, shape)
 
     # Apply erosion
     eroded = cv.erode(data_uint8, kernel, iterations=iterations)
@@ -31,6 +67,111 @@ def apply_erosion(data, kernel_size=3, iterations=2):
     return eroded_norm
 
 
+def min_filter_1d(data, size, axis, offset=None):
+    """
+    Running minimum along one axis with the van Herk/Gil-Werman algorithm.
+
+    The cost per pixel (3 comparisons) does not depend on the window size.
+    Pixels outside the image are ignored, as are NaN values.
+
+    Parameters:
+    - data: numpy array
+    - size: length of the window
+    - axis: axis along which the minimum is computed
+    - offset: position of the window start relative to each pixel
+      (default: -(size // 2), window centered like OpenCV's anchor)
+
+    Returns:
+    - array of the same shape and dtype, out[i] = min(data[i + offset : i + offset + size])
+    """
+    if offset is None:
+        offset = -(size // 2)
+    if size == 1 and offset == 0:
+        return data.copy()
+
+    data = np.moveaxis(data, axis, -1)
+    n = data.shape[-1]
+
+    # Pad with +inf so that every window is complete and the length is a multiple of size
+    before = max(-offset, 0)
+    after = max(offset + size - 1, 0)
+    length = -(-(before + n + after) // size) * size
+    padded = np.full(data.shape[:-1] + (length,), np.inf, dtype=data.dtype)
+    padded[..., before:before + n] = data
+
+    # Prefix minimum (g) and suffix minimum (h) inside each block of size pixels
+    blocks = padded.reshape(data.shape[:-1] + (length // size, size))
+    g = np.fmin.accumulate(blocks, axis=-1).reshape(padded.shape)
+    h = np.fmin.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(padded.shape)
+    del padded, blocks
+
+    # A window starting at i covers the end of block(i) and the start of block(i + size - 1)
+    start = before + offset
+    out = np.fmin(h[..., start:start + n], g[..., start + size - 1:start + size - 1 + n])
+
+    return np.moveaxis(out, -1, axis)
+
+
+def line_minimum(data, size, axis, offset=None):
+    """
+    Running minimum of a float32 image along one axis (1D erosion).
+
+    Short windows use OpenCV's vectorized erosion with a line kernel,
+    long windows the van Herk/Gil-Werman algorithm (min_filter_1d) whose
+    cost does not depend on the window length. Both give identical results.
+
+    Parameters:
+    - data: float32 array (2D, or 3D with channels last)
+    - size: length of the window
+    - axis: 0 (vertical) or 1 (horizontal)
+    - offset: position of the window start relative to each pixel (default: centered)
+
+    Returns:
+    - eroded array (float32)
+    """
+    if offset is None:
+        offset = -(size // 2)
+
+    # OpenCV needs the anchor inside the kernel
+    if size < VHGW_MIN_SIZE and -size < offset <= 0:
+        shape = (1, size) if axis == 1 else (size, 1)
+        anchor = (-offset, 0) if axis == 1 else (0, -offset)
+        return cv.erode(data, np.ones(shape, np.uint8), anchor=anchor)
+
+    return min_filter_1d(data, size, axis, offset=offset)
+
+
+@profiled
+def erode_float(data, kernel_size=3, iterations=2, shape='square'):
+    """
+    Float32 morphological erosion, equivalent to the OpenCV erosion without uint8 quantization.
+
+    For square kernels, N iterations with a k x k kernel are folded into a
+    single pass with a (N*(k-1)+1) square kernel, which is separable: a
+    horizontal then a vertical line minimum (see line_minimum).
+    Circular kernels are not separable and their folded element grows with
+    N*k in both directions, which measured slower than iterating; they use
+    OpenCV's float32 erosion with the disc kernel.
+
+    Parameters:
+    - data: numpy array (2D, or 3D with channels last)
+    - kernel_size: size of the erosion kernel (default: 3)
+    - iterations: number of erosion iterations (default: 2)
+    - shape: 'square' or 'circle' (default: 'square')
+
+    Returns:
+    - eroded image (float32)
+    """
+    data = np.ascontiguousarray(data, dtype=np.float32)
+
+    if shape == 'square':
+        size = iterations * (kernel_size - 1) + 1
+        eroded = line_minimum(data, size, axis=1)
+        return line_minimum(eroded, size, axis=0)
+
+    return cv.erode(data, structuring_element(kernel_size, shape), iterations=iterations)
+
+
 def normalize_image(data):
     """
     Normalize an image between 0 and 1.
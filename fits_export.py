@@ -0,0 +1,163 @@
+"""
+Export of the reduction results as (tile-compressed) FITS files
+
+The final image is written with the header of the original file (WCS and
+observation keywords included), optionally followed by the star mask and
+the eroded image as extensions. With tile compression (RICE or GZIP), the
+images go in compressed extensions after an empty primary HDU; each HDU
+is compressed in its own thread (the compression codecs release the GIL)
+and the compressed HDUs are then written one after the other. The file is
+written under a temporary name in the same directory and renamed once
+complete, so an error never leaves a truncated file behind.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import tempfile
+import time
+
+from astropy.io import fits
+import numpy as np
+
+
+# Tile compression algorithms offered by export_fits (None: uncompressed)
+COMPRESSION_TYPES = ('RICE_1', 'GZIP_1', 'GZIP_2')
+
+# Default quantization of floating-point images: noise level / 16 (astropy default)
+DEFAULT_QUANTIZE_LEVEL = 16.0
+
+# Header keywords describing the layout of the original file, set again for each written HDU
+STRUCTURE_KEYWORDS = ('SIMPLE', 'XTENSION', 'BITPIX', 'EXTEND', 'PCOUNT', 'GCOUNT', 'EXTNAME', 'BZERO', 'BSCALE',
+                      'BLANK', 'CHECKSUM', 'DATASUM')
+
+# Names of the HDUs of the exported stages
+EXTENSION_NAMES = {'finale': 'FINALE', 'masque': 'MASQUE', 'erodee': 'ERODEE'}
+
+# Permissions of the exported files, as open() would create them (mkstemp creates them private)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+def export_header(header):
+    """
+    Copy of a header without the keywords describing the original data layout.
+
+    Parameters:
+    - header: header of the original HDU, or None
+
+    Returns:
+    - header keeping the WCS, observation and history keywords
+    """
+    header = fits.Header() if header is None else header.copy()
+    for keyword in STRUCTURE_KEYWORDS:
+        header.remove(keyword, ignore_missing=True, remove_all=True)
+    for keyword in [card.keyword for card in header.cards if card.keyword.startswith('NAXIS')]:
+        header.remove(keyword, ignore_missing=True, remove_all=True)
+    return header
+
+
+def check_compression(compression, quantize_level=DEFAULT_QUANTIZE_LEVEL):
+    """
+    Check compression options before writing (raises ValueError).
+
+    RICE quantizes floating-point images: without quantization (0) it would
+    silently store them as integers.
+    """
+    if compression is not None and compression not in COMPRESSION_TYPES:
+        raise ValueError(f"Unknown compression: {compression} (expected one of {', '.join(COMPRESSION_TYPES)})")
+    if compression is not None and quantize_level == 0 and not compression.startswith('GZIP'):
+        raise ValueError(f"{compression} cannot store floating-point images losslessly, use GZIP_1 or GZIP_2")
+
+
+def _compressed_hdu_bytes(data, header, name, compression, tile_shape, quantize_level):
+    """
+    Compress one image into the bytes of a FITS extension (runs in a thread).
+
+    Returns:
+    - bytes of the CompImageHDU (header and heap), ready to be appended to a file
+    """
+    # Tiles of (rows, columns) pixels in the last two axes, one plane deep
+    if tile_shape is not None:
+        tile_shape = (1,) * (data.ndim - 2) + tuple(min(size, axis) for size, axis in zip(tile_shape, data.shape[-2:]))
+    hdu = fits.CompImageHDU(data, header=header, name=name, compression_type=compression, tile_shape=tile_shape,
+                            quantize_level=quantize_level, quantize_method=fits.hdu.compressed.SUBTRACTIVE_DITHER_1)
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(buffer)
+
+    # The extension starts after the empty primary HDU
+    content = buffer.getvalue()
+    with fits.open(io.BytesIO(content)) as hdul:
+        start = hdul.fileinfo(1)['hdrLoc']
+    return content[start:]
+
+
+def export_fits(path, images, header=None, compression='RICE_1', tile_shape=None,
+                quantize_level=DEFAULT_QUANTIZE_LEVEL, workers=None, overwrite=False):
+    """
+    Write reduction results into one FITS file.
+
+    Parameters:
+    - path: output file
+    - images: dictionary stage name -> image in the axis order of the file
+      (see to_fits_layout), the first one being the final image; known
+      stages get the names of EXTENSION_NAMES ('finale' -> FINALE)
+    - header: header of the original image (WCS and keywords are kept on every image HDU)
+    - compression: one of COMPRESSION_TYPES, or None for an uncompressed file
+    - tile_shape: (rows, columns) of the compression tiles, in the last two
+      axes of every image (default: one row per tile)
+    - quantize_level: quantization of the floating-point images (noise
+      sigma / quantize_level, with subtractive dithering); 0 stores them
+      losslessly, only with the GZIP algorithms
+    - workers: threads compressing the HDUs (default: one per image)
+    - overwrite: replace an existing file
+
+    Returns:
+    - dictionary with 'seconds' (write time), 'bytes' (size of the file)
+      and 'data_bytes' (size of the images in memory)
+    """
+    check_compression(compression, quantize_level)
+    if not overwrite and os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+
+    start = time.perf_counter()
+    header = export_header(header)
+    hdus = [(EXTENSION_NAMES.get(stage, stage.upper()), np.asarray(image)) for stage, image in images.items()]
+
+    handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            if compression is None:
+                primary_name, primary_data = hdus[0]
+                hdul = fits.HDUList([fits.PrimaryHDU(primary_data, header=header)])
+                hdul[0].header['EXTNAME'] = primary_name
+                if len(hdus) > 1:
+                    hdul[0].header.set('EXTEND', True, after='NAXIS' + str(primary_data.ndim))
+                hdul.extend(fits.ImageHDU(data, header=header, name=name) for name, data in hdus[1:])
+                hdul.writeto(f)
+            else:
+                # Keywords of the original file are on the image HDUs, the primary HDU stays empty
+                with ThreadPoolExecutor(max_workers=workers or len(hdus)) as executor:
+                    extensions = [executor.submit(_compressed_hdu_bytes, data, header, name, compression,
+                                                  tile_shape, quantize_level)
+                                  for name, data in hdus]
+                    primary = fits.PrimaryHDU()
+                    primary.header['EXTEND'] = True
+                    f.write(primary.header.tostring().encode('ascii'))
+                    for extension in extensions:
+                        f.write(extension.result())
+        os.chmod(temporary, FILE_MODE)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return {
+        'seconds': time.perf_counter() - start,
+        'bytes': os.path.getsize(path),
+        'data_bytes': sum(data.nbytes for _, data in hdus),
+    }
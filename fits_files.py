@@ -0,0 +1,68 @@
+"""
+Input and output files of the command-line tools
+
+Expands the inputs given on the command line into FITS files and names
+their results. Only uses the standard library, so the daemon client can
+use it without loading astropy.
+"""
+
+import glob
+import os
+
+
+# Extensions recognized as FITS files when a directory is given
+FITS_EXTENSIONS = ('.fits', '.fit', '.fts')
+
+
+def find_fits_files(inputs):
+    """
+    Expand the inputs given on the command line into a sorted list of FITS files.
+
+    Parameters:
+    - inputs: list of files, directories or glob patterns
+
+    Returns:
+    - list of file paths (without duplicates)
+    """
+    files = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            files.extend(
+                os.path.join(entry, name) for name in sorted(os.listdir(entry))
+                if name.lower().endswith(FITS_EXTENSIONS)
+            )
+        elif os.path.isfile(entry):
+            files.append(entry)
+        else:
+            files.extend(sorted(glob.glob(entry)))
+
+    # Keep the first occurrence of each file
+    return list(dict.fromkeys(files))
+
+
+def output_path(path, output_dir, suffix):
+    """Path of the result file written for an input file"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_dir, f"{name}{suffix}.fits")
+
+
+def output_jobs(files, output_dir, suffix):
+    """
+    Pair every input file with its result file.
+
+    Raises ValueError when two inputs would write the same result (same
+    name in different directories), before any file is processed.
+
+    Returns:
+    - list of (input path, output path)
+    """
+    jobs = []
+    inputs = {}
+    for path in files:
+        destination = output_path(path, output_dir, suffix)
+        if destination in inputs:
+            raise ValueError(f"{inputs[destination]} and {path} would both be written to {destination} "
+                             f"(rename one of them or process them separately)")
+        inputs[destination] = path
+        jobs.append((path, destination))
+    return jobs
@@ -0,0 +1,324 @@
+"""
+FITS input/output helpers for large images
+
+Reads parts of memory-mapped images without loading the whole HDU and
+writes results incrementally into a preallocated output file.
+"""
+
+from astropy.io import fits
+import numpy as np
+
+
+# Header keywords describing the storage of the input data, not valid for the float32 output
+SCALING_KEYWORDS = ('BZERO', 'BSCALE', 'BLANK')
+
+# FITS files are made of blocks of 2880 bytes
+FITS_BLOCK_SIZE = 2880
+
+
+def open_memmap(path):
+    """
+    Open a FITS file with memory mapping and without scaling the data on access.
+
+    Scaling (BZERO/BSCALE/BLANK) is applied by read_section on the parts
+    that are actually read, which keeps the file memory-mapped.
+
+    Returns:
+    - opened HDU list (to be closed by the caller)
+    """
+    return fits.open(path, memmap=True, do_not_scale_image_data=True)
+
+
+def read_section(hdu, key):
+    """
+    Read part of an image HDU opened with open_memmap, with the same scaling
+    astropy applies to hdu.data.
+
+    Parameters:
+    - hdu: image HDU
+    - key: tuple of slices
+
+    Returns:
+    - numpy array with the scaled values
+    """
+    raw = np.asarray(hdu.section[key])
+
+    header = hdu.header
+    bitpix = header['BITPIX']
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    blank = header.get('BLANK') if bitpix > 0 else None
+
+    if bscale == 1 and bzero == 0 and blank is None:
+        return raw
+
+    # Pseudo-unsigned integers (e.g. uint16 stored as int16 with BZERO=32768)
+    if bscale == 1 and blank is None and bitpix in (16, 32, 64) and bzero == 1 << (bitpix - 1):
+        return (raw.astype(np.int64) + bzero).astype(f'uint{bitpix}')
+
+    if bitpix > 16:
+        data = raw.astype(np.float64)
+    elif bitpix > 0:
+        data = raw.astype(np.float32)
+    else:
+        data = raw.copy()
+
+    if bscale != 1:
+        np.multiply(data, bscale, data)
+    if bzero != 0:
+        data += bzero
+    if blank is not None:
+        data[raw == blank] = np.nan
+
+    return data
+
+
+def is_color(shape):
+    """True for the 3D shapes read as one color image: (3, height, width) or (height, width, 3)"""
+    return len(shape) == 3 and (shape[0] == 3 or shape[2] == 3)
+
+
+def image_planes(shape, color=True):
+    """
+    Planes of an image HDU processed one at a time.
+
+    Parameters:
+    - shape: numpy shape of the HDU data
+    - color: read (3, height, width) HDUs as one color image (else as a
+      cube of 3 planes); (height, width, 3) HDUs are always one color image,
+      their axis 0 holds rows, not planes
+
+    Returns:
+    - list of index tuples selecting each 2D plane (or the whole color
+      image, empty tuple) in the data
+    """
+    if len(shape) < 2:
+        return []
+    if len(shape) == 2 or (is_color(shape) and (color or shape[0] != 3)):
+        return [()]
+    return list(np.ndindex(*shape[:-2]))
+
+
+def normalize_raw(raw, header, dtype=np.float32):
+    """
+    Normalize raw FITS data between 0 and 1, into a single buffer.
+
+    Integer data stays in its native type until it is written, already
+    normalized, into one array of the requested dtype. BZERO/BSCALE are not
+    applied: normalization removes any affine scaling (a negative BSCALE
+    flips the range), and BLANK pixels become NaN.
+
+    Parameters:
+    - raw: unscaled data (e.g. from an HDU opened with open_memmap)
+    - header: header of the HDU
+    - dtype: dtype of the normalized image (default: float32)
+
+    Returns:
+    - normalized image, channels last for color images (as prepare_image)
+    - the same buffer in the axis order of raw (view, no copy)
+    """
+    # Color images with channels first are stored channels last
+    channels_first = raw.ndim == 3 and raw.shape[0] == 3
+    if channels_first:
+        raw = np.transpose(raw, (1, 2, 0))
+
+    blank = header.get('BLANK') if header['BITPIX'] > 0 else None
+    valid = None
+    if blank is not None:
+        valid = raw != blank
+        values = raw[valid]
+    else:
+        values = raw
+
+    if values.size == 0:
+        raw_min = raw_max = 0
+    elif np.issubdtype(raw.dtype, np.floating):
+        raw_min, raw_max = np.nanmin(values), np.nanmax(values)
+    else:
+        raw_min, raw_max = values.min(), values.max()
+    del values
+
+    normalized = np.empty(raw.shape, dtype=dtype)
+    if raw_max > raw_min:
+        if header.get('BSCALE', 1) < 0:
+            np.subtract(raw_max, raw, out=normalized, dtype=dtype)
+        else:
+            np.subtract(raw, raw_min, out=normalized, dtype=dtype)
+        normalized /= float(raw_max) - float(raw_min)
+    else:
+        normalized[...] = raw
+
+    if valid is not None:
+        normalized[~valid] = np.nan
+
+    if channels_first:
+        return normalized, np.transpose(normalized, (2, 0, 1))
+    return normalized, normalized
+
+
+def load_normalized(path, dtype=np.float32):
+    """
+    Load the first image of a FITS file normalized between 0 and 1, in a single buffer.
+
+    The image is the primary HDU, or the first extension with image data
+    when the primary HDU is empty; of a data cube, only the first plane is
+    read. The file is memory-mapped (see normalize_raw).
+
+    Parameters:
+    - path: path of the FITS file
+    - dtype: dtype of the normalized image (default: float32)
+
+    Returns:
+    - normalized image, channels last for color images (as prepare_image)
+    - the same buffer in the axis order of the file (view, no copy)
+    - header of the HDU
+    """
+    with open_memmap(path) as hdul:
+        hdu = next((hdu for hdu in hdul if has_image(hdu)), hdul[0])
+        header = hdu.header.copy()
+        raw = hdu.data
+        if raw is None or raw.ndim not in (2, 3):
+            raise ValueError(f"{path}: no 2D or 3D image in the primary HDU or its extensions")
+        if not is_color(raw.shape):
+            raw = raw[image_planes(raw.shape)[0]]
+
+        normalized, file_order = normalize_raw(raw, header, dtype)
+        del raw
+
+    return normalized, file_order, header
+
+
+def iter_planes(path, color=True, dtype=np.float32):
+    """
+    Read every image plane of every HDU of a FITS file, one at a time.
+
+    The file is memory-mapped and each plane is read only when it is
+    requested, so a cube is never loaded as a whole. HDUs without image
+    data (empty primary HDU, tables) are skipped.
+
+    Parameters:
+    - path: path of the FITS file
+    - color: read 3-plane HDUs as one color image (see image_planes)
+    - dtype: dtype of the normalized planes
+
+    Yields:
+    - (hdu index, plane index tuple, normalized plane, same plane in the
+      axis order of the file, header of the HDU); see normalize_raw
+    """
+    with open_memmap(path) as hdul:
+        for index, hdu in enumerate(hdul):
+            if not has_image(hdu):
+                continue
+            for plane in image_planes(hdu.shape, color):
+                normalized, file_order = read_plane(hdu, plane, dtype)
+                yield index, plane, normalized, file_order, hdu.header
+
+
+def has_image(hdu):
+    """True for the HDUs with image data of at least 2 dimensions"""
+    return hdu.is_image and hdu.header.get('NAXIS', 0) >= 2
+
+
+def read_plane(hdu, plane, dtype=np.float32):
+    """
+    Read and normalize one plane of an image HDU opened with open_memmap.
+
+    Parameters:
+    - hdu: image HDU
+    - plane: index tuple of the plane (see image_planes)
+    - dtype: dtype of the normalized plane
+
+    Returns:
+    - normalized plane and the same plane in the axis order of the file (see normalize_raw)
+    """
+    raw = hdu.section[plane + (slice(None),) * (len(hdu.shape) - len(plane))]
+    return normalize_raw(np.asarray(raw), hdu.header, dtype)
+
+
+def create_output(path, shape, header=None, overwrite=False):
+    """
+    Create a float32 FITS file of the given shape and map its data for writing.
+
+    The file is allocated without writing the data, so arbitrarily large
+    results can be written part by part.
+
+    Parameters:
+    - path: output path
+    - shape: shape of the image (numpy order)
+    - header: header to copy (structure and scaling keywords are replaced)
+    - overwrite: replace an existing file
+
+    Returns:
+    - writable numpy memmap of the output data (flush it when done)
+    """
+    return create_outputs(path, [(shape, header)], overwrite=overwrite)[0]
+
+
+def create_outputs(path, layouts, overwrite=False):
+    """
+    Create a multi-extension float32 FITS file and map the data of every HDU for writing.
+
+    Parameters:
+    - path: output path
+    - layouts: list of (shape, header) per HDU, the first one is the
+      primary HDU; a shape of None gives an HDU without data
+    - overwrite: replace an existing file
+
+    Returns:
+    - list of writable numpy memmaps (None for the HDUs without data)
+    """
+    blocks = []
+    for index, (shape, header) in enumerate(layouts):
+        header = fits.Header() if header is None else header.copy()
+        for keyword in SCALING_KEYWORDS:
+            header.remove(keyword, ignore_missing=True)
+
+        # Let astropy build a valid header for a tiny array, then set the real size
+        kind = fits.PrimaryHDU if index == 0 else fits.ImageHDU
+        if shape is None:
+            hdu = kind(header=header)
+            data_bytes = 0
+        else:
+            hdu = kind(data=np.zeros((1,) * len(shape), dtype=np.float32), header=header)
+            for axis, size in enumerate(reversed(shape), start=1):
+                hdu.header[f'NAXIS{axis}'] = size
+            data_bytes = int(np.prod(shape)) * 4
+        if index == 0 and len(layouts) > 1:
+            hdu.header['EXTEND'] = True
+
+        header_bytes = hdu.header.tostring().encode('ascii')
+        padded_bytes = -(-data_bytes // FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE
+        blocks.append((shape, header_bytes, padded_bytes))
+
+    mode = 'wb' if overwrite else 'xb'
+    offsets = []
+    with open(path, mode) as f:
+        for shape, header_bytes, padded_bytes in blocks:
+            f.write(header_bytes)
+            offsets.append(f.tell())
+            f.seek(padded_bytes, 1)
+        f.truncate()
+
+    return [None if shape is None else np.memmap(path, dtype='>f4', mode='r+', offset=offset, shape=tuple(shape))
+            for (shape, _, _), offset in zip(blocks, offsets)]
+
+
+def write_plane(path, offset, shape, plane, data):
+    """
+    Write one plane of a float32 HDU created with create_outputs, with a plain file write.
+
+    Unlike writing into the memmap, the written pages do not stay mapped
+    in the process, so writing a large cube keeps memory use bounded.
+
+    Parameters:
+    - path: output file
+    - offset, shape: offset of the data of the HDU in the file and its shape
+      (offset and shape of the memmap returned by create_outputs)
+    - plane: index tuple of the plane (see image_planes)
+    - data: values of the plane
+    """
+    plane_size = int(np.prod(shape[len(plane):]))
+    index = int(np.ravel_multi_index(plane, shape[:len(plane)])) if plane else 0
+    with open(path, 'r+b') as f:
+        f.seek(offset + index * plane_size * 4)
+        np.ascontiguousarray(data, dtype='>f4').tofile(f)
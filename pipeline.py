@@ -0,0 +1,294 @@
+"""
+Star reduction pipeline with a stage-level result cache
+
+Each stage of the reduction only depends on a few parameters and on the
+stages before it. The cache keeps the result of every stage together with
+the key it was computed with, so that changing one parameter only
+recomputes the stages that actually depend on it.
+"""
+
+import numpy as np
+
+from star_detection import (find_sources, star_mask, background_statistics, to_grayscale, centroid_columns,
+                            blur_mask, blur_mask_from_sources, threshold_mask)
+from erosion import apply_erosion, prepare_image
+from reduction_localisee import compute_final_image, reduce_stars_localized
+from profiling import section
+
+
+# Default parameters (same values as the default positions of the GUI sliders)
+DEFAULT_PARAMS = {
+    'fwhm': 1.2,
+    'threshold_sigma': 2.5,
+    'radius': 3.6,
+    'detection_workers': 1,
+    'detection_engine': 'daofind',
+    'background_method': 'full',
+    'kernel_size': 3,
+    'iterations': 1,
+    'erosion_engine': 'opencv',
+    'erosion_shape': 'square',
+    'localized': False,
+    'gauss_sigma': 1.8,
+    'blur_engine': 'filter',
+    'mask_threshold': 0.54,
+}
+
+# Smallest FWHM of the preview detection (stars are at least one pixel wide at every resolution)
+MIN_PREVIEW_FWHM = 1.0
+
+
+def _stage_background(inputs, results, params):
+    """STEP 0: Background statistics of the detection image (reused when detection parameters change)"""
+    # Catalog given with the image, or detection results read from the catalog
+    # cache: the background is only computed by the detection stage if it misses later
+    catalogue = inputs.get('catalogue')
+    if inputs.get('sources') is not None or (catalogue is not None and catalogue.contains(params)):
+        return {'fond': None}
+
+    return {'fond': background_statistics(to_grayscale(inputs['original_raw']), method=params['background_method'])}
+
+
+def _stage_detection(inputs, results, params):
+    """STEP 1a: Detect stars (catalog of sources, independent of the mask radius)"""
+    # Catalog known in advance (e.g. registered from the reference frame of a sequence), empty without stars
+    if inputs.get('sources') is not None:
+        return {'sources': inputs['sources'] if len(inputs['sources']) else None}
+
+    catalogue = inputs.get('catalogue')
+    if catalogue is not None:
+        cached = catalogue.load(params)
+        if cached is not None:
+            return {'sources': cached[1]}
+
+    output = {}
+    if results.get('fond') is None:
+        output['fond'] = background_statistics(to_grayscale(inputs['original_raw']), method=params['background_method'])
+
+    sources = find_sources(
+        inputs['original_raw'],
+        fwhm=params['fwhm'],
+        threshold_sigma=params['threshold_sigma'],
+        background=output.get('fond', results.get('fond')),
+        workers=params['detection_workers'],
+        engine=params['detection_engine']
+    )
+    if catalogue is not None:
+        catalogue.store(params, None, sources)
+
+    output['sources'] = sources
+    return output
+
+
+def _stage_mask(inputs, results, params):
+    """STEP 1b: Draw a disc around each detected star (create binary mask)"""
+    # Same size as the detection image (channels are last in the normalized image)
+    return {'masque_brut': star_mask(inputs['original'].shape[:2], results['sources'], params['radius'])}
+
+
+def _stage_blur(inputs, results, params):
+    """STEP 2a: Apply gaussian blur to the binary mask"""
+    # Stamps engine: blurred discs added at the star positions, no full-frame filter
+    sources = results['sources']
+    if params['blur_engine'] == 'stamps' and sources is not None:
+        x_column, y_column = centroid_columns(sources)
+        return {'masque_flou': blur_mask_from_sources(sources[x_column], sources[y_column],
+                                                      results['masque_brut'].shape, params['radius'],
+                                                      sigma=params['gauss_sigma'])}
+
+    return {'masque_flou': blur_mask(results['masque_brut'], sigma=params['gauss_sigma'])}
+
+
+def _stage_threshold(inputs, results, params):
+    """STEP 2b: Threshold the blurred mask"""
+    return {'masque_lisse': threshold_mask(results['masque_flou'], threshold=params['mask_threshold'])}
+
+
+def _stage_erosion(inputs, results, params):
+    """STEP 3: Apply morphological erosion to reduce stars"""
+    # Localized mode: the star regions are eroded by the final stage
+    if params['localized']:
+        return {'erodee': None}
+
+    return {'erodee': apply_erosion(
+        inputs['original'],
+        kernel_size=params['kernel_size'],
+        iterations=params['iterations'],
+        engine=params['erosion_engine'],
+        shape=params['erosion_shape']
+    )}
+
+
+def _stage_final(inputs, results, params):
+    """STEP 4: Blend original and eroded images using the smooth mask"""
+    if params['localized']:
+        return {'finale': reduce_stars_localized(
+            inputs['original'],
+            results['masque_lisse'],
+            kernel_size=params['kernel_size'],
+            iterations=params['iterations'],
+            engine=params['erosion_engine'],
+            shape=params['erosion_shape']
+        )}
+
+    return {'finale': compute_final_image(inputs['original'], results['erodee'], results['masque_lisse'])}
+
+
+# Stages in execution order: name -> (function, parameters used, stages it depends on)
+STAGES = {
+    'fond': (_stage_background, ('background_method',), ()),
+    'detection': (_stage_detection, ('fwhm', 'threshold_sigma', 'detection_workers', 'detection_engine'),
+                  ('fond',)),
+    'masque': (_stage_mask, ('radius',), ('detection',)),
+    'flou': (_stage_blur, ('gauss_sigma', 'blur_engine'), ('masque',)),
+    'seuil': (_stage_threshold, ('mask_threshold',), ('flou',)),
+    'erosion': (_stage_erosion, ('kernel_size', 'iterations', 'erosion_engine', 'erosion_shape', 'localized'), ()),
+    'finale': (_stage_final, (), ('erosion', 'seuil')),
+}
+
+
+class PipelineCancelled(Exception):
+    """Raised when a pipeline run is cancelled between two stages"""
+
+
+class StageCache:
+    """Dependency-aware cache of the results of every pipeline stage"""
+
+    def __init__(self, catalog_cache=None):
+        """
+        Parameters:
+        - catalog_cache: optional catalog_cache.CatalogCache; detection
+          results are then read from it and written to it
+        """
+        self.catalog_cache = catalog_cache
+        self.reset()
+
+    def reset(self, original=None, original_raw=None, sources=None):
+        """
+        Forget all cached results and set new input images.
+
+        Parameters:
+        - original: normalized image (0-1), used for erosion and blending
+        - original_raw: raw image, used for star detection
+        - sources: optional catalog of the stars of the image (an empty
+          table for an image without stars); the star detection is then skipped
+        """
+        self.inputs = {'original': original, 'original_raw': original_raw, 'sources': sources}
+        if self.catalog_cache is not None and original_raw is not None:
+            self.inputs['catalogue'] = self.catalog_cache.for_image(original_raw)
+        self.results = {}
+        self.keys = {}
+
+    def stage_key(self, stage, params):
+        """
+        Key of a stage: the parameters it uses and the keys of the stages it depends on.
+        """
+        _, used, deps = STAGES[stage]
+        return (
+            tuple(params[name] for name in used),
+            tuple(self.stage_key(dep, params) for dep in deps)
+        )
+
+    def run(self, params, progress=None, cancelled=None):
+        """
+        Run the pipeline, recomputing only the stages whose key changed.
+
+        Parameters:
+        - params: dictionary of processing parameters (see DEFAULT_PARAMS)
+        - progress: optional callable progress(stage, index, total) called
+          before each stage
+        - cancelled: optional callable returning True when the run must stop;
+          checked between stages, raises PipelineCancelled
+
+        Returns:
+        - dictionary of all stage results (fond, masque_brut, sources,
+          masque_flou, masque_lisse, erodee, finale); erodee is None in localized mode
+        """
+        if self.inputs['original'] is None:
+            raise ValueError("No image loaded")
+
+        params = {**DEFAULT_PARAMS, **params}
+
+        for index, (stage, (func, _, _)) in enumerate(STAGES.items()):
+            if cancelled is not None and cancelled():
+                raise PipelineCancelled(stage)
+            if progress is not None:
+                progress(stage, index, len(STAGES))
+
+            key = self.stage_key(stage, params)
+            if self.keys.get(stage) != key:
+                with section(stage) as record:
+                    output = func(self.inputs, self.results, params)
+                    record['output'] = output
+                self.results.update(output)
+                self.keys[stage] = key
+
+        return self.results
+
+
+def preview_params(params, factor):
+    """
+    Parameters of a preview run on an image downsampled by factor.
+
+    The lengths in pixels (FWHM, mask radius, blur sigma, half-width of the
+    erosion kernel) are divided by factor so that the preview shows the
+    same structures as the full resolution run. The detection uses the
+    vectorized peak finder; the threshold is unchanged, so the faintest
+    stars may be missed (downsampling dilutes them).
+
+    Parameters:
+    - params: dictionary of processing parameters of the full resolution run
+    - factor: downsampling factor of the preview image (1 = full resolution)
+
+    Returns:
+    - dictionary of processing parameters for the preview image
+    """
+    params = {**DEFAULT_PARAMS, **params, 'detection_workers': 1, 'detection_engine': 'peaks'}
+    if factor == 1:
+        return params
+
+    # The erosion kernel keeps at least 3x3 pixels, so that it still has an effect
+    half_width = max(1, round((params['kernel_size'] // 2) / factor))
+    return {
+        **params,
+        'fwhm': max(params['fwhm'] / factor, MIN_PREVIEW_FWHM),
+        'radius': params['radius'] / factor,
+        'gauss_sigma': params['gauss_sigma'] / factor,
+        'kernel_size': 2 * half_width + 1,
+    }
+
+
+def reduce_image(data_raw, params=None, original=None, catalog_cache=None, sources=None, progress=None):
+    """
+    Run the complete star reduction on a raw image.
+
+    Parameters:
+    - data_raw: raw image (2D, or 3D color image)
+    - params: dictionary of processing parameters (missing ones use DEFAULT_PARAMS)
+    - original: normalized image if already available (e.g. from
+      fits_io.load_normalized), otherwise computed with prepare_image
+    - catalog_cache: optional CatalogCache of the detection results
+    - sources: optional catalog of the stars (see StageCache.reset)
+    - progress: optional callable progress(stage, index, total) (see StageCache.run)
+
+    Returns:
+    - dictionary of all stage results (see StageCache.run)
+    """
+    if original is None:
+        original = prepare_image(data_raw)
+
+    cache = StageCache(catalog_cache=catalog_cache)
+    cache.reset(original=original, original_raw=data_raw, sources=sources)
+    return cache.run(params or {}, progress=progress)
+
+
+def to_fits_layout(image, data_raw):
+    """
+    Put an image computed by the pipeline back in the axis order of the raw FITS data.
+
+    prepare_image moves the channels of (3, height, width) images last; this
+    undoes it so the output can be written with the original header.
+    """
+    if image.ndim == 3 and data_raw.ndim == 3 and data_raw.shape[0] == 3:
+        return np.transpose(image, (2, 0, 1))
+    return image
@@ -0,0 +1,247 @@
+"""
+Lightweight profiling of the reduction steps
+
+Library functions are decorated with @profiled and pipeline stages are
+wrapped in section(). While a Profiler is active, each call records its
+wall time, CPU time, peak memory allocated during the call (tracemalloc)
+and the shapes of the arrays it received and returned. When no profiler
+is active, the decorated functions only test one global variable.
+Calls made by other threads than the one that started the profiler are
+not recorded.
+
+Usage:
+    with Profiler() as profiler:
+        reduce_image(data_raw, params)
+    print(profiler.format_summary())
+    profiler.to_chrome_trace('reduction.trace.json')
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+
+# Profiler receiving the records (None when profiling is disabled)
+_active = None
+
+
+def _describe(value):
+    """Shape, dtype and size of the arrays contained in a value (arrays, tuples, dicts)"""
+    if isinstance(value, np.ndarray):
+        return [{'shape': list(value.shape), 'dtype': str(value.dtype), 'mb': round(value.nbytes / 1e6, 3)}]
+    if isinstance(value, (tuple, list)):
+        return [array for item in value for array in _describe(item)]
+    if isinstance(value, dict):
+        return [array for item in value.values() for array in _describe(item)]
+    return []
+
+
+class Profiler:
+    """Collects the timing and memory records of the instrumented calls made by one thread"""
+
+    def __init__(self, memory=True):
+        """
+        Parameters:
+        - memory: measure the peak allocated memory with tracemalloc (slows
+          down the pure Python parts, not the numpy/OpenCV ones)
+        """
+        self.memory = memory
+        self.records = []
+        self.stack = []
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.started_tracemalloc = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Make this profiler the active one, for the calls of the current thread"""
+        global _active
+        self.thread = threading.get_ident()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        _active = self
+
+    def stop(self):
+        """Stop recording"""
+        global _active
+        if _active is self:
+            _active = None
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def record(self, name, inputs=(), tags=None):
+        """
+        Record one call (context manager).
+
+        Parameters:
+        - name: name of the step
+        - inputs: values whose arrays are described in the record
+        - tags: optional dictionary stored in the record (e.g. file name)
+
+        Yields:
+        - the record dictionary; set record['output'] = value to describe
+          the result arrays
+        """
+        entry = {
+            'name': name,
+            'thread': threading.get_ident(),
+            'pid': os.getpid(),
+            'depth': len(self.stack),
+            'inputs': _describe(inputs),
+        }
+        if tags:
+            entry['tags'] = dict(tags)
+
+        # Peak memory of nested calls: the peak is reset for each call and
+        # the peak seen so far is handed back to the enclosing call
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack and self.stack[-1] is not None:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame = {'base': current, 'peak': current}
+        else:
+            frame = None
+        self.stack.append(frame)
+
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield entry
+        finally:
+            entry['wall_s'] = time.perf_counter() - start_wall
+            entry['cpu_s'] = time.process_time() - start_cpu
+            entry['start_s'] = start_wall - self.origin
+            self.stack.pop()
+
+            if frame is not None:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                entry['peak_mb'] = round((peak - frame['base']) / 1e6, 3)
+                if self.stack and self.stack[-1] is not None:
+                    self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+
+            if 'output' in entry:
+                entry['output'] = _describe(entry['output'])
+            with self.lock:
+                self.records.append(entry)
+
+    def summary(self):
+        """
+        Totals per step name.
+
+        Returns:
+        - dictionary name -> {'calls', 'wall_s', 'cpu_s', 'peak_mb'} (peak_mb
+          is the largest peak of one call), in order of first call
+        """
+        totals = {}
+        for entry in sorted(self.records, key=lambda r: r['start_s']):
+            total = totals.setdefault(entry['name'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_mb': 0.0})
+            total['calls'] += 1
+            total['wall_s'] += entry['wall_s']
+            total['cpu_s'] += entry['cpu_s']
+            total['peak_mb'] = max(total['peak_mb'], entry.get('peak_mb', 0.0))
+        return totals
+
+    def format_summary(self, top_level_only=False):
+        """One line per step: name, wall time, CPU time and peak memory"""
+        names = None
+        if top_level_only:
+            names = {entry['name'] for entry in self.records if entry['depth'] == 0}
+        parts = []
+        for name, total in self.summary().items():
+            if names is None or name in names:
+                text = f"{name} {total['wall_s']:.2f} s"
+                if self.memory:
+                    text += f" / {total['peak_mb']:.0f} MB"
+                parts.append(text)
+        return ", ".join(parts)
+
+    def to_dict(self):
+        """Records and summary as a JSON-serializable dictionary"""
+        return {'records': self.records, 'summary': self.summary()}
+
+    def to_json(self, path):
+        """Write the records and the summary as JSON"""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def to_chrome_trace(self, path):
+        """Write the records in the Chrome trace format (chrome://tracing, Perfetto)"""
+        events = []
+        for entry in self.records:
+            args = {key: entry[key] for key in ('cpu_s', 'peak_mb', 'inputs', 'output', 'tags') if key in entry}
+            events.append({
+                'name': entry['name'],
+                'ph': 'X',
+                'ts': entry['start_s'] * 1e6,
+                'dur': entry['wall_s'] * 1e6,
+                'pid': entry['pid'],
+                'tid': entry['thread'],
+                'args': args,
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def merge(self, records, origin=None, tags=None):
+        """
+        Add records made by another profiler (e.g. in a worker process).
+
+        Parameters:
+        - records: records of the other profiler
+        - origin: origin of the other profiler (time.perf_counter is
+          system-wide), used to put its records on the same time axis
+        - tags: dictionary added to the tags of every record
+        """
+        shift = 0.0 if origin is None else origin - self.origin
+        with self.lock:
+            for entry in records:
+                entry = dict(entry, start_s=entry['start_s'] + shift)
+                if tags:
+                    entry['tags'] = {**entry.get('tags', {}), **tags}
+                self.records.append(entry)
+
+
+def active():
+    """Active profiler, or None when profiling is disabled"""
+    return _active
+
+
+def profiled(func):
+    """Decorator recording the calls of a function while a profiler is active"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _active
+        if profiler is None or profiler.thread != threading.get_ident():
+            return func(*args, **kwargs)
+        with profiler.record(name, inputs=args) as entry:
+            result = func(*args, **kwargs)
+            entry['output'] = result
+        return result
+
+    return wrapper
+
+
+def section(name, inputs=(), tags=None):
+    """Context manager recording a block of code while a profiler is active"""
+    profiler = _active
+    if profiler is None or profiler.thread != threading.get_ident():
+        return contextlib.nullcontext({})
+    return profiler.record(name, inputs=inputs, tags=tags)
@@ -0,0 +1,113 @@
+"""
+Multi-resolution image pyramid for display
+
+The canvases of the interface are a few hundred pixels wide: displaying a
+level of the pyramid close to the screen size instead of the full image
+makes redraws independent of the image resolution.
+"""
+
+import math
+
+import numpy as np
+
+
+# Levels smaller than this (in both dimensions) are not built
+MIN_LEVEL_SIZE = 128
+
+# Number of pixels of the sample used to build the histogram of the image
+HISTOGRAM_SAMPLES = 1 << 20
+
+# Number of bins of the histogram (percentiles are interpolated inside a bin)
+HISTOGRAM_BINS = 65536
+
+
+def downsample(data):
+    """
+    Halve the resolution of an image by averaging blocks of 2x2 pixels.
+
+    Parameters:
+    - data: 2D image or color image with channels last
+
+    Returns:
+    - image of size (height // 2, width // 2), the last odd row/column is dropped
+    """
+    height = data.shape[0] // 2 * 2
+    width = data.shape[1] // 2 * 2
+    data = data[:height, :width]
+    total = data[0::2, 0::2] + data[1::2, 0::2]
+    total += data[0::2, 1::2]
+    total += data[1::2, 1::2]
+    total *= 0.25
+    return total
+
+
+class ImagePyramid:
+    """Image at several resolutions (each level is half the previous one) with a cached histogram"""
+
+    def __init__(self, data, min_size=MIN_LEVEL_SIZE):
+        """
+        Build the levels of the pyramid.
+
+        Parameters:
+        - data: full resolution image (level 0, not copied)
+        - min_size: smallest size of the last level
+        """
+        self.data = data
+        self.levels = [data]
+        level = data
+        while min(level.shape[:2]) >= 2 * min_size:
+            level = downsample(level.astype(np.float32, copy=False))
+            self.levels.append(level)
+
+        # Strided sample of the full image, keeps the pixel distribution
+        step = max(1, math.ceil(math.sqrt(data.shape[0] * data.shape[1] / HISTOGRAM_SAMPLES)))
+        self.sample = data[::step, ::step]
+        self.edges = None
+        self.cumulative = None
+
+    def level_for(self, width, height):
+        """
+        Smallest level covering a display area.
+
+        Parameters:
+        - width, height: size of the display area in screen pixels
+
+        Returns:
+        - index of the level (0 = full resolution)
+        """
+        for index in range(len(self.levels) - 1, 0, -1):
+            level_height, level_width = self.levels[index].shape[:2]
+            if level_width >= width and level_height >= height:
+                return index
+        return 0
+
+    def build_histogram(self):
+        """Cumulative histogram of the sample (NaN ignored), computed once"""
+        values = self.sample[np.isfinite(self.sample)]
+        if values.size == 0:
+            self.edges = np.array([0.0, 1.0])
+            self.cumulative = np.array([0.0, 0.0])
+            return
+
+        low, high = float(values.min()), float(values.max())
+        if high <= low:
+            high = low + 1.0
+        counts, self.edges = np.histogram(values, bins=HISTOGRAM_BINS, range=(low, high))
+        self.cumulative = np.concatenate(([0.0], np.cumsum(counts, dtype=np.float64)))
+
+    def percentiles(self, low, high):
+        """
+        Estimate two percentiles of the image (NaN ignored) from its histogram.
+
+        Each call costs O(bins), whatever the size of the image.
+
+        Returns:
+        - (value at low percentile, value at high percentile)
+        """
+        if self.cumulative is None:
+            self.build_histogram()
+
+        # Interpolate the value where the cumulative count reaches each percentile
+        targets = np.array([low, high]) / 100.0 * self.cumulative[-1]
+        data_min, data_max = np.interp(targets, self.cumulative, self.edges)
+        return data_min, data_max
@@ -6,10 +6,24 @@ Implements the formula: I_final = (M × I_erode) + ((1 - M) × I_original)
 from astropy.io import fits
 import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy import ndimage
 
+from erosion import apply_erosion
+from profiling import profiled
 
-def compute_final_image(original, eroded, mask):
+
+# Fraction of nonzero mask pixels below which compute_final_image only
+# blends the star pixels (measured on color frames)
+SPARSE_MASK_FRACTION = 0.03
+
+# Fraction of blocks containing stars above which eroding the whole frame
+# is faster than the localized erosion (measured on a 60 Mpx float32 frame)
+DENSE_BLOCK_FRACTION = 0.25
+
+
+@profiled
+def compute_final_image(original, eroded, mask, out=None, sparse=None, band_pixels=1 << 20):
     """
     Compute the final image by combining original and eroded via the mask.
 
@@ -18,26 +32,60 @@ def compute_final_image(original, eroded, mask):
     Where mask is white (M=1) -> display eroded image (reduced stars)
     Where mask is black (M=0) -> display original image (preserved background)
 
+    The formula is evaluated in place in the output: a 2D mask is broadcast
+    over the channels of color images, and the only temporaries are one
+    band of rows at a time. The sparse path copies the original and blends
+    the nonzero mask pixels only.
+
     Parameters:
     - original: normalized original image (0-1)
     - eroded: normalized eroded image (0-1)
     - mask: smoothed normalized mask (0-1), white = stars
+    - out: optional output array (may be original itself, not eroded)
+    - sparse: True/False to force the sparse/dense path, None to choose
+      from the fraction of nonzero mask pixels (see SPARSE_MASK_FRACTION)
+    - band_pixels: number of pixels per band of rows in the dense path
 
     Returns:
-    - combined final image
+    - combined final image (dtype of the inputs, float32 in the pipeline)
     """
-    # If image is color and mask is 2D, expand mask
-    if original.ndim == 3 and mask.ndim == 2:
-        mask_3d = np.stack([mask, mask, mask], axis=2)
-    else:
-        mask_3d = mask
-
-    # Apply combination formula
-    # Where M=1 (star) -> take eroded
-    # Where M=0 (background) -> take original
-    final = (mask_3d * eroded) + ((1 - mask_3d) * original)
-
-    return final
+    dtype = np.result_type(original, eroded, mask)
+    if out is None:
+        out = np.empty(original.shape, dtype=dtype)
+
+    # Broadcast a 2D mask over the channels of a color image
+    broadcast = original.ndim == 3 and mask.ndim == 2
+
+    def weights(m):
+        return m[..., np.newaxis] if broadcast else m
+
+    if sparse is None:
+        sparse = np.count_nonzero(mask) < SPARSE_MASK_FRACTION * mask.size
+
+    if sparse:
+        # Copy the original and blend only the star pixels
+        if out is not original:
+            np.copyto(out, original, casting='same_kind')
+        # Pixels where any channel of a per-channel mask is nonzero, blended on every channel
+        ys, xs = np.nonzero(mask if mask.ndim == 2 else mask.any(axis=2))
+        m = weights(mask[ys, xs])
+        out[ys, xs] = (m * eroded[ys, xs]) + ((1 - m) * original[ys, xs])
+        return out
+
+    # Dense path by bands of rows: out = (1 - M) × I_original, then out += M × I_erode
+    height, width = mask.shape[:2]
+    band = max(1, band_pixels // width)
+    temp = np.empty((min(band, height),) + original.shape[1:], dtype=dtype)
+    for y0 in range(0, height, band):
+        y1 = min(y0 + band, height)
+        m = weights(mask[y0:y1])
+        t = temp[:y1 - y0]
+        np.subtract(1, m, out=t)
+        np.multiply(t, original[y0:y1], out=out[y0:y1])
+        np.multiply(m, eroded[y0:y1], out=t)
+        out[y0:y1] += t
+
+    return out
 
 
 def process_star_reduction(original, eroded, star_mask, gauss_sigma=2.0, mask_threshold=0.1):
@@ -64,3 +112,104 @@ def process_star_reduction(original, eroded, star_mask, gauss_sigma=2.0, mask_th
     final = compute_final_image(original, eroded, mask_smooth)
 
     return final, mask_smooth
+
+
+def _blocks(image, ys, xs, size):
+    """Copy the size x size blocks of image starting at (ys, xs), channels last"""
+    blocks = sliding_window_view(image, (size, size), axis=(0, 1))[ys, xs]
+    if image.ndim == 3:
+        blocks = np.moveaxis(blocks, 1, -1)
+    return np.ascontiguousarray(blocks)
+
+
+def _block_maximum(image, size, axis):
+    """Maximum of each group of size rows (axis 0) or columns (axis 1), the last group may be shorter"""
+    image = np.moveaxis(image, axis, 0)
+    full = image.shape[0] // size * size
+    groups = [image[:full].reshape((-1, size) + image.shape[1:]).max(axis=1)]
+    if full < image.shape[0]:
+        groups.append(image[full:].max(axis=0, keepdims=True))
+    return np.moveaxis(np.concatenate(groups), 0, axis)
+
+
+@profiled
+def reduce_stars_localized(original, mask, kernel_size=3, iterations=2, engine='opencv', shape='square',
+                           block_size=16, max_blocks=4096):
+    """
+    Erode and blend only inside the star regions of the mask.
+
+    The frame is divided into blocks and only the blocks containing star
+    pixels (M > 0) are processed: each one is read with a halo equal to the
+    erosion reach, the windows are eroded together in a single call, and the
+    star pixels of each block are blended into a copy of the original. The
+    result is identical to eroding the whole image then calling
+    compute_final_image, but the cost scales with the area of the stars
+    instead of the area of the frame.
+
+    Parameters:
+    - original: normalized original image (0-1)
+    - mask: smoothed normalized mask (0-1), white = stars
+    - kernel_size, iterations, engine, shape: erosion parameters (see apply_erosion)
+    - block_size: size of the blocks (raised to 4 times the halo for large kernels)
+    - max_blocks: number of blocks processed at once, bounds memory use
+
+    Returns:
+    - combined final image
+    """
+    height, width = mask.shape
+    halo = iterations * (kernel_size // 2)
+    block_size = max(block_size, 4 * halo)
+    window = block_size + 2 * halo
+
+    # Blocks containing star pixels
+    if height >= window and width >= window:
+        occupied = _block_maximum(_block_maximum(mask, block_size, 0), block_size, 1) > 0
+    else:
+        occupied = np.ones(1, dtype=bool)
+
+    # Image too small to be split or stars everywhere: erode it whole
+    if np.mean(occupied) > DENSE_BLOCK_FRACTION:
+        eroded = apply_erosion(original, kernel_size=kernel_size, iterations=iterations, engine=engine, shape=shape)
+        return compute_final_image(original, eroded, mask)
+
+    final = original.copy()
+    block_y, block_x = np.nonzero(occupied)
+
+    for start in range(0, len(block_y), max_blocks):
+        # Blocks on the bottom/right edges are moved inside the image (they
+        # overlap their neighbours, which only writes the same pixels twice)
+        ys = np.minimum(block_y[start:start + max_blocks] * block_size, height - block_size)
+        xs = np.minimum(block_x[start:start + max_blocks] * block_size, width - block_size)
+
+        # Windows with a halo on every side that is not an image edge
+        # (erosion ignores the outside of the image, like apply_erosion)
+        wy = np.clip(ys - halo, 0, height - window)
+        wx = np.clip(xs - halo, 0, width - window)
+        windows = _blocks(original, wy, wx, window)
+
+        # Erode all the windows at once, stacked vertically and separated by
+        # rows of their maximum value (no effect on a minimum): pixels of
+        # neighbouring windows cannot reach the blocks
+        stacked = np.full((len(ys), window + halo) + windows.shape[2:], np.nanmax(windows), dtype=windows.dtype)
+        stacked[:, :window] = windows
+        eroded = apply_erosion(stacked.reshape((-1,) + stacked.shape[2:]), kernel_size=kernel_size,
+                               iterations=iterations, engine=engine, shape=shape).reshape(stacked.shape)
+
+        index = np.arange(len(ys))
+        e = sliding_window_view(eroded, (block_size, block_size), axis=(1, 2))[index, ys - wy, xs - wx]
+        o = sliding_window_view(windows, (block_size, block_size), axis=(1, 2))[index, ys - wy, xs - wx]
+        if original.ndim == 3:
+            e = np.moveaxis(e, 1, -1)
+            o = np.moveaxis(o, 1, -1)
+        m = _blocks(mask, ys, xs, block_size)
+
+        # Formula: I_final = (M × I_erode) + ((1 - M) × I_original), on the star pixels
+        selected = m > 0
+        m = m[selected]
+        if original.ndim == 3:
+            m = m[:, np.newaxis]
+        rows, cols = np.broadcast_arrays(ys[:, None, None] + np.arange(block_size)[:, None],
+                                         xs[:, None, None] + np.arange(block_size))
+        final[rows[selected], cols[selected]] = (m * e[selected]) + ((1 - m) * o[selected])
+
+    return final
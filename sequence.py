@@ -0,0 +1,434 @@
+"""
+Star reduction of frame sequences of the same field
+
+Sub-exposures and time-lapse frames show the same stars, only shifted and
+rotated by the mount. The stars are detected once, on a reference frame;
+each following frame is registered against this catalog by measuring the
+positions of its brightest isolated stars around their predicted
+positions and fitting a rigid transform (rotation and translation), and
+the transformed catalog replaces the detection in the pipeline. The full
+detection runs again, and the frame becomes the new reference, only when
+the registration fails: too few stars found, RMS residual above the
+tolerance, or too little of the reference field left in the frame.
+
+Usage:
+    sequence = SequenceCatalog(params)
+    for data_raw in frames:
+        sources, registration = sequence.catalog(data_raw)
+        results = reduce_image(data_raw, params, sources=sources)
+"""
+
+import math
+import time
+
+from astropy.io import fits
+from astropy.table import QTable
+import numpy as np
+from scipy.spatial import cKDTree
+
+from pipeline import DEFAULT_PARAMS, reduce_image, to_fits_layout
+from star_detection import background_statistics, centroid_columns, find_sources, to_grayscale
+from fits_io import load_normalized
+from profiling import section
+
+
+# Number of reference stars (the brightest isolated ones) measured on each frame
+REGISTRATION_STARS = 200
+
+# Fewest stars found on a frame for a valid registration
+MIN_MATCHES = 8
+
+# Default tolerance on the RMS residual of the registration (pixels)
+REGISTRATION_TOLERANCE = 1.0
+
+# Default distance searched around the predicted position of each star (pixels)
+SEARCH_RADIUS = 10
+
+# Peak of a star over the noise of its window (robust sigma) to be measured
+MEASURE_SNR = 5.0
+
+# Fewest reference stars still in the frame (fraction of the catalog) to reuse the catalog
+MIN_OVERLAP = 0.9
+
+# Size of the binned images compared by phase correlation (pixels, largest axis)
+CORRELATION_SIZE = 512
+
+
+def rigid_transform(angle=0.0, dx=0.0, dy=0.0):
+    """2x3 matrix of a rotation (radians, around the origin) followed by a translation"""
+    cos, sin = math.cos(angle), math.sin(angle)
+    return np.array([[cos, -sin, dx], [sin, cos, dy]])
+
+
+def apply_transform(transform, x, y):
+    """
+    Transform pixel positions.
+
+    Parameters:
+    - transform: 2x3 matrix (see rigid_transform)
+    - x, y: arrays of positions
+
+    Returns:
+    - transformed x, y
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    return (transform[0, 0] * x + transform[0, 1] * y + transform[0, 2],
+            transform[1, 0] * x + transform[1, 1] * y + transform[1, 2])
+
+
+def fit_rigid(source, target):
+    """
+    Least-squares rigid transform mapping source points on target points (Kabsch).
+
+    Parameters:
+    - source, target: (n, 2) arrays of matched (x, y) positions
+
+    Returns:
+    - 2x3 matrix (see rigid_transform)
+    """
+    source_center = source.mean(axis=0)
+    target_center = target.mean(axis=0)
+    covariance = (source - source_center).T @ (target - target_center)
+    u, _, vt = np.linalg.svd(covariance)
+    # No reflection: the frames of a sequence are never mirrored
+    d = np.sign(np.linalg.det(vt.T @ u.T)) or 1.0
+    rotation = vt.T @ np.diag([1.0, d]) @ u.T
+    return np.column_stack([rotation, target_center - rotation @ source_center])
+
+
+def fit_with_rejection(source, target, iterations=3):
+    """
+    Rigid transform between matched points, ignoring wrong matches.
+
+    Points further than 3 times the median residual (at least half a
+    pixel) from the fit, e.g. a neighbouring star measured instead of the
+    expected one, are left out and the transform is fitted again.
+
+    Returns:
+    - 2x3 matrix, boolean array of the points kept, RMS residual of the kept points (pixels)
+    """
+    keep = np.ones(len(source), dtype=bool)
+    for _ in range(iterations):
+        transform = fit_rigid(source[keep], target[keep])
+        residuals = np.hypot(*(np.column_stack(apply_transform(transform, *source.T)) - target).T)
+        new_keep = residuals <= max(3 * np.median(residuals[keep]), 0.5)
+        if new_keep.sum() < 3 or np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+
+    rms = float(np.sqrt(np.mean(residuals[keep] ** 2)))
+    return transform, keep, rms
+
+
+def registration_stars(sources, count=REGISTRATION_STARS, isolation=SEARCH_RADIUS):
+    """
+    Reference stars measured on the following frames: the brightest ones
+    without another star closer than isolation (their search windows only
+    contain them).
+
+    Returns:
+    - (n, 2) array of (x, y) positions
+    """
+    x_column, y_column = centroid_columns(sources)
+    positions = np.column_stack([np.asarray(sources[x_column], dtype=float),
+                                 np.asarray(sources[y_column], dtype=float)])
+    if len(positions) < 2:
+        return positions
+
+    distances, _ = cKDTree(positions).query(positions, k=2)
+    isolated = np.flatnonzero(distances[:, 1] > isolation)
+    if 'flux' in sources.colnames:
+        isolated = isolated[np.argsort(-np.asarray(sources['flux'])[isolated], kind='stable')]
+    return positions[isolated[:count]]
+
+
+def measure_positions(data_gray, x, y, search=SEARCH_RADIUS, box=2, snr=MEASURE_SNR):
+    """
+    Measure the stars near predicted positions.
+
+    In a window of +/- search pixels around each prediction, the brightest
+    pixel is taken as the star if it stands snr robust sigmas above the
+    median of the window; its centroid is computed in a box of +/- box
+    pixels around that peak.
+
+    Parameters:
+    - data_gray: 2D image
+    - x, y: predicted positions
+    - search: half-size of the search windows
+    - box: half-size of the centroid boxes
+    - snr: detection threshold in robust sigmas of the window
+
+    Returns:
+    - measured x, y (NaN for the stars not found or too close to the border)
+    """
+    height, width = data_gray.shape
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    measured_x = np.full(len(x), np.nan)
+    measured_y = np.full(len(y), np.nan)
+
+    # The windows and the centroid boxes around their peaks must stay in the frame
+    reach = search + box
+    with np.errstate(invalid='ignore'):
+        xi = np.rint(x)
+        yi = np.rint(y)
+        index = np.flatnonzero((xi >= reach) & (xi < width - reach) & (yi >= reach) & (yi < height - reach))
+    if not len(index):
+        return measured_x, measured_y
+    xi = xi[index].astype(np.intp)
+    yi = yi[index].astype(np.intp)
+
+    offsets = np.arange(-search, search + 1)
+    windows = data_gray[yi[:, None, None] + offsets[:, None], xi[:, None, None] + offsets]
+    windows = windows.reshape(len(index), -1).astype(np.float32)
+    level = np.median(windows, axis=1)
+    noise = 1.4826 * np.median(np.abs(windows - level[:, None]), axis=1)
+
+    peak_index = np.argmax(windows, axis=1)
+    peak = windows[np.arange(len(index)), peak_index]
+    found = (peak > level) & (peak - level > snr * noise)
+    peak_y = yi + peak_index // len(offsets) - search
+    peak_x = xi + peak_index % len(offsets) - search
+
+    # Centroid of the background-subtracted box around the peak
+    offsets = np.arange(-box, box + 1)
+    stamps = data_gray[peak_y[:, None, None] + offsets[:, None], peak_x[:, None, None] + offsets]
+    stamps = np.maximum(stamps.astype(np.float32) - level[:, None, None], 0)
+    total = stamps.sum(axis=(1, 2))
+    found &= total > 0
+    total[~found] = 1
+
+    measured_x[index[found]] = (peak_x + stamps.sum(axis=1) @ offsets / total)[found]
+    measured_y[index[found]] = (peak_y + stamps.sum(axis=2) @ offsets / total)[found]
+    return measured_x, measured_y
+
+
+def bin_image(data_gray, size=CORRELATION_SIZE):
+    """
+    Average blocks of pixels so that the image is about size pixels on its largest axis.
+
+    Returns:
+    - binned float32 image, binning factor
+    """
+    factor = max(1, math.ceil(max(data_gray.shape) / size))
+    height, width = data_gray.shape[0] // factor, data_gray.shape[1] // factor
+    blocks = data_gray[:height * factor, :width * factor].reshape(height, factor, width, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32), factor
+
+
+def phase_correlation(reference, image):
+    """
+    Translation of an image relative to a reference image of the same shape.
+
+    Returns:
+    - (dx, dy) in pixels, such that image(x + dx, y + dy) ~ reference(x, y)
+    """
+    cross = np.fft.rfft2(image - image.mean()) * np.conj(np.fft.rfft2(reference - reference.mean()))
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    correlation = np.fft.irfft2(cross, s=reference.shape)
+
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    height, width = correlation.shape
+    return (dx - width if dx > width // 2 else dx), (dy - height if dy > height // 2 else dy)
+
+
+class SequenceCatalog:
+    """Star catalog of a reference frame carried over the following frames of a sequence"""
+
+    def __init__(self, params=None, tolerance=REGISTRATION_TOLERANCE, search=SEARCH_RADIUS, min_overlap=MIN_OVERLAP):
+        """
+        Parameters:
+        - params: processing parameters (detection parameters of the reference frames)
+        - tolerance: largest RMS residual of a registration (pixels); above
+          it, the stars of the frame are detected again
+        - search: distance searched around the predicted position of each star (pixels)
+        - min_overlap: fewest reference stars still in the frame (fraction of the
+          catalog) to reuse the catalog
+        """
+        self.params = {**DEFAULT_PARAMS, **(params or {})}
+        self.tolerance = tolerance
+        self.search = search
+        self.min_overlap = min_overlap
+        self.reference = None
+        self.points = None
+        self.shape = None
+        self.binned = None
+        self.transform = rigid_transform()
+
+    @property
+    def box(self):
+        """Half-size of the centroid boxes of measure_positions (pixels)"""
+        return math.ceil(1.5 * self.params['fwhm']) + 1
+
+    def set_reference(self, data_raw):
+        """
+        Detect the stars of a frame and use it as reference for the next ones.
+
+        Returns:
+        - table of detected stars (or None if none found)
+        """
+        data_gray = to_grayscale(data_raw)
+        params = self.params
+        background = background_statistics(data_gray, method=params['background_method'])
+        sources = find_sources(data_gray, fwhm=params['fwhm'], threshold_sigma=params['threshold_sigma'],
+                               background=background, workers=params['detection_workers'],
+                               engine=params['detection_engine'])
+
+        self.reference = sources
+        self.points = None
+        if sources is not None:
+            # Measured as on the next frames: the residuals then do not include
+            # the difference between the two centroid estimators
+            points = registration_stars(sources, isolation=self.search)
+            x, y = measure_positions(data_gray, *points.T, search=self.search, box=self.box)
+            found = np.isfinite(x)
+            self.points = np.column_stack([x[found], y[found]])
+        self.shape = data_gray.shape
+        self.binned = bin_image(data_gray)[0]
+        self.transform = rigid_transform()
+        return sources
+
+    def register(self, data_gray):
+        """
+        Rigid transform from the reference frame to a frame.
+
+        The stars are first searched around their positions in the previous
+        frame; if too few are found (large jump of the mount), the translation
+        is estimated by phase correlation of binned images and they are
+        searched again.
+
+        Returns:
+        - 2x3 matrix, number of stars used, RMS residual (pixels); None when
+          too few stars are found
+        """
+        if self.points is None or len(self.points) < MIN_MATCHES or data_gray.shape != self.shape:
+            return None
+
+        minimum = max(MIN_MATCHES, len(self.points) // 2)
+        x, y = measure_positions(data_gray, *apply_transform(self.transform, *self.points.T),
+                                 search=self.search, box=self.box)
+        found = np.isfinite(x)
+
+        if found.sum() < minimum:
+            binned, factor = bin_image(data_gray)
+            dx, dy = phase_correlation(self.binned, binned)
+            transform = rigid_transform(dx=dx * factor, dy=dy * factor)
+            x, y = measure_positions(data_gray, *apply_transform(transform, *self.points.T),
+                                     search=max(self.search, 2 * factor), box=self.box)
+            found = np.isfinite(x)
+            if found.sum() < minimum:
+                return None
+
+        transform, keep, rms = fit_with_rejection(self.points[found], np.column_stack([x[found], y[found]]))
+        if keep.sum() < MIN_MATCHES:
+            return None
+        return transform, int(keep.sum()), rms
+
+    def catalog(self, data_raw):
+        """
+        Catalog of the stars of the next frame of the sequence.
+
+        Parameters:
+        - data_raw: raw frame (2D, or 3D color image)
+
+        Returns:
+        - table of stars (reference catalog moved onto the frame, or a new
+          detection; empty when none was found)
+        - dictionary describing the registration: 'detected' (True when the
+          stars were detected), 'matches', 'residual' (pixels), 'transform'
+          (2x3 matrix from the reference frame)
+        """
+        data_gray = to_grayscale(data_raw)
+        registration = None
+        if self.reference is not None:
+            with section('registration'):
+                registration = self.register(data_gray)
+
+        if registration is not None:
+            transform, matches, rms = registration
+            sources = self.moved_catalog(transform, data_gray.shape)
+            if rms <= self.tolerance and sources is not None:
+                self.transform = transform
+                return sources, {'detected': False, 'matches': matches, 'residual': rms, 'transform': transform}
+
+        with section('detection'):
+            sources = self.set_reference(data_raw)
+        if sources is None:
+            # An empty catalog, not None: reduce_image would detect the stars again
+            sources = QTable()
+        return sources, {'detected': True, 'matches': 0, 'residual': 0.0, 'transform': self.transform}
+
+    def moved_catalog(self, transform, shape):
+        """
+        Reference catalog moved onto a frame.
+
+        Returns:
+        - table of the stars whose centroid falls in the frame, or None when
+          fewer than min_overlap of the reference stars do
+        """
+        x_column, y_column = centroid_columns(self.reference)
+        x, y = apply_transform(transform, self.reference[x_column], self.reference[y_column])
+        inside = (x >= 0) & (x < shape[1]) & (y >= 0) & (y < shape[0])
+        if inside.sum() < self.min_overlap * len(inside):
+            return None
+
+        sources = self.reference[inside]
+        sources[x_column] = x[inside]
+        sources[y_column] = y[inside]
+        return sources
+
+
+def process_sequence(jobs, params=None, reference=None, tolerance=REGISTRATION_TOLERANCE, search=SEARCH_RADIUS,
+                     overwrite=False, progress=None):
+    """
+    Reduce the stars of the frames of a sequence, in order, reusing the star catalog.
+
+    Parameters:
+    - jobs: list of (input path, output path) in the order of the sequence
+    - params: processing parameters (missing ones use DEFAULT_PARAMS)
+    - reference: optional FITS file of the reference frame (default: the first frame)
+    - tolerance, search: see SequenceCatalog
+    - overwrite: replace existing output files
+    - progress: optional callable progress(path, destination, nb_stars,
+      registration, elapsed) called after each frame (see SequenceCatalog.catalog)
+
+    Returns:
+    - number of frames whose stars were detected (the others reused the catalog)
+    """
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    sequence = SequenceCatalog(params, tolerance=tolerance, search=search)
+    if reference is not None:
+        with section('load'):
+            _, data_raw, _ = load_normalized(reference)
+        with section('detection'):
+            sequence.set_reference(data_raw)
+        del data_raw
+
+    detections = 0
+    for path, destination in jobs:
+        start = time.perf_counter()
+        with section('load'):
+            original, data_raw, header = load_normalized(path)
+        sources, registration = sequence.catalog(data_raw)
+        detections += registration['detected']
+        results = reduce_image(data_raw, params, original=original, sources=sources)
+
+        # Record the parameters and the registration in the header of the result
+        header['HISTORY'] = 'Star reduction (detect_stars, smooth_mask, apply_erosion, compute_final_image)'
+        for name, value in params.items():
+            header['HISTORY'] = f'{name} = {value}'
+        if not registration['detected']:
+            (a, b, dx), (_, _, dy) = registration['transform']
+            header['HISTORY'] = (f"Star catalog registered on the reference frame: rotation "
+                                 f"{math.degrees(math.atan2(-b, a)):.4f} deg, shift ({dx:.2f}, {dy:.2f}) px, "
+                                 f"rms {registration['residual']:.3f} px")
+
+        with section('write'):
+            final = to_fits_layout(results['finale'], data_raw).astype(np.float32)
+            fits.writeto(destination, final, header, overwrite=overwrite)
+
+        if progress is not None:
+            progress(path, destination, len(sources), registration, time.perf_counter() - start)
+
+    return detections
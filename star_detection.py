@@ -2,15 +2,476 @@
 Star detection module using DAOStarFinder
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import threading
+
 from astropy.io import fits
+from astropy.table import Table, vstack
 from photutils.detection import DAOStarFinder
-from astropy.stats import sigma_clipped_stats
+from astropy.stats import sigma_clipped_stats, gaussian_fwhm_to_sigma
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from profiling import profiled
+
+
+# Size of the tiles of the parallel detection, without their overlap (pixels)
+DETECTION_TILE_SIZE = 1024
+
+# Background estimators of background_statistics
+BACKGROUND_METHODS = ('full', 'subsample', 'mesh')
+
+# Star detectors of find_sources: DAOStarFinder, or the vectorized peak finder find_peaks_fast
+DETECTION_ENGINES = ('daofind', 'peaks')
+
+# Sharpness of the stars kept by find_peaks_fast (DAOStarFinder defaults)
+SHARPNESS_RANGE = (0.2, 1.0)
+
+# Number of pixels used by the subsample and mesh background estimators
+BACKGROUND_SAMPLES = 1 << 20
+
+# Size of the boxes of the mesh background estimator (pixels)
+BACKGROUND_BOX_SIZE = 128
+
+# Truncation of scipy's gaussian_filter (in standard deviations)
+GAUSSIAN_TRUNCATE = 4.0
+
+# blur_mask_from_sources filters the whole frame instead when the stamps
+# cover more than this fraction of its pixels (summed, overlaps included)
+STAMP_COVERAGE_LIMIT = 0.5
+
+# Image shared with the parallel detection workers (attached in each worker)
+_shared_memory = None
+_shared_image = None
+
+
+def to_grayscale(data):
+    """
+    Convert a color image to the grayscale image used for star detection.
+
+    Parameters:
+
+    data: 2D or 3D numpy array
+
+    Returns:
+
+    2D numpy array (the image itself if already grayscale)
+    """
+    if data.ndim == 3:
+        if data.shape[0] == 3:
+            return data[0]
+        elif data.shape[2] == 3:
+            return np.mean(data, axis=2)
+        else:
+            return data[:, :, 0]
+    return data
+
+
+def _strided_sample(data_gray, max_samples):
+    """Step and strided sample of about max_samples pixels, keeps the spatial distribution"""
+    step = max(1, math.ceil(math.sqrt(data_gray.shape[0] * data_gray.shape[1] / max_samples)))
+    return step, data_gray[::step, ::step]
+
+
+def _interpolation_weights(size, cells):
+    """
+    Matrix of the linear interpolation of cells values (at the centres of the
+    cells) to size pixels, constant beyond the first and last centres.
+    """
+    position = np.clip((np.arange(size) + 0.5) * cells / size - 0.5, 0, cells - 1)
+    first = np.floor(position).astype(np.intp)
+    second = np.minimum(first + 1, cells - 1)
+    fraction = (position - first).astype(np.float32)
+
+    weights = np.zeros((size, cells), dtype=np.float32)
+    rows = np.arange(size)
+    np.add.at(weights, (rows, first), 1 - fraction)
+    np.add.at(weights, (rows, second), fraction)
+    return weights
+
+
+def mesh_background(data_gray, box_size=BACKGROUND_BOX_SIZE, max_samples=BACKGROUND_SAMPLES):
+    """
+    Coarse 2D background: sigma-clipped statistics in boxes, interpolated.
+
+    The statistics of each box are computed on a strided subsample of the
+    image; the grid of box medians is median-filtered (to reject boxes
+    covered by a bright object) and bilinearly upsampled to the image size.
+
+    Parameters:
+
+    data_gray: 2D numpy array
+
+    box_size: size of the boxes in pixels (default: BACKGROUND_BOX_SIZE)
 
+    max_samples: number of pixels of the subsample (default: BACKGROUND_SAMPLES)
 
-def detect_stars(data, fwhm=3.0, threshold_sigma=5.5, radius=3.5):
+    Returns:
+
+    (mean, median, std): mean and std are scalars (mean of the box means,
+    median of the box standard deviations), median is a float32 map of the
+    background with the shape of the image
+    """
+    height, width = data_gray.shape
+    step, sample = _strided_sample(data_gray, max_samples)
+    box = max(1, box_size // step)
+    ny, nx = max(1, sample.shape[0] // box), max(1, sample.shape[1] // box)
+    by, bx = min(box, sample.shape[0]), min(box, sample.shape[1])
+
+    blocks = sample[:ny * by, :nx * bx].reshape(ny, by, nx, bx)
+    means, medians, stds = sigma_clipped_stats(blocks, sigma=3.0, axis=(1, 3))
+
+    # Boxes without valid pixels take the median of the others
+    medians = np.where(np.isfinite(medians), medians, np.nanmedian(medians))
+    medians = ndimage.median_filter(medians, size=3, mode='nearest')
+
+    # Bilinear upsampling as two small matrix products (much faster than ndimage.zoom)
+    medians = medians.astype(np.float32)
+    background = _interpolation_weights(height, ny) @ medians @ _interpolation_weights(width, nx).T
+    return float(np.nanmean(means)), background, float(np.nanmedian(stds))
+
+
+@profiled
+def background_statistics(data_gray, method='full', max_samples=BACKGROUND_SAMPLES):
+    """
+    Background statistics used to set the detection threshold.
+
+    They only depend on the image: compute them once and pass them to
+    find_stars / detect_stars when the detection parameters change.
+
+    Parameters:
+
+    data_gray: 2D numpy array
+
+    method: 'full' (sigma clipping over every pixel), 'subsample'
+    (sigma clipping over a strided subsample of max_samples pixels; the
+    median of n pixels has a standard error of about 1.25 std / sqrt(n),
+    0.1% of the noise for one million pixels) or 'mesh' (see mesh_background)
+
+    max_samples: number of pixels of the subsample and mesh estimators
+
+    Returns:
+
+    (mean, median, std) as returned by sigma_clipped_stats (median is a map
+    of the image size with the mesh estimator)
+    """
+    if method == 'full':
+        return sigma_clipped_stats(data_gray, sigma=3.0)
+    if method == 'subsample':
+        return sigma_clipped_stats(_strided_sample(data_gray, max_samples)[1], sigma=3.0)
+    if method == 'mesh':
+        return mesh_background(data_gray, max_samples=max_samples)
+    raise ValueError(f"Unknown background method: {method} (expected one of {', '.join(BACKGROUND_METHODS)})")
+
+
+@profiled
+def find_stars(data_gray, fwhm=3.0, threshold_sigma=5.5, background=None):
+    """
+    Run DAOStarFinder on a grayscale image.
+
+    Parameters:
+
+    data_gray: 2D numpy array
+
+    fwhm: Full Width at Half Maximum of the stars (default: 3.0)
+
+    threshold_sigma: number of standard deviations above the background to detect a star (default: 5.5)
+
+    background: (mean, median, std) background statistics (see
+    background_statistics; median may be a background map); computed with
+    sigma_clipped_stats on the whole image when None
+
+    Returns:
+
+    table of detected stars (or None if none found)
+    """
+    # Calculate background statistics
+    if background is None:
+        background = sigma_clipped_stats(data_gray, sigma=3.0)
+    mean, median, std = background
+
+    # Create the detector
+    daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold_sigma * std)
+
+    # Find the stars
+    sources = daofind(data_gray - median)
+
+    if sources is None or len(sources) == 0:
+        return None
+    return sources
+
+
+def density_kernel(fwhm):
+    """
+    Density enhancement kernel of DAOStarFinder for round stars.
+
+    Parameters:
+
+    fwhm: Full Width at Half Maximum of the stars
+
+    Returns:
+
+    (kernel, footprint, relative error): the zero-sum Gaussian kernel
+    (convolving with it gives the amplitude of the best fitting star), the
+    boolean footprint of the kernel and the factor converting the noise of
+    the image into the noise of the convolved image
+    """
+    # Same truncation as photutils _StarFinderKernel: 1.5 sigma, at least 2 pixels
+    sigma = fwhm * gaussian_fwhm_to_sigma
+    radius = int(max(2, 1.5 * sigma))
+    yy, xx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    distance2 = xx ** 2 + yy ** 2
+    footprint = (distance2 <= (1.5 * sigma) ** 2) | (distance2 <= 4)
+
+    gaussian = np.exp(-distance2 / (2 * sigma ** 2)) * footprint
+    n_pixels = footprint.sum()
+    denom = (gaussian ** 2).sum() - gaussian.sum() ** 2 / n_pixels
+    kernel = (gaussian - gaussian.sum() / n_pixels) / denom * footprint
+    return kernel, footprint, 1.0 / math.sqrt(denom)
+
+
+@profiled
+def find_peaks_fast(data_gray, fwhm=3.0, threshold_sigma=5.5, background=None):
+    """
+    Detect stars as the local maxima of the DAOStarFinder convolved image.
+
+    Same kernel, threshold, minimum separation and sharpness filter as
+    find_stars, without the roundness filter (elongated sources are kept)
+    and with centroids interpolated from the convolved image. Every step
+    is a whole-array operation: much faster than DAOStarFinder, which
+    checks each candidate peak in Python, on crowded fields. Meant for
+    previews.
+
+    Parameters:
+
+    data_gray: 2D numpy array
+
+    fwhm, threshold_sigma, background: see find_stars
+
+    Returns:
+
+    table of detected stars with id, x_centroid, y_centroid, sharpness and
+    peak columns (or None if none found)
+    """
+    if background is None:
+        background = sigma_clipped_stats(data_gray, sigma=3.0)
+    _, median, std = background
+
+    kernel, footprint, relative_error = density_kernel(fwhm)
+    data = np.asarray(data_gray - median, dtype=np.float32)
+    convolved = ndimage.convolve(data, kernel.astype(np.float32), mode='constant')
+
+    # Local maxima above the threshold, at least the DAOStarFinder separation apart: maxima of
+    # their 3x3 neighbourhood (inside the disc from 2 pixels), then compared with the rest of the disc
+    separation = math.ceil(2.5 * fwhm)
+    neighbourhood = ndimage.maximum_filter(convolved, size=3 if separation >= 2 else 1, mode='constant')
+    ys, xs = np.nonzero((convolved > threshold_sigma * std * relative_error) & (convolved == neighbourhood))
+    padded = np.pad(convolved, separation)
+    positions = (ys + separation) * padded.shape[1] + xs + separation
+    centre = convolved[ys, xs]
+    is_peak = np.ones(len(ys), dtype=bool)
+    for dy, dx in zip(*disc_offsets(separation)):
+        if max(abs(dy), abs(dx)) > 1:
+            is_peak &= centre >= padded.ravel()[positions + dy * padded.shape[1] + dx]
+    ys, xs, centre = ys[is_peak], xs[is_peak], centre[is_peak]
+
+    # Sharpness: peak pixel above the mean of the rest of the kernel footprint, relative to the
+    # amplitude of the star (hot pixels are sharper than 1, noise bumps and blends flatter than 0.2)
+    radius = footprint.shape[0] // 2
+    padded = np.pad(data, radius)
+    positions = (ys + radius) * padded.shape[1] + xs + radius
+    surrounding = np.zeros(len(ys), dtype=np.float32)
+    for dy, dx in np.argwhere(footprint) - radius:
+        if dy or dx:
+            surrounding += padded.ravel()[positions + dy * padded.shape[1] + dx]
+    peak = data[ys, xs]
+    sharpness = (peak - surrounding / (footprint.sum() - 1)) / centre
+    keep = (sharpness > SHARPNESS_RANGE[0]) & (sharpness < SHARPNESS_RANGE[1])
+    ys, xs, centre, peak, sharpness = ys[keep], xs[keep], centre[keep], peak[keep], sharpness[keep]
+    if len(ys) == 0:
+        return None
+
+    # Sub-pixel position: vertex of the parabola through the peak and its two neighbours on each axis
+    padded = np.pad(convolved, 1, mode='edge')
+    positions = []
+    for before, after, index in ((padded[ys + 1, xs], padded[ys + 1, xs + 2], xs),
+                                 (padded[ys, xs + 1], padded[ys + 2, xs + 1], ys)):
+        curvature = before - 2 * centre + after
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0.0)
+        positions.append(index + np.clip(offset, -0.5, 0.5))
+
+    return Table({'id': np.arange(1, len(ys) + 1), 'x_centroid': positions[0], 'y_centroid': positions[1],
+                  'sharpness': sharpness, 'peak': peak})
+
+
+def detection_reach(fwhm):
+    """
+    Distance around a star that DAOStarFinder reads to detect it.
+
+    Parameters:
+
+    fwhm: Full Width at Half Maximum of the stars
+
+    Returns:
+
+    number of pixels (convolution kernel, peak footprint and minimum separation)
+    """
+    # DAOStarFinder kernel radius (see photutils _StarFinderKernel, round stars)
+    kernel_radius = int(max(2, 1.5 * fwhm * gaussian_fwhm_to_sigma))
+    min_separation = math.ceil(2.5 * fwhm)
+    return 2 * kernel_radius + 2 * min_separation + 2
+
+
+def centroid_columns(sources):
+    """Names of the x and y centroid columns (renamed x_centroid/y_centroid in photutils 3.0)"""
+    if 'x_centroid' in sources.colnames:
+        return 'x_centroid', 'y_centroid'
+    return 'xcentroid', 'ycentroid'
+
+
+def _pool_context():
+    """
+    Start method of the detection pool: the default one, or forkserver when
+    other threads are running (e.g. the readers and writers of a batch run
+    with -j 1), since forking a multithreaded process can deadlock the children
+    """
+    if threading.active_count() > 1 and 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return None
+
+
+def _attach_shared_image(name, shape, dtype):
+    """Initializer of the detection workers: map the shared image"""
+    global _shared_memory, _shared_image
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    _shared_image = np.ndarray(shape, dtype=dtype, buffer=_shared_memory.buf)
+
+
+def _detect_tile(window, core, fwhm, threshold_sigma, background):
+    """
+    Detect the stars of one tile of the shared image (runs in a worker).
+
+    Only the stars whose centroid lies in the core of the tile are kept, in
+    image coordinates; the rest of the window is the overlap with the
+    neighbouring tiles. Core bounds on the image border are infinite, so the
+    stars centred just outside the frame are kept once.
+    """
+    y0, y1, x0, x1 = window
+    sources = find_stars(_shared_image[y0:y1, x0:x1], fwhm=fwhm, threshold_sigma=threshold_sigma,
+                         background=background)
+    if sources is None:
+        return None
+
+    x_column, y_column = centroid_columns(sources)
+    sources[x_column] += x0
+    sources[y_column] += y0
+
+    cy0, cy1, cx0, cx1 = core
+    x = np.asarray(sources[x_column])
+    y = np.asarray(sources[y_column])
+    inside = (y >= cy0) & (y < cy1) & (x >= cx0) & (x < cx1)
+    return sources[inside] if np.any(inside) else None
+
+
+def find_stars_parallel(data_gray, fwhm=3.0, threshold_sigma=5.5, background=None, workers=None,
+                        tile_size=DETECTION_TILE_SIZE, tolerance=0.5):
+    """
+    Run DAOStarFinder on overlapping tiles in a process pool.
+
+    The image is copied once into shared memory, the workers detect the
+    stars of their tiles (with an overlap larger than the neighbourhood
+    DAOStarFinder uses, and the same background statistics for all tiles),
+    and the catalogs are merged: each star belongs to the tile containing
+    its centroid, and stars found twice across a seam (closer than
+    tolerance) are removed with a KD-tree.
+
+    Parameters:
+
+    data_gray: 2D numpy array
+
+    fwhm, threshold_sigma, background: see find_stars
+
+    workers: number of worker processes (default: number of CPUs)
+
+    tile_size: size of the tiles without their overlap
+
+    tolerance: distance in pixels under which two sources are the same star
+
+    Returns:
+
+    table of detected stars sorted by position (or None if none found)
+    """
+    # Same background statistics for every tile, as in a single pass
+    if background is None:
+        background = sigma_clipped_stats(data_gray, sigma=3.0)
+    mean, median, std = background
+
+    # Background map (mesh estimator): subtracted once before sharing the image
+    if np.ndim(median):
+        data_gray = data_gray - median
+        median = 0.0
+    background = (float(mean), float(median), float(std))
+
+    height, width = data_gray.shape
+    overlap = detection_reach(fwhm) + math.ceil(fwhm) + 1
+    tiles = []
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+            window = (max(y0 - overlap, 0), min(y1 + overlap, height), max(x0 - overlap, 0), min(x1 + overlap, width))
+            # Every centroid belongs to exactly one core, including those slightly outside the image
+            core = (y0 if y0 > 0 else -np.inf, y1 if y1 < height else np.inf,
+                    x0 if x0 > 0 else -np.inf, x1 if x1 < width else np.inf)
+            tiles.append((window, core))
+
+    # A single tile or worker: no pool needed
+    workers = workers or os.cpu_count() or 1
+    if len(tiles) == 1 or workers == 1:
+        return find_stars(data_gray, fwhm=fwhm, threshold_sigma=threshold_sigma, background=background)
+
+    data_gray = np.ascontiguousarray(data_gray)
+    shared = shared_memory.SharedMemory(create=True, size=max(data_gray.nbytes, 1))
+    try:
+        np.ndarray(data_gray.shape, dtype=data_gray.dtype, buffer=shared.buf)[...] = data_gray
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context(), initializer=_attach_shared_image,
+                                 initargs=(shared.name, data_gray.shape, data_gray.dtype)) as executor:
+            futures = [executor.submit(_detect_tile, window, core, fwhm, threshold_sigma, background)
+                       for window, core in tiles]
+            tables = [table for table in (future.result() for future in futures) if table is not None]
+    finally:
+        shared.close()
+        shared.unlink()
+
+    if not tables:
+        return None
+    sources = vstack(tables)
+
+    # Stars detected by two tiles across a seam: keep the first of each pair
+    x_column, y_column = centroid_columns(sources)
+    positions = np.column_stack([np.asarray(sources[x_column]), np.asarray(sources[y_column])])
+    pairs = cKDTree(positions).query_pairs(tolerance, output_type='ndarray')
+    if len(pairs):
+        keep = np.ones(len(sources), dtype=bool)
+        keep[np.unique(pairs.max(axis=1))] = False
+        sources = sources[keep]
+        positions = positions[keep]
+
+    # Same order and numbering as a single pass (by row, then column)
+    sources = sources[np.lexsort((positions[:, 0], np.floor(positions[:, 1])))]
+    sources['id'] = np.arange(1, len(sources) + 1)
+    return sources
+
+
+@profiled
+def detect_stars(data, fwhm=3.0, threshold_sigma=5.5, radius=3.5, background=None, workers=1):
     """
     Detect stars in an image and return a binary mask.
 
@@ -24,6 +485,11 @@ def detect_stars(data, fwhm=3.0, threshold_sigma=5.5, radius=3.5):
 
     radius: radius of the circles in the mask for each star (default: 3.5)
 
+    background: precomputed (mean, median, std) background statistics (default: computed from data)
+
+    workers: number of processes of the detection (default: 1, single pass;
+    more runs find_stars_parallel)
+
     Returns:
 
     mask: 2D numpy array with 255 for stars, 0 elsewhere
@@ -31,53 +497,151 @@ def detect_stars(data, fwhm=3.0, threshold_sigma=5.5, radius=3.5):
     sources: table of detected stars (or None if none found)
     """
     # If color image, convert to grayscale
-    if data.ndim == 3:
-        if data.shape[0] == 3:
-            data_gray = data[0]
-        elif data.shape[2] == 3:
-            data_gray = np.mean(data, axis=2)
-        else:
-            data_gray = data[:, :, 0]
-    else:
-        data_gray = data
+    data_gray = to_grayscale(data)
 
-    # Calculate background statistics
-    mean, median, std = sigma_clipped_stats(data_gray, sigma=3.0)
+    sources = find_sources(data_gray, fwhm=fwhm, threshold_sigma=threshold_sigma, background=background,
+                           workers=workers)
+    return star_mask(data_gray.shape, sources, radius), sources
 
-    # Create the detector
-    daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold_sigma * std)
 
-    # Find the stars
-    sources = daofind(data_gray - median)
+def find_sources(data, fwhm=3.0, threshold_sigma=5.5, background=None, workers=1, engine='daofind'):
+    """
+    Detect the stars of an image (catalog only, see detect_stars).
+
+    Parameters:
+
+    data: 2D numpy array, or color image (converted with to_grayscale)
+
+    fwhm, threshold_sigma, background, workers: see detect_stars
+
+    engine: 'daofind' (DAOStarFinder) or 'peaks' (find_peaks_fast, single pass)
+
+    Returns:
+
+    table of detected stars (or None if none found)
+    """
+    # If color image, convert to grayscale
+    data_gray = to_grayscale(data)
+
+    if engine == 'peaks':
+        return find_peaks_fast(data_gray, fwhm=fwhm, threshold_sigma=threshold_sigma, background=background)
+    if engine != 'daofind':
+        raise ValueError(f"Unknown detection engine: {engine} (expected one of {', '.join(DETECTION_ENGINES)})")
 
+    if workers > 1:
+        return find_stars_parallel(data_gray, fwhm=fwhm, threshold_sigma=threshold_sigma,
+                                   background=background, workers=workers)
+    return find_stars(data_gray, fwhm=fwhm, threshold_sigma=threshold_sigma, background=background)
+
+
+def star_mask(shape, sources, radius):
+    """
+    Binary mask with a disc around each star of a catalog.
+
+    The catalog does not depend on the radius: changing the radius only
+    needs this function, not a new detection.
+
+    Parameters:
+
+    shape: (height, width) of the mask
+
+    sources: table of detected stars, or None
+
+    radius: radius of the discs
+
+    Returns:
+
+    mask: 2D numpy array with 255 for stars, 0 elsewhere
+    """
     # Create an empty mask
-    mask = np.zeros(data_gray.shape, dtype=np.uint8)
+    mask = np.zeros(shape, dtype=np.uint8)
 
-    if sources is None or len(sources) == 0:
-        return mask, None
+    if sources is None:
+        return mask
 
-    # For each detected star, draw a circle in the mask
-    for star in sources:
-        x = int(star['xcentroid'])
-        y = int(star['ycentroid'])
+    # Draw a disc of the given radius around each detected star
+    x_column, y_column = centroid_columns(sources)
+    rasterize_star_mask(mask, sources[x_column], sources[y_column], radius)
+    return mask
 
-        if 0 <= y < data_gray.shape[0] and 0 <= x < data_gray.shape[1]:
-            range_size = int(radius) + 1
-            for dy in range(-range_size, range_size + 1):
-                for dx in range(-range_size, range_size + 1):
-                    new_y = y + dy
-                    new_x = x + dx
-                    # Vérifier si dans les limites et dans le rayon
-                    if (0 <= new_y < data_gray.shape[0] and 0 <= new_x < data_gray.shape[1] and
-                        np.sqrt(dx**2 + dy**2) <= radius):
-                        mask[new_y, new_x] = 255
 
-    return mask, sources
+def disc_offsets(radius):
+    """
+    Pixel offsets covered by a disc of the given radius.
 
+    Parameters:
 
-def smooth_mask(mask, sigma=2.0, threshold=0.1):
+    radius: radius of the disc in pixels
+
+    Returns:
+
+    dy, dx: 1D integer arrays of the offsets (relative to the centre) inside the disc
     """
-    Apply a Gaussian blur to the mask for smooth transitions.
+    range_size = int(radius) + 1
+    dy, dx = np.mgrid[-range_size:range_size + 1, -range_size:range_size + 1]
+    inside = np.sqrt(dx**2 + dy**2) <= radius
+    return dy[inside], dx[inside]
+
+
+@profiled
+def rasterize_star_mask(mask, x, y, radius, value=255, chunk_size=65536, origin=(0, 0), image_shape=None):
+    """
+    Draw a disc around each star position into the mask, in place.
+
+    The disc stamp is computed once and pasted at every centroid with
+    vectorized fancy indexing; pixels falling outside the mask are clipped.
+    Centroids are truncated to integers and stars whose centroid lies
+    outside the image are ignored.
+
+    Parameters:
+
+    mask: 2D numpy array to draw into
+
+    x, y: centroid coordinates of the stars (pixels)
+
+    radius: radius of the discs
+
+    value: value written inside the discs (default: 255)
+
+    chunk_size: maximum number of (star, offset) pairs handled at once, bounds memory use
+
+    origin: (y, x) image coordinates of the first pixel of the mask, when the
+    mask only covers part of the image (default: (0, 0))
+
+    image_shape: shape of the whole image, used to ignore stars outside of it
+    (default: shape of the mask)
+
+    Returns:
+
+    mask (modified in place)
+    """
+    if image_shape is None:
+        image_shape = mask.shape
+    height, width = mask.shape
+    x = np.asarray(x, dtype=float).astype(np.intp)
+    y = np.asarray(y, dtype=float).astype(np.intp)
+
+    # Keep only the stars whose centroid is inside the image
+    inside = (y >= 0) & (y < image_shape[0]) & (x >= 0) & (x < image_shape[1])
+    x = x[inside] - origin[1]
+    y = y[inside] - origin[0]
+
+    dy, dx = disc_offsets(radius)
+    stars_per_chunk = max(1, chunk_size // len(dy))
+
+    for start in range(0, len(x), stars_per_chunk):
+        ys = (y[start:start + stars_per_chunk, None] + dy).ravel()
+        xs = (x[start:start + stars_per_chunk, None] + dx).ravel()
+        valid = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+        mask[ys[valid], xs[valid]] = value
+
+    return mask
+
+
+@profiled
+def blur_mask(mask, sigma=2.0):
+    """
+    Apply a Gaussian blur to the binary mask.
 
     Parameters:
 
@@ -85,19 +649,230 @@ def smooth_mask(mask, sigma=2.0, threshold=0.1):
 
     sigma: standard deviation of the Gaussian blur
 
-    threshold: minimum threshold to keep values
-
     Returns:
 
-    smoothed mask normalized between 0 and 1
+    blurred mask normalized between 0 and 1 (before thresholding)
     """
     # Normalize between 0 and 1
     mask_norm = mask.astype(np.float32) / 255.0
 
     # Apply Gaussian blur
-    mask_smooth = ndimage.gaussian_filter(mask_norm, sigma=sigma)
+    return ndimage.gaussian_filter(mask_norm, sigma=sigma)
+
+
+@functools.lru_cache(maxsize=32)
+def gaussian_kernel(sigma):
+    """
+    1D kernel of scipy's gaussian_filter (normalized, radius truncated at GAUSSIAN_TRUNCATE sigmas).
+
+    Returns:
+
+    read-only 1D numpy array of odd length
+    """
+    radius = int(GAUSSIAN_TRUNCATE * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma**2 * x**2)
+    kernel /= kernel.sum()
+    kernel.setflags(write=False)
+    return kernel
+
+
+@functools.lru_cache(maxsize=32)
+def disc_gaussian_stamp(radius, sigma):
+    """
+    Disc drawn by rasterize_star_mask blurred like blur_mask, computed once per (radius, sigma).
+
+    Parameters:
 
-    # Apply threshold to remove very low values
-    mask_smooth = np.where(mask_smooth > threshold, mask_smooth, 0)
+    radius: radius of the disc
 
-    return mask_smooth
\ No newline at end of file
+    sigma: standard deviation of the Gaussian blur
+
+    Returns:
+
+    read-only square 2D numpy array centred on the star pixel (disc of 1.0)
+    """
+    size = int(radius) + 1
+    dy, dx = disc_offsets(radius)
+    disc = np.zeros((2 * size + 1, 2 * size + 1))
+    disc[dy + size, dx + size] = 1.0
+
+    kernel = gaussian_kernel(sigma)
+    stamp = np.apply_along_axis(np.convolve, 0, disc, kernel)
+    stamp = np.apply_along_axis(np.convolve, 1, stamp, kernel)
+    stamp.setflags(write=False)
+    return stamp
+
+
+def _reflect(index, size):
+    """Fold indices up to one size outside [0, size) back inside (mode 'reflect' of scipy.ndimage)"""
+    return np.where(index < 0, -1 - index, np.where(index >= size, 2 * size - 1 - index, index))
+
+
+def paste_stamps(image, ys, xs, stamp, weights=None, chunk_size=1 << 20):
+    """
+    Add a stamp centred on each position, in place.
+
+    Values falling outside the image are reflected back inside, which gives
+    the borders of gaussian_filter (mode 'reflect').
+
+    Parameters:
+
+    image: contiguous 2D float numpy array
+
+    ys, xs: integer positions of the stamp centres (may be outside the image
+    by less than the image size minus half the stamp)
+
+    stamp: square 2D array of odd size
+
+    weights: optional factor of the stamp at each position
+
+    chunk_size: maximum number of pixels added at once, bounds memory use
+
+    Returns:
+
+    image (modified in place)
+    """
+    height, width = image.shape
+    half = stamp.shape[0] // 2
+    sy, sx = np.mgrid[-half:half + 1, -half:half + 1]
+    sy, sx, values = sy.ravel(), sx.ravel(), stamp.ravel()
+    flat = image.reshape(-1)
+    if weights is None:
+        weights = np.ones(len(ys), dtype=image.dtype)
+
+    # np.add.at is only fast when the values have the dtype of the image
+    values = values.astype(image.dtype)
+    weights = np.asarray(weights, dtype=image.dtype)
+
+    # Stamps entirely inside the image: plain offsets of the flat index
+    interior = (ys >= half) & (ys < height - half) & (xs >= half) & (xs < width - half)
+    starts = ys[interior] * width + xs[interior]
+    interior_weights = weights[interior]
+    offsets = sy * width + sx
+
+    per_chunk = max(1, chunk_size // values.size)
+    for start in range(0, len(starts), per_chunk):
+        chunk = slice(start, start + per_chunk)
+        np.add.at(flat, (starts[chunk, None] + offsets).ravel(), (interior_weights[chunk, None] * values).ravel())
+
+    # Stamps crossing the border: fold the outside values back
+    border_y, border_x, border_weights = ys[~interior], xs[~interior], weights[~interior]
+    for start in range(0, len(border_y), per_chunk):
+        chunk = slice(start, start + per_chunk)
+        ty = _reflect(border_y[chunk, None] + sy, height)
+        tx = _reflect(border_x[chunk, None] + sx, width)
+        np.add.at(flat, (ty * width + tx).ravel(), (border_weights[chunk, None] * values).ravel())
+
+    return image
+
+
+@profiled
+def blur_mask_from_sources(x, y, shape, radius, sigma=2.0):
+    """
+    Blurred star mask built directly from the star positions.
+
+    Gives the same result as blur_mask(rasterize_star_mask(...)) without
+    filtering the whole frame: a disc blurred by the Gaussian is computed
+    once and added at every star, so the cost grows with the number of
+    stars instead of the number of pixels. The pixels that the sum counts
+    wrongly are corrected with single Gaussian kernels: pixels covered by
+    several discs (the mask is a union) and disc pixels outside the image.
+    Dense fields, where the stamps would cover more than
+    STAMP_COVERAGE_LIMIT of the frame, are filtered as in blur_mask.
+
+    Parameters:
+
+    x, y: centroid coordinates of the stars (pixels)
+
+    shape: (height, width) of the mask
+
+    radius: radius of the discs
+
+    sigma: standard deviation of the Gaussian blur
+
+    Returns:
+
+    blurred mask normalized between 0 and 1 (float32, as blur_mask)
+    """
+    height, width = shape
+    reach = int(radius) + 1
+    stamp = disc_gaussian_stamp(float(radius), float(sigma))
+
+    # Dense fields are faster to filter; folding the borders needs stamps smaller than the image
+    if len(x) * stamp.size > STAMP_COVERAGE_LIMIT * height * width or stamp.shape[0] // 2 >= min(height, width):
+        mask = rasterize_star_mask(np.zeros(shape, dtype=np.uint8), x, y, radius)
+        return blur_mask(mask, sigma=sigma)
+
+    # Same star pixels as rasterize_star_mask
+    x = np.asarray(x, dtype=float).astype(np.intp)
+    y = np.asarray(y, dtype=float).astype(np.intp)
+    inside = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+    x, y = x[inside], y[inside]
+
+    # Accumulated in float64: the corrections subtract nearly equal sums
+    blurred = np.zeros(shape, dtype=np.float64)
+    paste_stamps(blurred, y, x, stamp)
+
+    # Stars whose disc may overlap another one or leave the image
+    near_edge = (y < reach) | (y >= height - reach) | (x < reach) | (x >= width - reach)
+    crowded = np.zeros(len(x), dtype=bool)
+    if len(x) > 1:
+        pairs = cKDTree(np.column_stack([x, y])).query_pairs(2 * reach, p=np.inf, output_type='ndarray')
+        crowded[pairs.ravel()] = True
+    selected = near_edge | crowded
+
+    dy, dx = disc_offsets(radius)
+    ys = (y[selected, None] + dy).ravel()
+    xs = (x[selected, None] + dx).ravel()
+    valid = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+
+    # Pixels counted once per disc covering them, and pixels outside the image
+    pixels, counts = np.unique(ys[valid] * width + xs[valid], return_counts=True)
+    extra = counts > 1
+    correction_y = np.concatenate([pixels[extra] // width, ys[~valid]])
+    correction_x = np.concatenate([pixels[extra] % width, xs[~valid]])
+    correction = -np.concatenate([counts[extra] - 1, np.ones(np.count_nonzero(~valid))]).astype(np.float64)
+
+    kernel = gaussian_kernel(float(sigma))
+    paste_stamps(blurred, correction_y, correction_x, np.outer(kernel, kernel), weights=correction)
+
+    return blurred.astype(np.float32)
+
+
+@profiled
+def threshold_mask(mask_blurred, threshold=0.1):
+    """
+    Remove the very low values of a blurred mask.
+
+    Parameters:
+
+    mask_blurred: blurred mask normalized between 0 and 1
+
+    threshold: minimum threshold to keep values
+
+    Returns:
+
+    thresholded mask (values below the threshold set to 0)
+    """
+    return np.where(mask_blurred > threshold, mask_blurred, 0)
+
+
+@profiled
+def smooth_mask(mask, sigma=2.0, threshold=0.1):
+    """
+    Apply a Gaussian blur to the mask for smooth transitions.
+
+    Parameters:
+
+    mask: binary mask (0-255)
+
+    sigma: standard deviation of the Gaussian blur
+
+    threshold: minimum threshold to keep values
+
+    Returns:
+
+    smoothed mask normalized between 0 and 1
+    """
+    return threshold_mask(blur_mask(mask, sigma=sigma), threshold=threshold)
@@ -0,0 +1,475 @@
+"""
+Command-line interface for star reduction (no display server needed)
+
+Usage:
+    python star_reduction.py batch examples/ -o results/batch -j 8
+    python star_reduction.py batch "night/*.fits" --config params.json --kernel-size 5
+    python star_reduction.py tiled mosaic.fits mosaic_finale.fits --tile-size 4096
+    python star_reduction.py cube timeseries.fits timeseries_finale.fits -j 4
+    python star_reduction.py sequence "night/light_*.fits" -o results/sequence --tolerance 0.5
+    python star_reduction.py serve -j 4
+"""
+
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from astropy.io import fits
+import numpy as np
+
+from pipeline import DEFAULT_PARAMS, reduce_image, to_fits_layout
+from fits_io import load_normalized
+from tiled import process_tiled
+from cube import process_planes
+from sequence import process_sequence, REGISTRATION_TOLERANCE, SEARCH_RADIUS
+from streaming import stream_jobs, DEFAULT_PREFETCH
+from profiling import Profiler
+from catalog_cache import CatalogCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from fits_export import export_fits, check_compression, COMPRESSION_TYPES, DEFAULT_QUANTIZE_LEVEL
+from daemon import serve, DEFAULT_SOCKET
+from fits_files import find_fits_files, output_jobs
+
+
+def load_params(args):
+    """
+    Build the processing parameters: defaults, then config file, then command-line options.
+    """
+    params = dict(DEFAULT_PARAMS)
+
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        unknown = set(config) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise ValueError(f"Unknown parameters in {args.config}: {', '.join(sorted(unknown))}")
+        params.update(config)
+
+    for name in DEFAULT_PARAMS:
+        value = getattr(args, name)
+        if value is not None:
+            params[name] = value
+
+    return params
+
+
+def read_file(job):
+    """
+    Load one input file normalized between 0 and 1 (runs in a reader thread).
+
+    Parameters:
+    - job: (input path, output path)
+
+    Returns:
+    - normalized float32 image (channels last), True if the file stores the
+      channels first, header
+    """
+    original, data_raw, header = load_normalized(job[0])
+    return original, data_raw.shape != original.shape, header
+
+
+def reduce_file(data, params, profile=False, catalog_cache=None, progress=None):
+    """
+    Reduce the stars of a file loaded by read_file.
+
+    Runs in the compute thread or in a worker process. When catalog_cache
+    (a CatalogCache) is given, the detection results are read from it or
+    added to it; progress(stage, index, total) is called before each
+    pipeline stage.
+
+    Returns:
+    - final image in the axis order of the file (float32), header with the
+      parameters recorded, number of detected stars, processing time in
+      seconds, and the profiling records {'origin', 'records'} when profile
+      is True (else None)
+    """
+    start = time.perf_counter()
+    profiler = Profiler() if profile else None
+    if profiler is not None:
+        profiler.start()
+
+    # Detection runs on the same buffer, in the axis order of the file
+    original, channels_first, header = data
+    data_raw = np.transpose(original, (2, 0, 1)) if channels_first else original
+    try:
+        results = reduce_image(data_raw, params, original=original, catalog_cache=catalog_cache,
+                               progress=progress)
+        final = to_fits_layout(results['finale'], data_raw).astype(np.float32)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+    # Record the parameters in the header of the result
+    header['HISTORY'] = 'Star reduction (detect_stars, smooth_mask, apply_erosion, compute_final_image)'
+    for name, value in params.items():
+        header['HISTORY'] = f'{name} = {value}'
+
+    nb_stars = 0 if results['sources'] is None else len(results['sources'])
+    records = None if profiler is None else {'origin': profiler.origin, 'records': profiler.records}
+    return final, header, nb_stars, time.perf_counter() - start, records
+
+
+def write_file(job, result, overwrite=False, compression=None, tile_shape=None, quantize_level=DEFAULT_QUANTIZE_LEVEL):
+    """
+    Write the final image of a file (runs in a writer thread).
+
+    With a compression (see fits_export.export_fits), the image is written
+    in a tile-compressed extension after an empty primary HDU.
+
+    Returns:
+    - number of detected stars, processing time in seconds and profiling
+      records of the reduction (see reduce_file)
+    """
+    final, header, nb_stars, elapsed, records = result
+    if compression is None:
+        fits.writeto(job[1], final, header, overwrite=overwrite)
+    else:
+        export_fits(job[1], {'finale': final}, header, compression=compression, tile_shape=tile_shape,
+                    quantize_level=quantize_level, overwrite=overwrite)
+    return nb_stars, elapsed, records
+
+
+def run_batch(args):
+    """Run the reduction on all the files, overlapping reads and writes with the reduction"""
+    params = load_params(args)
+    try:
+        check_compression(args.compression, args.quantize)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    files = find_fits_files(args.inputs)
+    if not files:
+        print("No FITS file found", file=sys.stderr)
+        return 1
+    try:
+        destinations = output_jobs(files, args.output, args.suffix)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+
+    # Skip the files whose result already exists
+    jobs = []
+    for path, destination in destinations:
+        if os.path.exists(destination) and not args.overwrite:
+            print(f"skip  {path} ({destination} exists)")
+            continue
+        jobs.append((path, destination))
+
+    workers = args.workers or os.cpu_count() or 1
+    print(f"{len(jobs)} file(s), {workers} worker(s)")
+
+    catalog_cache = None
+    if not args.no_catalog_cache:
+        catalog_cache = CatalogCache(args.catalog_cache, max_bytes=int(args.catalog_cache_size * 1e6))
+
+    # Records of the workers gathered on one time axis
+    profile = args.profile or args.trace
+    profiler = Profiler() if profile else None
+
+    # Files are read and written by threads of this process; a single worker
+    # reduces them in this process too, without sending the images to a pool
+    compute = functools.partial(reduce_file, params=params, profile=bool(profile), catalog_cache=catalog_cache)
+    write = functools.partial(write_file, overwrite=args.overwrite, compression=args.compression,
+                              tile_shape=args.tile_shape, quantize_level=args.quantize)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    failures = 0
+    start = time.perf_counter()
+    try:
+        for (path, destination), result, error, timings in stream_jobs(
+                jobs, read_file, compute, write, executor=executor, workers=workers,
+                readers=args.readers, writers=args.writers, prefetch=args.prefetch):
+            if error is not None:
+                failures += 1
+                print(f"error {path}: {error}", file=sys.stderr)
+                continue
+
+            nb_stars, elapsed, records = result
+            io_time = sum(record['wall_s'] for record in timings)
+            print(f"done  {path} -> {destination} ({nb_stars} stars, {elapsed:.1f} s + {io_time:.1f} s I/O)")
+            if profiler is not None:
+                profiler.merge(timings, origin=0.0, tags={'file': path})
+                profiler.merge(records['records'], origin=records['origin'], tags={'file': path})
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print(f"{len(jobs) - failures}/{len(jobs)} file(s) processed in {time.perf_counter() - start:.1f} s")
+    if profiler is not None:
+        save_profile(profiler, args)
+    return 1 if failures else 0
+
+
+def run_tiled(args):
+    """Run the reduction of one large image tile by tile"""
+    params = load_params(args)
+
+    def progress(done, total):
+        print(f"\rtile {done}/{total}", end='', flush=True)
+
+    profiler = Profiler() if args.profile or args.trace else None
+    if profiler is not None:
+        profiler.start()
+
+    start = time.perf_counter()
+    try:
+        nb_stars = process_tiled(args.input, args.output, params, tile_size=args.tile_size,
+                                 overwrite=args.overwrite, progress=progress)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    print(f"\n{args.input} -> {args.output} ({nb_stars} stars, {time.perf_counter() - start:.1f} s)")
+
+    if profiler is not None:
+        save_profile(profiler, args)
+    return 0
+
+
+def run_cube(args):
+    """Run the reduction of every image plane of a multi-extension FITS file or cube"""
+    params = load_params(args)
+
+    def progress(done, total):
+        print(f"\rplane {done}/{total}", end='', flush=True)
+
+    # Only the planes reduced in this process are recorded (-j 1)
+    profiler = Profiler() if args.profile or args.trace else None
+    if profiler is not None:
+        profiler.start()
+
+    start = time.perf_counter()
+    try:
+        nb_stars = process_planes(args.input, args.output, params, workers=args.workers, color=not args.planes,
+                                  overwrite=args.overwrite, progress=progress)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    print(f"\n{args.input} -> {args.output} ({nb_stars} stars, {time.perf_counter() - start:.1f} s)")
+
+    if profiler is not None:
+        save_profile(profiler, args)
+    return 0
+
+
+def run_sequence(args):
+    """Run the reduction of a sequence of frames of the same field, reusing the star catalog"""
+    params = load_params(args)
+    files = find_fits_files(args.inputs)
+    if not files:
+        print("No FITS file found", file=sys.stderr)
+        return 1
+    try:
+        jobs = output_jobs(files, args.output, args.suffix)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+    existing = [destination for _, destination in jobs if os.path.exists(destination)]
+    if existing and not args.overwrite:
+        print(f"{existing[0]} exists (use --overwrite)", file=sys.stderr)
+        return 1
+
+    def progress(path, destination, nb_stars, registration, elapsed):
+        if registration['detected']:
+            how = "detected"
+        else:
+            how = f"registered on {registration['matches']} stars, rms {registration['residual']:.2f} px"
+        print(f"done  {path} -> {destination} ({nb_stars} stars {how}, {elapsed:.1f} s)")
+
+    profiler = Profiler() if args.profile or args.trace else None
+    if profiler is not None:
+        profiler.start()
+
+    start = time.perf_counter()
+    try:
+        detections = process_sequence(jobs, params, reference=args.reference, tolerance=args.tolerance,
+                                      search=args.search, overwrite=args.overwrite, progress=progress)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    print(f"{len(jobs)} frame(s) processed in {time.perf_counter() - start:.1f} s, "
+          f"stars detected on {detections} frame(s)")
+
+    if profiler is not None:
+        save_profile(profiler, args)
+    return 0
+
+
+def run_serve(args):
+    """Run the local daemon until interrupted"""
+    catalog_cache = None
+    if not args.no_catalog_cache:
+        catalog_cache = CatalogCache(args.catalog_cache, max_bytes=int(args.catalog_cache_size * 1e6))
+    try:
+        serve(args.socket, workers=args.workers, catalog_cache=catalog_cache)
+    except OSError as e:
+        print(f"Cannot listen on {args.socket}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def save_profile(profiler, args):
+    """Print the per-step summary and write the profile files requested on the command line"""
+    for name, total in profiler.summary().items():
+        memory = f", peak {total['peak_mb']:.0f} MB" if profiler.memory else ""
+        print(f"  {name:<22} {total['calls']:>5} call(s) {total['wall_s']:>8.2f} s wall "
+              f"{total['cpu_s']:>8.2f} s CPU{memory}")
+    if args.profile:
+        profiler.to_json(args.profile)
+        print(f"Profile written to {args.profile}")
+    if args.trace:
+        profiler.to_chrome_trace(args.trace)
+        print(f"Chrome trace written to {args.trace}")
+
+
+def add_profile_arguments(parser):
+    """Add the options writing the timing and memory of every step"""
+    parser.add_argument('--profile', metavar='FILE', help="write the time, CPU time, peak memory and array "
+                                                          "sizes of every step as JSON")
+    parser.add_argument('--trace', metavar='FILE', help="write the steps as a Chrome trace (chrome://tracing, Perfetto)")
+
+
+def add_catalog_cache_arguments(parser):
+    """Add the options of the catalog cache"""
+    parser.add_argument('--catalog-cache', metavar='DIR', default=DEFAULT_CACHE_DIR,
+                        help=f"directory of the cached detection results (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--catalog-cache-size', metavar='MB', type=float, default=DEFAULT_MAX_BYTES / 1e6,
+                        help="size limit of the catalog cache, least recently used results are removed "
+                             f"(default: {DEFAULT_MAX_BYTES / 1e6:.0f})")
+    parser.add_argument('--no-catalog-cache', action='store_true', help="always run the star detection")
+
+
+def add_param_arguments(parser):
+    """Add one option per processing parameter (overrides the config file)"""
+    group = parser.add_argument_group("processing parameters (default: config file, then built-in defaults)")
+    group.add_argument('--fwhm', type=float, help=f"FWHM of the stars (default: {DEFAULT_PARAMS['fwhm']})")
+    group.add_argument('--threshold-sigma', type=float,
+                       help=f"detection threshold in sigma (default: {DEFAULT_PARAMS['threshold_sigma']})")
+    group.add_argument('--radius', type=float, help=f"radius of the star mask (default: {DEFAULT_PARAMS['radius']})")
+    group.add_argument('--background-method', choices=('full', 'subsample', 'mesh'),
+                       help="background estimator of the detection: sigma clipping over every pixel, over a "
+                            f"subsample, or a coarse 2D mesh (default: {DEFAULT_PARAMS['background_method']})")
+    group.add_argument('--detection-workers', type=int,
+                       help="processes of the star detection, on overlapping tiles "
+                            f"(default: {DEFAULT_PARAMS['detection_workers']}, single pass)")
+    group.add_argument('--detection-engine', choices=('daofind', 'peaks'),
+                       help="star detector: DAOStarFinder, or local maxima of the same convolved image without the "
+                            f"roundness filter (faster, meant for previews) (default: {DEFAULT_PARAMS['detection_engine']})")
+    group.add_argument('--kernel-size', type=int,
+                       help=f"erosion kernel size (default: {DEFAULT_PARAMS['kernel_size']})")
+    group.add_argument('--iterations', type=int,
+                       help=f"erosion iterations (default: {DEFAULT_PARAMS['iterations']})")
+    group.add_argument('--erosion-engine', choices=('opencv', 'float'),
+                       help=f"erosion engine (default: {DEFAULT_PARAMS['erosion_engine']})")
+    group.add_argument('--erosion-shape', choices=('square', 'circle'),
+                       help=f"shape of the erosion kernel (default: {DEFAULT_PARAMS['erosion_shape']})")
+    group.add_argument('--localized', action='store_const', const=True,
+                       help="erode only the star regions instead of the whole frame")
+    group.add_argument('--gauss-sigma', type=float,
+                       help=f"sigma of the mask blur (default: {DEFAULT_PARAMS['gauss_sigma']})")
+    group.add_argument('--blur-engine', choices=('filter', 'stamps'),
+                       help="blur of the star mask: Gaussian filter of the whole frame, or blurred discs added at "
+                            f"each star (faster for sparse fields) (default: {DEFAULT_PARAMS['blur_engine']})")
+    group.add_argument('--mask-threshold', type=float,
+                       help=f"threshold of the smoothed mask (default: {DEFAULT_PARAMS['mask_threshold']})")
+
+
+def build_parser():
+    """Command-line parser"""
+    parser = argparse.ArgumentParser(prog='star-reduction', description="Astronomical star reduction")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch = subparsers.add_parser('batch', help="reduce the stars of many FITS files in parallel")
+    batch.add_argument('inputs', nargs='+', help="FITS files, directories or glob patterns")
+    batch.add_argument('-o', '--output', default='results/batch', help="output directory (default: results/batch)")
+    batch.add_argument('-j', '--workers', type=int, default=None,
+                       help="number of worker processes (default: number of CPUs)")
+    batch.add_argument('--prefetch', type=int, default=DEFAULT_PREFETCH,
+                       help=f"files loaded ahead of the workers (default: {DEFAULT_PREFETCH})")
+    batch.add_argument('--readers', type=int, default=1, help="threads reading the input files (default: 1)")
+    batch.add_argument('--writers', type=int, default=1, help="threads writing the results (default: 1)")
+    batch.add_argument('-c', '--config', help="JSON file with processing parameters")
+    batch.add_argument('--suffix', default='_finale', help="suffix of the result files (default: _finale)")
+    batch.add_argument('--overwrite', action='store_true', help="overwrite existing results")
+    add_catalog_cache_arguments(batch)
+    batch.add_argument('--compression', choices=COMPRESSION_TYPES,
+                       help="write the results as tile-compressed FITS (default: uncompressed)")
+    batch.add_argument('--tile-shape', type=int, nargs=2, metavar=('ROWS', 'COLUMNS'),
+                       help="size of the compression tiles (default: one row per tile)")
+    batch.add_argument('--quantize', type=float, default=DEFAULT_QUANTIZE_LEVEL,
+                       help="quantization of the compressed values, noise sigma / QUANTIZE; 0 is lossless, with the "
+                            f"GZIP algorithms only (default: {DEFAULT_QUANTIZE_LEVEL:g})")
+    add_param_arguments(batch)
+    add_profile_arguments(batch)
+    batch.set_defaults(func=run_batch)
+
+    tiled = subparsers.add_parser('tiled', help="reduce the stars of an image larger than memory, tile by tile")
+    tiled.add_argument('input', help="FITS file (2D image or (3, height, width) color image)")
+    tiled.add_argument('output', help="result FITS file")
+    tiled.add_argument('-t', '--tile-size', type=int, default=2048, help="size of the tiles in pixels (default: 2048)")
+    tiled.add_argument('-c', '--config', help="JSON file with processing parameters")
+    tiled.add_argument('--overwrite', action='store_true', help="overwrite the output file")
+    add_param_arguments(tiled)
+    add_profile_arguments(tiled)
+    tiled.set_defaults(func=run_tiled)
+
+    cube = subparsers.add_parser('cube', help="reduce every image plane of a multi-extension FITS file or data cube")
+    cube.add_argument('input', help="FITS file (images in any HDU, cubes such as time series or spectral planes)")
+    cube.add_argument('output', help="result FITS file, with one HDU per input image HDU")
+    cube.add_argument('-j', '--workers', type=int, default=1,
+                      help="number of planes reduced in parallel (default: 1)")
+    cube.add_argument('--planes', action='store_true',
+                      help="read (3, height, width) HDUs as 3 planes instead of a color image")
+    cube.add_argument('-c', '--config', help="JSON file with processing parameters")
+    cube.add_argument('--overwrite', action='store_true', help="overwrite the output file")
+    add_param_arguments(cube)
+    add_profile_arguments(cube)
+    cube.set_defaults(func=run_cube)
+
+    sequence = subparsers.add_parser('sequence', help="reduce the stars of a sequence of frames of the same field, "
+                                                      "detecting them once and registering the next frames")
+    sequence.add_argument('inputs', nargs='+', help="FITS files, directories or glob patterns, in the order of the "
+                                                    "sequence (sorted by name)")
+    sequence.add_argument('-o', '--output', default='results/sequence',
+                          help="output directory (default: results/sequence)")
+    sequence.add_argument('--reference', metavar='FILE', help="frame whose stars are detected first "
+                                                              "(default: the first frame)")
+    sequence.add_argument('--tolerance', type=float, default=REGISTRATION_TOLERANCE,
+                          help="largest RMS residual of the registration in pixels, above it the stars are "
+                               f"detected again (default: {REGISTRATION_TOLERANCE})")
+    sequence.add_argument('--search', type=int, default=SEARCH_RADIUS,
+                          help="distance searched around the position of each star in the previous frame "
+                               f"in pixels (default: {SEARCH_RADIUS})")
+    sequence.add_argument('-c', '--config', help="JSON file with processing parameters")
+    sequence.add_argument('--suffix', default='_finale', help="suffix of the result files (default: _finale)")
+    sequence.add_argument('--overwrite', action='store_true', help="overwrite existing results")
+    add_param_arguments(sequence)
+    add_profile_arguments(sequence)
+    sequence.set_defaults(func=run_sequence)
+
+    serve_parser = subparsers.add_parser('serve', help="run a local daemon reducing the files submitted to it with "
+                                                       "warm worker processes")
+    serve_parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                              help=f"Unix domain socket of the API, created with mode 0600 (default: {DEFAULT_SOCKET})")
+    serve_parser.add_argument('-j', '--workers', type=int, default=None,
+                              help="number of worker processes (default: number of CPUs)")
+    add_catalog_cache_arguments(serve_parser)
+    serve_parser.set_defaults(func=run_serve)
+
+    return parser
+
+
+def main(argv=None):
+    """Entry point of the command-line interface"""
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
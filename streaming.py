@@ -0,0 +1,173 @@
+"""
+Streaming batch processing: prefetched reads, parallel compute, asynchronous writes
+
+Reading and decoding a FITS file, then encoding and saving its result, do
+not have to wait for the reduction of the other files. Reader threads
+load the next files into a bounded queue while the compute workers reduce
+the files already loaded, and writer threads save the results as they
+come out. Every queue is bounded, so when the compute falls behind the
+readers block (backpressure): at most readers + prefetch + workers +
+2 * writers files are held in memory at once.
+
+Usage:
+    for job, result, error, timings in stream_jobs(paths, read, compute, write, prefetch=2):
+        ...
+"""
+
+from concurrent.futures import FIRST_COMPLETED, wait
+import os
+import queue
+import threading
+import time
+
+
+# Default number of files loaded ahead of the compute workers
+DEFAULT_PREFETCH = 2
+
+# Marks the end of a queue
+_END = object()
+
+
+def _timed(name, func, *args):
+    """
+    Call func and time it.
+
+    Returns:
+    - result of func, record of the call in the format of profiling.Profiler
+      (start_s is an absolute time.perf_counter value)
+    """
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    result = func(*args)
+    record = {
+        'name': name,
+        'thread': threading.get_ident(),
+        'pid': os.getpid(),
+        'depth': 0,
+        'inputs': [],
+        'wall_s': time.perf_counter() - start_wall,
+        'cpu_s': time.thread_time() - start_cpu,
+        'start_s': start_wall,
+    }
+    return result, record
+
+
+def start_workers(executor, workers):
+    """
+    Start the processes of a process pool before any thread of stream_jobs runs.
+
+    ProcessPoolExecutor forks its worker processes on the first submit. Made
+    from the dispatcher while readers are inside astropy, the fork could copy
+    a lock held by a reader thread into the children, which then deadlock.
+    """
+    for future in [executor.submit(os.getpid) for _ in range(workers)]:
+        future.result()
+
+
+def stream_jobs(jobs, read, compute, write, executor=None, workers=1, readers=1, writers=1,
+                prefetch=DEFAULT_PREFETCH):
+    """
+    Run read, compute and write on every job, overlapping the three stages.
+
+    Parameters:
+    - jobs: list of jobs (e.g. (input path, output path) tuples)
+    - read: read(job) -> data, called in reader threads
+    - compute: compute(data) -> result, called in the compute thread, or in
+      the executor when one is given (then it must be picklable)
+    - write: write(job, result) -> value yielded for the job, called in writer threads
+    - executor: optional concurrent.futures executor running compute (its
+      processes are started before the threads, see start_workers)
+    - workers: largest number of jobs computed at the same time in the executor
+    - readers: number of reader threads
+    - writers: number of writer threads
+    - prefetch: number of loaded jobs waiting for a compute worker
+
+    Yields:
+    - (job, value returned by write, exception or None, list of the
+      'load' and 'write' records of the job; see _timed), in completion
+      order; a job whose read, compute or write raised is yielded with
+      the exception and its remaining stages are skipped
+    """
+    jobs = list(jobs)
+    pending = queue.Queue()
+    loaded = queue.Queue(maxsize=max(prefetch, 1))
+    computed = queue.Queue(maxsize=max(writers, 1))
+    done = queue.Queue()
+
+    for job in jobs:
+        pending.put(job)
+    for _ in range(readers):
+        pending.put(_END)
+
+    if executor is not None:
+        start_workers(executor, workers)
+
+    def reader():
+        while True:
+            job = pending.get()
+            if job is _END:
+                return
+            try:
+                data, record = _timed('load', read, job)
+                loaded.put((job, data, None, [record]))
+            except Exception as error:
+                loaded.put((job, None, error, []))
+
+    def dispatcher():
+        running = {}
+
+        def collect(futures):
+            for future in futures:
+                job, records = running.pop(future)
+                error = future.exception()
+                computed.put((job, None if error else future.result(), error, records))
+
+        for _ in range(len(jobs)):
+            job, data, error, records = loaded.get()
+            if error is not None:
+                computed.put((job, None, error, records))
+            elif executor is None:
+                try:
+                    computed.put((job, compute(data), None, records))
+                except Exception as error:
+                    computed.put((job, None, error, records))
+            else:
+                # At most workers jobs sent to the executor: the others wait in the bounded queue
+                while len(running) >= workers:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                try:
+                    running[executor.submit(compute, data)] = (job, records)
+                except Exception as error:
+                    computed.put((job, None, error, records))
+            del data
+        collect(list(running))
+
+        for _ in range(writers):
+            computed.put((_END, None, None, None))
+
+    def writer():
+        while True:
+            job, result, error, records = computed.get()
+            if job is _END:
+                return
+            value = None
+            if error is None:
+                try:
+                    value, record = _timed('write', write, job, result)
+                    records.append(record)
+                except Exception as exception:
+                    error = exception
+            del result
+            done.put((job, value, error, records))
+
+    threads = [threading.Thread(target=reader, daemon=True) for _ in range(readers)]
+    threads.append(threading.Thread(target=dispatcher, daemon=True))
+    threads.extend(threading.Thread(target=writer, daemon=True) for _ in range(writers))
+    for thread in threads:
+        thread.start()
+
+    for _ in range(len(jobs)):
+        yield done.get()
+    for thread in threads:
+        thread.join()
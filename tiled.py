@@ -0,0 +1,246 @@
+"""
+Tiled out-of-core star reduction for images larger than memory
+
+The image is read tile by tile from a memory-mapped FITS file and the
+result is written tile by tile into a preallocated output FITS file.
+Each tile is processed with a halo large enough for every stage of the
+pipeline (detection, mask drawing, Gaussian blur, erosion), so the
+result does not depend on the tile size: stars crossing tile seams come
+out exactly as in a single untiled run using the same background
+statistics.
+"""
+
+import math
+
+import numpy as np
+from astropy.stats import sigma_clipped_stats
+
+from star_detection import (find_stars, detection_reach, rasterize_star_mask, blur_mask, threshold_mask,
+                            centroid_columns, GAUSSIAN_TRUNCATE)
+from erosion import apply_erosion
+from reduction_localisee import compute_final_image, reduce_stars_localized
+from pipeline import DEFAULT_PARAMS
+from fits_io import open_memmap, read_section, create_output
+from profiling import section
+
+
+
+def halo_sizes(params):
+    """
+    Number of pixels each stage needs around a tile to give exact results.
+
+    Parameters:
+    - params: processing parameters (see DEFAULT_PARAMS)
+
+    Returns:
+    - dictionary with:
+      - 'erosion': reach of the iterated erosion
+      - 'blur': radius of the Gaussian blur of the mask
+      - 'mask': reach of the smoothed mask (Gaussian radius + disc radius), i.e.
+        distance at which a star still changes the mask of the tile
+      - 'detection': total halo read for detection (mask reach + neighbourhood
+        DAOStarFinder uses around a star: convolution kernel, peak footprint
+        and minimum separation)
+    """
+    erosion_reach = params['iterations'] * (params['kernel_size'] // 2)
+    gauss_reach = int(GAUSSIAN_TRUNCATE * params['gauss_sigma'] + 0.5)
+    disc_reach = int(params['radius']) + 1
+
+    dao_reach = detection_reach(params['fwhm'])
+
+    return {
+        'erosion': erosion_reach,
+        'blur': gauss_reach,
+        'mask': gauss_reach + disc_reach,
+        'detection': gauss_reach + disc_reach + dao_reach,
+    }
+
+
+def iter_tiles(height, width, tile_size):
+    """Yield the (y0, y1, x0, x1) bounds of the tiles covering the image"""
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            yield y0, min(y0 + tile_size, height), x0, min(x0 + tile_size, width)
+
+
+def expand(bounds, halo, height, width):
+    """Bounds of a tile grown by a halo, clipped to the image"""
+    y0, y1, x0, x1 = bounds
+    return max(y0 - halo, 0), min(y1 + halo, height), max(x0 - halo, 0), min(x1 + halo, width)
+
+
+def _window(hdu, bounds):
+    """Read the pixels inside bounds (all channels of a (3, height, width) image) as float"""
+    y0, y1, x0, x1 = bounds
+    key = (slice(y0, y1), slice(x0, x1))
+    if hdu.header['NAXIS'] == 3:
+        key = (slice(None),) + key
+    return read_section(hdu, key).astype(float)
+
+
+def image_range(hdu, band_height=1024):
+    """
+    Minimum and maximum of the image, read by bands of rows.
+
+    Returns:
+    - (data_min, data_max) ignoring NaN values
+    """
+    height, width = hdu.shape[-2:]
+    data_min = np.inf
+    data_max = -np.inf
+    for y0 in range(0, height, band_height):
+        band = _window(hdu, (y0, min(y0 + band_height, height), 0, width))
+        data_min = min(data_min, np.nanmin(band))
+        data_max = max(data_max, np.nanmax(band))
+    return data_min, data_max
+
+
+def estimate_background(hdu, max_samples=4_000_000):
+    """
+    Background statistics of the detection image from a strided subsample.
+
+    Parameters:
+    - hdu: image HDU opened with open_memmap
+    - max_samples: maximum number of pixels used for sigma clipping
+
+    Returns:
+    - (mean, median, std) as returned by sigma_clipped_stats
+    """
+    height, width = hdu.shape[-2:]
+    step = max(1, math.ceil(math.sqrt(height * width / max_samples)))
+
+    key = (slice(None, None, step), slice(None, None, step))
+    if hdu.header['NAXIS'] == 3:
+        key = (0,) + key
+    sample = read_section(hdu, key).astype(float)
+
+    return sigma_clipped_stats(sample, sigma=3.0)
+
+
+def process_tile(hdu, bounds, params, background, data_range, halos):
+    """
+    Reduce the stars of one tile.
+
+    Parameters:
+    - hdu: image HDU opened with open_memmap
+    - bounds: (y0, y1, x0, x1) of the tile
+    - params: processing parameters
+    - background: (mean, median, std) statistics used for detection
+    - data_range: (min, max) of the whole image, used for normalization
+    - halos: result of halo_sizes(params)
+
+    Returns:
+    - final image of the tile (channels first for color images), number of
+      stars whose centroid lies inside the tile
+    """
+    height, width = hdu.shape[-2:]
+    y0, y1, x0, x1 = bounds
+    color = hdu.header['NAXIS'] == 3
+
+    # STEP 1: Detect stars on the tile grown by the detection halo
+    det = expand(bounds, halos['detection'], height, width)
+    data_det = _window(hdu, det)
+    gray = data_det[0] if color else data_det
+    sources = find_stars(gray, fwhm=params['fwhm'], threshold_sigma=params['threshold_sigma'],
+                         background=background)
+
+    # STEP 2: Draw and smooth the mask on the tile grown by the Gaussian reach.
+    # Only stars far enough from the detection window edges are kept: their
+    # detection is identical to the untiled run.
+    mask_bounds = expand(bounds, halos['blur'], height, width)
+    keep_bounds = expand(bounds, halos['mask'], height, width)
+    mask = np.zeros((mask_bounds[1] - mask_bounds[0], mask_bounds[3] - mask_bounds[2]), dtype=np.uint8)
+    nb_stars = 0
+
+    if sources is not None:
+        # Integer positions in image coordinates (as drawn by rasterize_star_mask)
+        x_column, y_column = centroid_columns(sources)
+        xs = (np.asarray(sources[x_column], dtype=float) + det[2]).astype(np.intp)
+        ys = (np.asarray(sources[y_column], dtype=float) + det[0]).astype(np.intp)
+        keep = ((ys >= keep_bounds[0]) & (ys < keep_bounds[1]) &
+                (xs >= keep_bounds[2]) & (xs < keep_bounds[3]))
+        rasterize_star_mask(mask, xs[keep], ys[keep], params['radius'],
+                            origin=(mask_bounds[0], mask_bounds[2]), image_shape=(height, width))
+        nb_stars = int(np.count_nonzero((ys >= y0) & (ys < y1) & (xs >= x0) & (xs < x1)))
+
+    mask_smooth = threshold_mask(blur_mask(mask, sigma=params['gauss_sigma']), threshold=params['mask_threshold'])
+    mask_smooth = mask_smooth[y0 - mask_bounds[0]:y1 - mask_bounds[0], x0 - mask_bounds[2]:x1 - mask_bounds[2]]
+
+    # STEP 3: Erode the normalized tile grown by the erosion reach
+    ero = expand(bounds, halos['erosion'], height, width)
+    data_min, data_max = data_range
+    data_ero = _window(hdu, ero)
+    if data_max > data_min:
+        data_ero = (data_ero - data_min) / (data_max - data_min)
+    if color:
+        data_ero = np.transpose(data_ero, (1, 2, 0))
+    core = (slice(y0 - ero[0], y1 - ero[0]), slice(x0 - ero[2], x1 - ero[2]))
+    erosion_params = dict(kernel_size=params['kernel_size'], iterations=params['iterations'],
+                          engine=params['erosion_engine'], shape=params['erosion_shape'])
+
+    if params['localized']:
+        # STEP 3-4: Erode and blend the star regions only (no star in the halo)
+        mask_ero = np.zeros(data_ero.shape[:2], dtype=mask_smooth.dtype)
+        mask_ero[core] = mask_smooth
+        final = reduce_stars_localized(data_ero, mask_ero, **erosion_params)[core]
+    else:
+        eroded = apply_erosion(data_ero, **erosion_params)[core]
+
+        # STEP 4: Blend original and eroded tiles
+        final = compute_final_image(data_ero[core], eroded, mask_smooth)
+    if color:
+        final = np.transpose(final, (2, 0, 1))
+
+    return final, nb_stars
+
+
+def process_tiled(input_path, output_path, params=None, tile_size=2048, background=None,
+                  overwrite=False, progress=None):
+    """
+    Reduce the stars of a FITS image tile by tile, without loading it in memory.
+
+    Parameters:
+    - input_path: FITS file (2D image, or color image with channels first)
+    - output_path: FITS file written with the float32 final image
+    - params: processing parameters (missing ones use DEFAULT_PARAMS)
+    - tile_size: size of the square tiles (without halo)
+    - background: (mean, median, std) for detection; estimated from a
+      subsample of the image when None
+    - overwrite: replace an existing output file
+    - progress: optional callable progress(done, total) called after each tile
+
+    Returns:
+    - number of detected stars
+    """
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    halos = halo_sizes(params)
+
+    with open_memmap(input_path) as hdul:
+        hdu = hdul[0]
+        naxis = hdu.header['NAXIS']
+        if naxis not in (2, 3) or (naxis == 3 and hdu.shape[0] != 3):
+            raise ValueError(f"{input_path}: tiled mode needs a 2D image or a (3, height, width) color image")
+
+        height, width = hdu.shape[-2:]
+        data_range = image_range(hdu)
+        if background is None:
+            background = estimate_background(hdu)
+
+        output = create_output(output_path, hdu.shape, hdu.header, overwrite=overwrite)
+
+        tiles = list(iter_tiles(height, width, tile_size))
+        nb_stars = 0
+        for index, bounds in enumerate(tiles):
+            with section('tile', tags={'bounds': bounds}):
+                final, tile_stars = process_tile(hdu, bounds, params, background, data_range, halos)
+                y0, y1, x0, x1 = bounds
+                output[..., y0:y1, x0:x1] = final
+            nb_stars += tile_stars
+
+            if progress is not None:
+                progress(index + 1, len(tiles))
+
+        output.flush()
+        del output
+
+    return nb_stars